@@ -0,0 +1,131 @@
+# adaptive_limit.py
+"""
+Адаптивный лимит одновременных запросов к API (AIMD):
+  * пока задержка в норме и ошибок нет — лимит растёт на 1 за каждые `limit` успешных ответов;
+  * на 429/5xx/таймаут или рост задержки (EWMA выше базовой в LATENCY_TOLERANCE раз) —
+    лимит умножается на BACKOFF (не чаще раза в COOLDOWN секунд; в это время лимит и не растёт).
+Окна раздельные: извлечение документов и ТН ВЭД с веб-поиском (LIMITERS).
+Текущий лимит и история изменений доступны через metrics().
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Optional
+
+BACKOFF = 0.7
+LATENCY_TOLERANCE = 2.0
+COOLDOWN = 5.0
+EWMA_ALPHA = 0.2
+BASELINE_WINDOW = 100
+HISTORY_LEN = 500
+
+def outcome_of(exc: Optional[BaseException]) -> str:
+    """ok | throttle (429/5xx/таймаут — сигнал перегрузки) | error (остальное, на лимит не влияет)."""
+    if exc is None:
+        return "ok"
+    import requests  # к этому моменту уже загружен клиентом API
+    if isinstance(exc, requests.Timeout):
+        return "throttle"
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        code = exc.response.status_code
+        if code == 429 or code >= 500:
+            return "throttle"
+    return "error"
+
+class AdaptiveLimiter:
+    def __init__(self, name: str, initial: int, min_limit: int = 1, max_limit: int = 32):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial)
+        self.inflight = 0
+        self.ewma: Optional[float] = None
+        self._latencies: Deque[float] = deque(maxlen=BASELINE_WINDOW)
+        self._last_cut = 0.0
+        self._cond = threading.Condition()
+        self.history: Deque[tuple] = deque(maxlen=HISTORY_LEN)  # (time, лимит, причина)
+        self.counters = {"ok": 0, "throttle": 0, "error": 0, "slow": 0}
+        self._log("start")
+
+    def _log(self, reason: str) -> None:
+        self.history.append((time.time(), int(self.limit), reason))
+
+    @property
+    def saturated(self) -> bool:
+        return self.inflight >= int(self.limit)
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+
+    def release(self, latency: float, outcome: str) -> None:
+        with self._cond:
+            was_full = self.inflight >= int(self.limit)
+            self.inflight -= 1
+            self.counters[outcome] += 1
+            if outcome == "ok":
+                slow = self._observe(latency)
+                if slow:
+                    self.counters["slow"] += 1
+                    self._decrease("latency")
+                elif was_full:
+                    self._increase()  # растём, только если лимит действительно упирается
+            elif outcome == "throttle":
+                self._decrease("throttle")
+            self._cond.notify_all()
+
+    def _observe(self, latency: float) -> bool:
+        baseline = sorted(self._latencies)[len(self._latencies) // 2] if len(self._latencies) >= 10 else None
+        self._latencies.append(latency)
+        self.ewma = latency if self.ewma is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma
+        return baseline is not None and self.ewma > baseline * LATENCY_TOLERANCE
+
+    def _increase(self) -> None:
+        if time.monotonic() - self._last_cut < COOLDOWN:
+            return  # после снижения сначала смотрим, как API отреагирует
+        before = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        if int(self.limit) != before:
+            self._log("increase")
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_cut < COOLDOWN:
+            return  # ответы на запросы, ушедшие до снижения, не должны обрушить лимит повторно
+        self._last_cut = now
+        self.limit = max(self.min_limit, self.limit * BACKOFF)
+        self._log(reason)
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start = time.monotonic()
+        exc = None
+        try:
+            yield
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            self.release(time.monotonic() - start, outcome_of(exc))
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "inflight": self.inflight,
+                "latency_ewma": self.ewma,
+                "counters": dict(self.counters),
+                "history": list(self.history),
+            }
+
+LIMITERS: Dict[str, AdaptiveLimiter] = {
+    "extract": AdaptiveLimiter("extract", initial=2, max_limit=8),
+    "hs": AdaptiveLimiter("hs", initial=4, max_limit=16),
+}
+
+def metrics() -> Dict[str, Dict[str, Any]]:
+    return {name: lim.metrics() for name, lim in LIMITERS.items()}
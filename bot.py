@@ -1,234 +1,420 @@
 # bot.py
+"""
+Режимы запуска:
+  python bot.py                  — long polling (для разработки)
+  python bot.py --mode webhook   — свой HTTP-сервер (webhook.py), WEBHOOK_SECRET обязателен
+"""
+import argparse
 import os
 import asyncio
+import shutil
+import time
+import weakref
+from contextlib import ExitStack
 from io import BytesIO
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, InputMediaDocument
 from telegram.constants import ChatAction
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest
+from telegram.request import BaseRequest
+from telegram.ext import (
+    Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
+)
 from dotenv import load_dotenv
 
-from request_2_ppx import (
-    extract_from_pdf_file, validate_result, build_dt_text, classify_items_eaeu,
-    invoice, package_list, cmr, agreement
-)
+load_dotenv()  # до импорта модулей проекта: часть настроек читается при импорте
 
-load_dotenv()
+from pipeline import ROLE_NAMES
+import pdf_optimize
+from doc_roles import classify_documents, assign_documents
+from multidoc import MULTI_ROLES
+from outbox import Outbox
+from shipments import ShipmentRegistry, Shipment, accept_file, stream_download, unique_path
+from tg_file_cache import FileIdCache, file_sha256
+from result_store import ResultStore
+from work_queue import WorkQueue
+from worker import Worker
+from webhook import run_webhook
 
 # -------- настройки --------
 DOCS_DIR = Path("./docs")
 DOCS_DIR.mkdir(parents=True, exist_ok=True)
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
-
-UD_RESULT_TEXT = "result_text"
+JOB_TTL_HOURS = float(os.environ.get("JOB_TTL_HOURS", "24"))
+# для разработки: воркеры в потоках самого бота; в проде — отдельные процессы worker.py
+EMBEDDED_WORKERS = int(os.environ.get("EMBEDDED_WORKERS", "0"))
+EVENT_POLL_INTERVAL = 0.5
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# сколько обновлений обрабатывается одновременно (в т.ч. из одного чата)
+CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "32"))
+
+CD_CURRENT_JOB = "current_job"  # поставка, в которую идут новые файлы
+
+REGISTRY = ShipmentRegistry(ttl_seconds=JOB_TTL_HOURS * 3600)
+FILE_IDS = FileIdCache()
+STORE = ResultStore()
+QUEUE = WorkQueue()
+# выгрузки, документы и события воркеров — через очередь с лимитами Telegram
+OUTBOX = Outbox()
+HISTORY_LIMIT = 10
+MEDIA_GROUP_MAX = 10
 
 # -------- utils --------
 def list_pdfs() -> List[Path]:
     return sorted([p for p in DOCS_DIR.iterdir() if p.suffix.lower() == ".pdf"])
 
-def pick_first_four(pdfs: List[Path]) -> List[Path]:
-    return pdfs[:4]
+async def _send_docs_once(chat_id: int, paths: List[Path], hashes: List[str],
+                          context: ContextTypes.DEFAULT_TYPE, *, use_cache: bool):
+    for start_i in range(0, len(paths), MEDIA_GROUP_MAX):
+        part = list(zip(paths[start_i:start_i + MEDIA_GROUP_MAX], hashes[start_i:start_i + MEDIA_GROUP_MAX]))
+        with ExitStack() as stack:
+            media = []
+            for p, h in part:
+                file_id = FILE_IDS.get(h) if use_cache else None
+                media.append((file_id or stack.enter_context(p.open("rb")), p.name))
+            if len(media) == 1:
+                doc, name = media[0]
+                msgs = [await OUTBOX.send(
+                    context.bot, chat_id, "send_document",
+                    document=doc if isinstance(doc, str) else InputFile(doc, filename=name))]
+            else:
+                msgs = await OUTBOX.send(
+                    context.bot, chat_id, "send_media_group",
+                    media=[InputMediaDocument(doc, filename=name) for doc, name in media])
+        for msg, (_, h) in zip(msgs, part):
+            if msg.document:
+                FILE_IDS.put(h, msg.document.file_id)
 
 async def send_docs(paths: List[Path], update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Одним альбомом; уже отправлявшиеся файлы — по кэшированному file_id, без повторной загрузки."""
     chat_id = update.effective_chat.id
-    for p in paths:
-        with p.open("rb") as f:
-            await context.bot.send_document(chat_id=chat_id, document=InputFile(f, filename=p.name))
-
-def detect_required_docs(pdfs: List[Path]) -> Dict[str, Optional[Path]]:
-    found = {"invoice": None, "pl": None, "cmr": None, "agreement": None}
-    for p in pdfs:
-        n = p.name.lower()
-        if any(k in n for k in ["inv", "invoice"]):
-            found["invoice"] = found["invoice"] or p
-        elif any(k in n for k in ["pack", "packing", "pl"]):
-            found["pl"] = found["pl"] or p
-        elif "cmr" in n:
-            found["cmr"] = found["cmr"] or p
-        elif any(k in n for k in ["dogovor", "agreement", "contract", "ved-dogovor"]):
-            found["agreement"] = found["agreement"] or p
-    return found
-
-async def run_full_pipeline_async(docs: Dict[str, Path]) -> str:
-    def _run_sync() -> str:
-        invoice_json = extract_from_pdf_file(str(docs["invoice"]), invoice.INVOICE_INSTRUCTION_RU, invoice.INVOICE_SCHEMA)
-        validate_result(invoice_json, invoice.INVOICE_SCHEMA)
-
-        pl_json      = extract_from_pdf_file(str(docs["pl"]), package_list.PL_INSTRUCTION_RU, package_list.PACKING_LIST_SCHEMA)
-        validate_result(pl_json, package_list.PACKING_LIST_SCHEMA)
-
-        cmr_json     = extract_from_pdf_file(str(docs["cmr"]), cmr.CMR_INSTRUCTION_RU, cmr.CMR_SCHEMA)
-        validate_result(cmr_json, cmr.CMR_SCHEMA)
-
-        ag_json      = extract_from_pdf_file(str(docs["agreement"]), agreement.AGREEMENT_INSTRUCTION_RU, agreement.AGREEMENT_SCHEMA)
-        validate_result(ag_json, agreement.AGREEMENT_SCHEMA)
-
-        dt_text = build_dt_text(invoice_json, pl_json, cmr_json, ag_json)
-
-        hs_results = classify_items_eaeu(invoice_json, pl_json)
-        lines = []
-        for r in hs_results:
-            if "error" in r:
-                lines.append(f"[33] Позиция {r['line_index']}: ошибка — {r['error']}\n")
-                continue
-            lines.append(f"[33] Позиция {r['line_index']}: код ТН ВЭД ЕАЭС {r['eaeu_hs_code']} (доверие {r.get('confidence')})")
-            for s in r.get("explanations") or []:
-                lines.append(f"  - {s}")
-            if r.get("candidate_codes"):
-                lines.append("  Альтернативы:")
-                for c in r["candidate_codes"]:
-                    lines.append(f"    • {c['code']}: {c['why_not']}")
-            if r.get("evidence_urls"):
-                lines.append("  Источники:")
-                for url in r["evidence_urls"]:
-                    lines.append(f"    - {url}")
-            lines.append("")
-        hs_text = "\n".join(lines).rstrip()
-
-        combined = (
-            "Поле декларации | Вставляемый тектс:\n"
-            f"{dt_text}\n\n"
-            "=====================\n"
-            "Товар | ТН ВЭД:\n"
-            f"{hs_text}\n\n"
-            "Важно: это юридическая подсказка и не более; не является юридическим заключением."
-        )
-        return combined
-
-    return await asyncio.to_thread(_run_sync)
+    hashes = list(await asyncio.gather(*(asyncio.to_thread(file_sha256, p) for p in paths)))
+    try:
+        await _send_docs_once(chat_id, paths, hashes, context, use_cache=True)
+    except BadRequest:
+        # file_id мог стать недействительным (например, сменился токен бота) — грузим байты заново
+        for h in hashes:
+            FILE_IDS.drop(h)
+        await _send_docs_once(chat_id, paths, hashes, context, use_cache=False)
+
+async def send_text(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, **kwargs):
+    """
+    Сообщение в чат через OUTBOX: ответы делят лимиты чата с выгрузками, а RetryAfter
+    повторяется очередью, а не роняет обработчик.
+    """
+    return await OUTBOX.send(context.bot, chat_id, "send_message", text=text, **kwargs)
+
+def notify_failed(context: ContextTypes.DEFAULT_TYPE, chat_id: int, futures, what: str) -> None:
+    """Для отправок, которых обработчик не ждёт: если не дошло — одно сообщение об этом в чат."""
+    notified = []
+
+    def check(fut: asyncio.Future) -> None:
+        if fut.cancelled() or fut.exception() is None or notified:
+            return
+        notified.append(fut)
+        OUTBOX.submit(context.bot, chat_id, "send_message",
+                      text=f"Не удалось отправить {what}: {fut.exception()}. Попробуйте ещё раз позже.",
+                      reply_markup=main_menu_kb())
+
+    for fut in futures:
+        fut.add_done_callback(check)
+
+def detect_required_docs(pdfs: List[Path]) -> Dict[str, List[Path]]:
+    # роль — по тексту первой страницы (параллельно), LLM только при низкой уверенности;
+    # инвойсов и упаковочных листов может быть несколько
+    assigned = assign_documents(classify_documents(pdfs), MULTI_ROLES)
+    return {role: [g.path for g in guesses] for role, guesses in assigned.items()}
+
+async def create_job(chat_id: int) -> Shipment:
+    job = REGISTRY.create(chat_id)
+    await asyncio.to_thread(STORE.create_run, job.job_id, chat_id, None, "collecting")
+    return job
+
+# блокировка живёт, пока её держат или ждут обработчики чата, — словарь не растёт с числом чатов
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+async def current_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Shipment:
+    chat_id = update.effective_chat.id
+    # обновления чата обрабатываются параллельно: без блокировки два файла создали бы две поставки
+    async with _chat_lock(chat_id):
+        job = REGISTRY.get(chat_id, context.chat_data.get(CD_CURRENT_JOB))
+        if job is None:
+            # после готового отчёта поставка остаётся текущей: новый файл той же роли заменяет документ
+            job = await create_job(chat_id)
+            context.chat_data[CD_CURRENT_JOB] = job.job_id
+        return job
+
+def job_status_text(job: Shipment) -> str:
+    got = [f"{ROLE_NAMES[r]} — {', '.join(p.name for p in files)}" for r, files in job.docs.items()]
+    missing = [ROLE_NAMES[r] for r in job.missing_roles]
+    text = f"Поставка {job.job_id}.\nПолучено: " + ("; ".join(got) or "—")
+    if missing:
+        text += "\nОсталось прислать: " + ", ".join(missing)
+    return text
+
+async def report_queued(job: Shipment, submitted: List[str], rebuild: bool, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщает, что сборка отчёта поставлена в очередь (воркер возьмёт её, когда готовы входы)."""
+    if "report" not in submitted:
+        return
+    await asyncio.to_thread(STORE.set_status, job.job_id, "queued")
+    if rebuild:
+        text = f"Поставка {job.job_id}: пересчитываются только зависящие стадии — {', '.join(submitted)}."
+    else:
+        text = f"Все документы поставки {job.job_id} получены, отчёт в очереди."
+    await send_text(context, job.chat_id, text)
+
+async def deliver_events_forever(app: Application):
+    """Доставляет в чаты прогресс и результаты, опубликованные воркерами."""
+    while True:
+        try:
+            events = await asyncio.to_thread(QUEUE.take_events)
+        except Exception:
+            events = []
+        for ev in events:
+            # не ждём доставки: медленный или упёршийся в лимит чат не задерживает события других
+            if ev["kind"] == "done":
+                OUTBOX.submit(app.bot, ev["chat_id"], "send_message",
+                              text=ev["text"] + "\nВыберите способ получения результата:",
+                              reply_markup=export_menu_kb(ev["run_id"]))
+            elif ev["kind"] == "failed":
+                OUTBOX.submit(app.bot, ev["chat_id"], "send_message", text=ev["text"], reply_markup=main_menu_kb())
+            else:
+                OUTBOX.submit(app.bot, ev["chat_id"], "send_message", text=ev["text"])
+        if not events:
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
 
 # -------- UI --------
 def main_menu_text() -> str:
     return (
         "Здравствуйте! Перед вами MVP AI-таможенного брокера.\n"
-        "Для демонстрации используются заранее подготовленные документы:\n"
+        "Пришлите PDF-файлы поставки:\n"
         "— Договор\n"
         "— Инвойс\n"
         "— Международная автотранспортная накладная (CMR)\n"
         "— Упаковочный лист\n\n"
-        "Нажмите «Загрузить документы», чтобы отправить файлы и запустить обработку."
+        "Тип документа определяется автоматически, обработка каждого файла начинается сразу.\n"
+        "«Новая поставка» — начать ещё одну параллельно, «Демо» — обработать заранее подготовленные документы."
     )
 
 def main_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("📥 Загрузить документы", callback_data="upload")]])
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🆕 Новая поставка", callback_data="new")],
+        [InlineKeyboardButton("📥 Демо: документы из ./docs", callback_data="upload")],
+        [InlineKeyboardButton("🗂 Прошлые поставки", callback_data="history")],
+    ])
 
-def export_menu_kb() -> InlineKeyboardMarkup:
+def export_menu_kb(job_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📄 Выгрузить в TXT", callback_data="export_txt")],
-        [InlineKeyboardButton("💬 Отправить в чат", callback_data="export_chat")],
+        [InlineKeyboardButton("📄 Выгрузить в TXT", callback_data=f"export_txt:{job_id}")],
+        [InlineKeyboardButton("💬 Отправить в чат", callback_data=f"export_chat:{job_id}")],
         [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_menu")],
     ])
 
+def history_kb(runs: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    rows = []
+    for r in runs:
+        date = time.strftime("%d.%m %H:%M", time.localtime(r["created_at"]))
+        rows.append([InlineKeyboardButton(f"📄 {date} · {r['title'] or r['run_id']}", callback_data=f"export_txt:{r['run_id']}"),
+                     InlineKeyboardButton("💬", callback_data=f"export_chat:{r['run_id']}")])
+    rows.append([InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_menu")])
+    return InlineKeyboardMarkup(rows)
+
 async def back_to_menu_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=main_menu_text(), reply_markup=main_menu_kb())
+    await send_text(context, update.effective_chat.id, main_menu_text(), reply_markup=main_menu_kb())
 
 # -------- хэндлеры --------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(main_menu_text(), reply_markup=main_menu_kb())
+    await send_text(context, update.effective_chat.id, main_menu_text(), reply_markup=main_menu_kb())
+
+async def new_shipment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job = await create_job(update.effective_chat.id)
+    context.chat_data[CD_CURRENT_JOB] = job.job_id
+    await send_text(context, update.effective_chat.id,
+                    f"Создана поставка {job.job_id}. Пришлите 4 PDF: договор, инвойс, CMR и упаковочный лист.")
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    runs = await asyncio.to_thread(STORE.list_runs, update.effective_chat.id, HISTORY_LIMIT, "done")
+    if not runs:
+        await send_text(context, update.effective_chat.id, "Готовых отчётов пока нет.", reply_markup=main_menu_kb())
+        return
+    await send_text(context, update.effective_chat.id, "Последние поставки (выгрузка без повторной обработки):",
+                    reply_markup=history_kb(runs))
+
+async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    doc = update.message.document
+    chat_id = update.effective_chat.id
+    job = await current_job(update, context)
+    dest = unique_path(job.workdir, doc.file_name or f"{doc.file_unique_id}.pdf")
+    try:
+        tg_file = await doc.get_file()
+        await stream_download(tg_file.file_path, dest)
+    except Exception as e:
+        dest.unlink(missing_ok=True)   # имя было занято заранее
+        await send_text(context, chat_id, f"Не удалось скачать {doc.file_name}: {e}")
+        return
+    # файл уже лежит на серверах Telegram — запоминаем его file_id
+    FILE_IDS.put(await asyncio.to_thread(file_sha256, dest), doc.file_id)
+
+    rebuild = job.report_submitted
+    guess, submitted = await accept_file(job, dest, QUEUE)
+    if guess.role is None:
+        await send_text(context, chat_id, f"Не удалось определить тип документа {dest.name}. "
+                                          "Пришлите договор, инвойс, CMR или упаковочный лист.")
+        return
+    if not submitted:
+        dest.unlink(missing_ok=True)
+        await send_text(context, chat_id, f"{dest.name}: этот {ROLE_NAMES[guess.role]} уже есть в поставке.\n"
+                                          + job_status_text(job))
+        return
+    await send_text(context, chat_id,
+                    f"{dest.name}: {ROLE_NAMES[guess.role]} (уверенность {guess.confidence:.2f}). Обработка начата.\n"
+                    + job_status_text(job))
+    await report_queued(job, submitted, rebuild, context)
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    chat_id = update.effective_chat.id
     await query.answer()
 
     try:
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     except Exception:
         pass
 
-    if query.data == "upload":
+    action, _, job_id = (query.data or "").partition(":")
+
+    if action == "new":
+        await new_shipment(update, context)
+        return
+
+    if action == "history":
+        await history(update, context)
+        return
+
+    if action == "upload":
         pdfs = list_pdfs()
         if len(pdfs) < 4:
-            await query.message.reply_text(
-                f"В папке ./docs найдено {len(pdfs)} PDF-файлов. "
-                "Для демонстрации требуется 4 файла: договор, инвойс, CMR и упаковочный лист.",
-                reply_markup=main_menu_kb()
-            )
+            await send_text(context, chat_id,
+                            f"В папке ./docs найдено {len(pdfs)} PDF-файлов. "
+                            "Для демонстрации требуется 4 файла: договор, инвойс, CMR и упаковочный лист.",
+                            reply_markup=main_menu_kb())
             return
 
-        four = pick_first_four(pdfs)
-        await query.message.reply_text("Отправляю 4 PDF…")
-        await send_docs(four, update, context)
-
-        roles = detect_required_docs(four)
-        missing_roles = [k for k, v in roles.items() if v is None]
+        roles = await asyncio.to_thread(detect_required_docs, pdfs)
+        missing_roles = [k for k, v in roles.items() if not v]
         if missing_roles:
-            await query.message.reply_text(
-                "Не удалось распознать все документы по именам файлов.\n"
-                "Убедитесь, что названия содержат ключевые слова: "
-                "invoice/inv, packing/pack/pl, cmr, agreement/contract/dogovor.",
-                reply_markup=main_menu_kb()
-            )
-            return
-
-        await query.message.reply_text("Начинаю обработку документов…")
-        try:
-            combined_text = await run_full_pipeline_async(roles)
-        except Exception as e:
-            await query.message.reply_text(f"Ошибка обработки: {e}", reply_markup=main_menu_kb())
+            await send_text(context, chat_id,
+                            "Не удалось распознать все документы по содержимому.\n"
+                            f"Не найдены: {', '.join(missing_roles)}. "
+                            "Нужны договор, инвойс, CMR и упаковочный лист.",
+                            reply_markup=main_menu_kb())
             return
 
-        # --- ВАЖНО: не отправляем отчёт сразу ---
-        context.user_data[UD_RESULT_TEXT] = combined_text
-        await query.message.reply_text(  # <- новое поведение
-            "Отчёт готов.\nВыберите способ получения результата:",
-            reply_markup=export_menu_kb()
-        )
+        job = await create_job(chat_id)
+        context.chat_data[CD_CURRENT_JOB] = job.job_id
+        submitted = []
+        for role, sources in roles.items():
+            for src in sources:
+                dest = unique_path(job.workdir, src.name)
+                await asyncio.to_thread(shutil.copyfile, src, dest)
+                # извлечение ставится в очередь до отправки файлов в чат
+                submitted += await asyncio.to_thread(job.submit_extraction, QUEUE, role, dest)
+
+        files = [p for k in ("agreement", "invoice", "cmr", "pl") for p in job.docs[k]]
+        await send_text(context, chat_id, f"Отправляю {len(files)} PDF…")
+        # отправка файлов в чат идёт параллельно с извлечением и не блокирует его
+        context.application.create_task(send_docs(files, update, context), update=update)
+        await report_queued(job, submitted, False, context)
         return
 
-    if query.data == "export_txt":
-        combined_text = context.user_data.get(UD_RESULT_TEXT)
+    if action == "export_txt":
+        combined_text = await asyncio.to_thread(STORE.report, job_id, chat_id)
         if not combined_text:
-            await query.message.reply_text("Нет данных для экспорта. Начните заново.", reply_markup=main_menu_kb())
+            await send_text(context, chat_id, "Нет данных для экспорта. Начните заново.", reply_markup=main_menu_kb())
             return
         bio = BytesIO(combined_text.encode("utf-8"))
-        bio.name = "dt_mapping__hs_classification.txt"
-        await context.bot.send_document(
-            chat_id=update.effective_chat.id,
-            document=bio,
-            caption="Результаты обработки (TXT)."
-        )
-        await query.message.reply_text("Готово. Вернуться в главное меню?", reply_markup=InlineKeyboardMarkup([
+        bio.name = f"dt_mapping__hs_classification_{job_id}.txt"
+        await OUTBOX.send(context.bot, chat_id, "send_document",
+                          document=bio, caption="Результаты обработки (TXT).")
+        await send_text(context, chat_id, "Готово. Вернуться в главное меню?", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_menu")]
         ]))
         return
 
-    if query.data == "export_chat":
-        combined_text = context.user_data.get(UD_RESULT_TEXT)
+    if action == "export_chat":
+        combined_text = await asyncio.to_thread(STORE.report, job_id, chat_id)
         if not combined_text:
-            await query.message.reply_text("Нет данных для отправки. Начните заново.", reply_markup=main_menu_kb())
+            await send_text(context, chat_id, "Нет данных для отправки. Начните заново.", reply_markup=main_menu_kb())
             return
-        MAX_LEN = 4000
-        if len(combined_text) <= MAX_LEN:
-            await query.message.reply_text(combined_text)
-        else:
-            chunk, size = [], 0
-            for line in combined_text.splitlines(True):
-                if size + len(line) > MAX_LEN:
-                    await query.message.reply_text("".join(chunk))
-                    chunk, size = [], 0
-                chunk.append(line)
-                size += len(line)
-            if chunk:
-                await query.message.reply_text("".join(chunk))
-        await query.message.reply_text("Готово. Вернуться в главное меню?", reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_menu")]
-        ]))
+        # части (или zip, если их много) уходят в очередь чата; обработчик доставки не ждёт
+        futures = await OUTBOX.submit_text(context.bot, chat_id, combined_text,
+                                           f"dt_mapping__hs_classification_{job_id}.txt",
+                                           caption="Отчёт длинный — отправляю файлом (TXT в zip).")
+        notify_failed(context, chat_id, futures, "отчёт")
+        OUTBOX.submit(context.bot, chat_id, "send_message", text="Готово. Вернуться в главное меню?",
+                      reply_markup=InlineKeyboardMarkup([
+                          [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_menu")]
+                      ]))
         return
 
-    if query.data == "back_to_menu":
+    if action == "back_to_menu":
         await back_to_menu_prompt(update, context)
         return
 
+async def maintenance_forever(interval: float = 600):
+    while True:
+        REGISTRY.sweep()
+        await asyncio.to_thread(STORE.compact)
+        await asyncio.to_thread(STORE.evict)
+        await asyncio.to_thread(pdf_optimize.evict_cache)
+        await asyncio.sleep(interval)
+
+async def post_init(app: Application):
+    loop = asyncio.get_running_loop()
+    loop.create_task(maintenance_forever())
+    loop.create_task(deliver_events_forever(app))
+    if EMBEDDED_WORKERS:
+        Worker(QUEUE, STORE, threads=EMBEDDED_WORKERS).start_in_thread()
+
+def build_app(token: Optional[str] = None, request: Optional[BaseRequest] = None) -> Application:
+    """request — подменённый транспорт Bot API (нагрузочный тест loadtest.py)."""
+    builder = (Application.builder().token(token or TOKEN).post_init(post_init)
+               .concurrent_updates(CONCURRENT_UPDATES))
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("new", new_shipment))
+    app.add_handler(CommandHandler("history", history))
+    app.add_handler(MessageHandler(filters.Document.PDF, on_document, block=False))
+    app.add_handler(CallbackQueryHandler(on_callback))
+    return app
+
 def main():
+    ap = argparse.ArgumentParser(description="Telegram-бот AI-таможенного брокера")
+    ap.add_argument("--mode", choices=["polling", "webhook"], default=BOT_MODE)
+    args = ap.parse_args()
     if not TOKEN:
         raise RuntimeError("Переменная окружения TELEGRAM_TOKEN не задана.")
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(on_callback))
-    print("Бот запущен. Нажмите Ctrl+C для остановки.")
-    app.run_polling(close_loop=False)
+    app = build_app()
+    print(f"Бот запущен ({args.mode}). Нажмите Ctrl+C для остановки.")
+    if not EMBEDDED_WORKERS:
+        print("Задачи обрабатывают отдельные процессы: python worker.py")
+    if args.mode == "webhook":
+        try:
+            asyncio.run(run_webhook(app))
+        except KeyboardInterrupt:
+            pass
+    else:
+        app.run_polling(close_loop=False)
 
 if __name__ == "__main__":
     main()
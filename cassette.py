@@ -0,0 +1,178 @@
+# cassette.py
+"""
+Запись и воспроизведение обменов с API (кассеты) — чтобы повторить медленный или сломанный прогон
+в точности и гонять весь конвейер бота на реальных документах без сети.
+
+CASSETTE_MODE=record — каждый вызов _call_perplexity дописывается в CASSETTE_PATH (JSONL в gzip,
+запись — отдельный gzip-блок, поэтому файл можно дописывать из нескольких процессов): отпечаток
+запроса, краткое описание (текст промпта, имена/хэши/размеры файлов), попытки по моделям
+с задержкой, ошибкой и usage, итоговая задержка и ответ — или ошибка.
+CASSETTE_MODE=replay — ответы берутся из кассеты по отпечатку, без обращения к API и ключа;
+задержка — записанная, умноженная на CASSETTE_SPEED (1 — как было, 0 — без ожидания).
+Записанная ошибка воспроизводится как ошибка. Одинаковые запросы получают ответы в порядке
+записи (последний — повторно). Запроса нет в кассете — CassetteMiss.
+
+Отпечаток — хэш политики, сообщения (вместе с содержимым PDF), схемы, температуры и веб-поиска:
+при смене промпта, схемы или настроек подготовки PDF (pdf_optimize) кассету нужно перезаписать.
+
+Сводка по кассете:  python cassette.py data/cassettes/run.jsonl.gz
+"""
+import argparse
+import copy
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from hashing import content_hash
+
+CASSETTE_MODE = os.environ.get("CASSETTE_MODE", "").lower()          # "" | record | replay
+CASSETTE_PATH = Path(os.environ.get("CASSETTE_PATH", "./data/cassettes/run.jsonl.gz"))
+CASSETTE_SPEED = float(os.environ.get("CASSETTE_SPEED", "1"))
+FORMAT_VERSION = 1
+
+class CassetteMiss(LookupError):
+    pass
+
+def fingerprint(message_content: list, schema, *, temperature: float, web_search: bool, policy: str) -> str:
+    return content_hash([policy, message_content, schema, temperature, web_search])
+
+def describe(message_content: list, schema) -> Dict[str, Any]:
+    """Что было в запросе — без base64 файлов, для чтения кассеты человеком."""
+    text, files = [], []
+    for part in message_content:
+        if part.get("type") == "text":
+            text.append(part["text"])
+        elif part.get("type") == "file_url":
+            raw = part["file_url"]["url"].encode("ascii")
+            files.append({"name": part.get("file_name"), "sha256": hashlib.sha256(raw).hexdigest(),
+                          "b64_bytes": len(raw)})
+    return {"text": text, "files": files, "schema": content_hash(schema)}
+
+def total_usage(attempts: List[Dict[str, Any]]) -> Dict[str, int]:
+    out: Dict[str, int] = defaultdict(int)
+    for a in attempts:
+        for k, v in (a.get("usage") or {}).items():
+            if isinstance(v, int):
+                out[k] += v
+    return dict(out)
+
+class Cassette:
+    def __init__(self, path: Path, mode: str, speed: float = 1.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"CASSETTE_MODE: record или replay, а не {mode!r}")
+        self.path = Path(path)
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._tape: Optional[Dict[str, List[Dict[str, Any]]]] = None
+        self._served: Dict[str, int] = defaultdict(int)
+
+    # ——— запись ———
+    def _append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        block = gzip.compress(line.encode("utf-8"))
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("ab") as f:
+                f.write(block)   # один write на запись: O_APPEND не перемешает блоки разных процессов
+
+    def record(self, call: Callable[[], Any], attempts: List[Dict[str, Any]], message_content: list, schema, *,
+               temperature: float, web_search: bool, policy: str) -> Any:
+        """Выполняет call() и записывает обмен; attempts заполняет сам вызов (по попытке на модель)."""
+        entry = {"v": FORMAT_VERSION, "ts": time.time(), "policy": policy,
+                 "fp": fingerprint(message_content, schema, temperature=temperature,
+                                   web_search=web_search, policy=policy),
+                 "request": {**describe(message_content, schema), "temperature": temperature,
+                             "web_search": web_search},
+                 "attempts": attempts}
+        start = time.perf_counter()
+        try:
+            result = call()
+        except Exception as e:
+            self._append({**entry, "latency_s": round(time.perf_counter() - start, 3),
+                          "usage": total_usage(attempts), "error": f"{type(e).__name__}: {e}"})
+            raise
+        self._append({**entry, "latency_s": round(time.perf_counter() - start, 3),
+                      "usage": total_usage(attempts), "response": result})
+        return result
+
+    # ——— воспроизведение ———
+    def _load(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            if self._tape is None:
+                tape: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+                for entry in read(self.path):
+                    tape[entry["fp"]].append(entry)
+                self._tape = tape
+            return self._tape
+
+    def replay(self, message_content: list, schema, *, temperature: float, web_search: bool, policy: str,
+               on_item=None) -> Any:
+        fp = fingerprint(message_content, schema, temperature=temperature, web_search=web_search, policy=policy)
+        entries = self._load().get(fp)
+        if not entries:
+            text = " ".join(describe(message_content, schema)["text"])[:120]
+            raise CassetteMiss(f"нет в кассете {self.path}: {policy} «{text}…»")
+        with self._lock:
+            entry = entries[min(self._served[fp], len(entries) - 1)]
+            self._served[fp] += 1
+        time.sleep(entry["latency_s"] * self.speed)
+        if "error" in entry:
+            raise RuntimeError(f"(кассета) {entry['error']}")
+        result = copy.deepcopy(entry["response"])   # у каждого воспроизведения — своя копия
+        if on_item is not None:
+            head = {k: v for k, v in result.items() if k != "items"}
+            for idx, item in enumerate(result.get("items") or []):
+                on_item(idx, item, head)
+        return result
+
+def read(path: Path) -> List[Dict[str, Any]]:
+    # блоки gzip подряд читаются как один поток; недописанный хвост (упавший процесс) отбрасывается
+    entries = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+    except (EOFError, json.JSONDecodeError):
+        pass
+    return entries
+
+_CURRENT: Optional[Cassette] = None
+_CURRENT_LOCK = threading.Lock()
+
+def current() -> Optional[Cassette]:
+    """Кассета по CASSETTE_MODE/CASSETTE_PATH или None (обычная работа с API)."""
+    global _CURRENT
+    if not CASSETTE_MODE:
+        return None
+    with _CURRENT_LOCK:
+        if _CURRENT is None:
+            _CURRENT = Cassette(CASSETTE_PATH, CASSETTE_MODE, CASSETTE_SPEED)
+        return _CURRENT
+
+# ——— сводка ———
+def summary(path: Path) -> None:
+    entries = read(path)
+    by_policy: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for e in entries:
+        by_policy[e["policy"]].append(e)
+    print(f"{path}: записей {len(entries)}, уникальных запросов {len({e['fp'] for e in entries})}")
+    print(f"{'политика':<10} {'n':>5} {'ошибок':>7} {'p50, с':>7} {'p95, с':>7} {'вход':>9} {'выход':>9}")
+    for policy, es in sorted(by_policy.items()):
+        lat = sorted(e["latency_s"] for e in es)
+        p = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))]
+        tokens = lambda k: sum((e.get("usage") or {}).get(k, 0) for e in es)
+        print(f"{policy:<10} {len(es):>5} {sum('error' in e for e in es):>7} {p(0.5):>7.1f} {p(0.95):>7.1f} "
+              f"{tokens('prompt_tokens'):>9} {tokens('completion_tokens'):>9}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Сводка по кассете обменов с API")
+    ap.add_argument("path", type=Path, nargs="?", default=CASSETTE_PATH)
+    summary(ap.parse_args().path)
@@ -0,0 +1,144 @@
+# chunked_extract.py
+"""
+Извлечение длинных инвойсов по частям. Тысячи позиций в одном ответе упираются в лимит
+выходных токенов и таймауты, поэтому инвойс от CHUNK_MIN_PAGES страниц извлекается так:
+  1) шапка и итоги — по первой и последней страницам, схема без items;
+  2) позиции — диапазонами по CHUNK_PAGES страниц, параллельно (до CHUNK_WORKERS запросов).
+     К диапазону для контекста добавляются первая страница (шапка таблицы) и следующая
+     (продолжение строки на стыке), но вернуть нужно только строки, начинающиеся на своих страницах;
+  3) сшивка — по порядку диапазонов. Если конец одного диапазона совпадает с началом следующего
+     (модель всё же повторила строку на стыке), повтор отбрасывается — кроме случая, когда
+     итоги инвойса сходятся только с ним (значит, это действительно две одинаковые строки).
+Собранный инвойс проверяется по полной схеме в pipeline.extract_document.
+
+Деление PDF на страницы — через pypdf; без него инвойс извлекается одним запросом.
+"""
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from profiles import subset_schema, wire_schema
+from reconcile import totals_match
+from request_2_ppx import extract_from_pdf_bytes
+
+CHUNK_MIN_PAGES = int(os.environ.get("CHUNK_MIN_PAGES", "8"))   # меньше страниц — одним запросом
+CHUNK_PAGES = int(os.environ.get("CHUNK_PAGES", "4"))           # страниц позиций на запрос
+CHUNK_WORKERS = int(os.environ.get("CHUNK_WORKERS", "4"))
+OVERLAP_MAX = 3   # сколько строк на стыке диапазонов сравнивать на повтор
+
+def _pdf_reader():
+    # pypdf нужен только для длинных инвойсов и грузится при первом обращении
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    return PdfReader
+
+def page_count(path: Path) -> Optional[int]:
+    PdfReader = _pdf_reader()
+    if PdfReader is None:
+        return None
+    try:
+        return len(PdfReader(str(path)).pages)
+    except Exception:
+        return None
+
+def should_chunk(path: Path) -> bool:
+    n = page_count(path)
+    return n is not None and n >= CHUNK_MIN_PAGES
+
+def page_ranges(n: int, size: int = CHUNK_PAGES) -> List[Tuple[int, int]]:
+    """Диапазоны страниц (с 1, включительно) по size страниц."""
+    return [(a, min(a + size - 1, n)) for a in range(1, n + 1, size)]
+
+def pdf_pages(reader, pages: List[int]) -> bytes:
+    """Новый PDF из страниц pages (номера с 1)."""
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for p in pages:
+        writer.add_page(reader.pages[p - 1])
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+# ——— запросы ———
+def _header(reader, n: int, name: str, instruction: str) -> Dict[str, Any]:
+    fields = [f for f in wire_schema("invoice").get("properties", {}) if f != "items"]
+    pages = [1, n] if n > 1 else [1]
+    note = (f"\n\nИЗВЛЕЧЕНИЕ ПО ЧАСТЯМ. В файле — первая и последняя страницы инвойса из {n}. "
+            "Верни только реквизиты и итоги, позиции (items) не нужны.")
+    return extract_from_pdf_bytes(pdf_pages(reader, pages), name, instruction + note, subset_schema("invoice", fields))
+
+def _items_schema() -> Dict[str, Any]:
+    schema = subset_schema("invoice", ["items"])
+    items = schema["properties"]["items"]
+    # на странице диапазона может не оказаться ни одной новой строки
+    return {**schema, "properties": {"items": {**items, "minItems": 0}}}
+
+def _items_request(reader, n: int, span: Tuple[int, int]) -> Tuple[bytes, str]:
+    """PDF диапазона (с контекстными страницами) и дополнение к инструкции."""
+    a, b = span
+    before = [1] if a > 1 else []
+    after = [b + 1] if b < n else []
+    context = []
+    if before:
+        context.append("первая страница файла — первая страница инвойса (шапка таблицы)")
+    if after:
+        context.append(f"последняя страница файла — страница {b + 1}")
+    note = (f"\n\nИЗВЛЕЧЕНИЕ ПО ЧАСТЯМ. Инвойс из {n} страниц; в файле страницы {a}–{b}"
+            + (f" и для контекста: {'; '.join(context)}" if context else "") + ". "
+            f"Верни только позиции (items), строки которых начинаются на страницах {a}–{b}, "
+            "в порядке документа; строку, начатую на предыдущей странице, не возвращай. Итоги не нужны.")
+    return pdf_pages(reader, before + list(range(a, b + 1)) + after), note
+
+# ——— сшивка ———
+def _row_key(item: Dict[str, Any]) -> str:
+    norm = lambda v: " ".join(v.casefold().split()) if isinstance(v, str) else v
+    return json.dumps({k: norm(v) for k, v in item.items()}, sort_keys=True, ensure_ascii=False)
+
+def boundary_overlap(prev: List[Dict[str, Any]], nxt: List[Dict[str, Any]], limit: int = OVERLAP_MAX) -> int:
+    """Сколько строк в начале nxt повторяют конец prev (наибольшее совпадение, не больше limit)."""
+    for k in range(min(limit, len(prev), len(nxt)), 0, -1):
+        if [_row_key(x) for x in prev[-k:]] == [_row_key(x) for x in nxt[:k]]:
+            return k
+    return 0
+
+def stitch(header: Dict[str, Any], chunks: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Инвойс из шапки и позиций диапазонов (по порядку); повторы на стыках — см. описание модуля."""
+    deduped = list(chunks[0]) if chunks else []
+    full = list(deduped)
+    for prev, nxt in zip(chunks, chunks[1:]):
+        deduped += nxt[boundary_overlap(prev, nxt):]
+        full += nxt
+    invoice = {**header, "items": deduped}
+    if len(full) != len(deduped) and totals_match(invoice) is False \
+            and totals_match({**header, "items": full}) is True:
+        invoice["items"] = full
+    return invoice
+
+def extract_invoice_chunked(path: Path, instruction: str,
+                            on_item: Optional[Callable[[int, Dict[str, Any], Dict[str, Any]], None]] = None
+                            ) -> Dict[str, Any]:
+    """
+    Инвойс по частям: сначала шапка, затем диапазоны позиций параллельно.
+    on_item(idx, item, head) — как в request_2_ppx._call_perplexity; head — уже извлечённая шапка.
+    """
+    from pdf_optimize import prepare
+    reader = _pdf_reader()(io.BytesIO(prepare(path)[0]))   # части режутся из уже уменьшенного PDF
+    n = len(reader.pages)
+    # PdfReader не потокобезопасен — все части PDF режутся заранее, параллельны только запросы
+    requests = [_items_request(reader, n, span) for span in page_ranges(n)]
+    header = _header(reader, n, path.name, instruction)
+    item_cb = (lambda idx, item, _head: on_item(idx, item, header)) if on_item else None
+    schema = _items_schema()
+
+    def items(req: Tuple[bytes, str]) -> List[Dict[str, Any]]:
+        data, note = req
+        return extract_from_pdf_bytes(data, path.name, instruction + note, schema, on_item=item_cb).get("items") or []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(CHUNK_WORKERS, len(requests)))) as ex:
+        chunks = list(ex.map(items, requests))
+    return stitch(header, chunks)
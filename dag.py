@@ -0,0 +1,83 @@
+# dag.py
+"""
+Небольшой планировщик графа стадий: стадия стартует, как только готовы все её входы.
+Для каждого прогона собираются тайминги и критический путь (цепочка стадий,
+которая определила общее время).
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# fn(inputs) → результат, где inputs: имя зависимости → её результат
+StageFn = Callable[[Dict[str, Any]], Any]
+
+class StageError(RuntimeError):
+    def __init__(self, stage: str, cause: BaseException):
+        super().__init__(f"стадия {stage}: {cause}")
+        self.stage = stage
+        self.cause = cause
+
+def critical_path(deps: Dict[str, List[str]], timings: Dict[str, Tuple[float, float]],
+                  sink: str) -> List[Tuple[str, float]]:
+    """
+    Идём от конечной стадии назад, каждый раз к зависимости, завершившейся последней.
+    Возвращает [(стадия, длительность в секундах)] от начала к концу.
+    """
+    path = []
+    node = sink
+    while node is not None:
+        start, end = timings[node]
+        path.append((node, end - start))
+        done_deps = [d for d in deps.get(node, []) if d in timings]
+        node = max(done_deps, key=lambda d: timings[d][1]) if done_deps else None
+    return list(reversed(path))
+
+def format_critical_path(path: List[Tuple[str, float]], total: float) -> str:
+    chain = " → ".join(f"{name} ({dur:.1f} c)" for name, dur in path)
+    return f"Критический путь: {chain}; всего {total:.1f} c"
+
+class DagRunner:
+    def __init__(self, deps: Dict[str, List[str]], funcs: Dict[str, StageFn], max_workers: int = 8):
+        unknown = {d for ds in deps.values() for d in ds} - set(deps)
+        if unknown:
+            raise ValueError(f"неизвестные зависимости: {sorted(unknown)}")
+        self.deps = deps
+        self.funcs = funcs
+        self.max_workers = max_workers
+
+    def run(self, done: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], Dict[str, Tuple[float, float]]]:
+        """
+        done: уже готовые результаты стадий (не пересчитываются).
+        Возвращает (результаты, тайминги {стадия: (start, end)} по time.monotonic()).
+        """
+        results: Dict[str, Any] = dict(done or {})
+        now = time.monotonic()
+        timings: Dict[str, Tuple[float, float]] = {name: (now, now) for name in results}
+        pending = {name for name in self.deps if name not in results}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stage") as ex:
+            while pending or running:
+                ready = [n for n in pending if all(d in results for d in self.deps[n])]
+                for name in ready:
+                    pending.discard(name)
+                    inputs = {d: results[d] for d in self.deps[name]}
+                    running[ex.submit(self._timed, name, inputs)] = name
+                if not running:
+                    raise ValueError(f"цикл в графе стадий: {sorted(pending)}")
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    name = running.pop(fut)
+                    try:
+                        value, start, end = fut.result()
+                    except BaseException as e:
+                        for f in running:
+                            f.cancel()
+                        raise StageError(name, e) from e
+                    results[name] = value
+                    timings[name] = (start, end)
+        return results, timings
+
+    def _timed(self, name: str, inputs: Dict[str, Any]):
+        start = time.monotonic()
+        value = self.funcs[name](inputs)
+        return value, start, time.monotonic()
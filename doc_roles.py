@@ -0,0 +1,250 @@
+# doc_roles.py
+"""
+Определение роли документа (invoice / pl / cmr / agreement) по содержимому первой страницы.
+Локальный классификатор: ключевые слова + признаки разметки (заголовок, графы CMR, таблицы),
+имя файла — только слабая подсказка. LLM вызывается лишь при низкой уверенности.
+"""
+import re
+import zlib
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Iterable
+
+ROLES = ("invoice", "pl", "cmr", "agreement")
+CONFIDENCE_THRESHOLD = 0.55
+FILENAME_ONLY_CONFIDENCE = 0.3   # потолок, когда в тексте нет ни одного признака роли
+MAX_TEXT_CHARS = 6000
+
+# (шаблон, вес) — шаблоны применяются к тексту в нижнем регистре
+KEYWORDS: Dict[str, List[tuple]] = {
+    "invoice": [
+        (r"\bcommercial invoice\b", 6), (r"\binvoice\b", 3), (r"\bинвойс\w*", 4),
+        (r"\bсч[её]т(?:-фактура)?\b", 2), (r"\brechnung\b", 3), (r"\bproforma\b", 1),
+        (r"\bunit price\b|цена за ед", 2), (r"\btotal amount\b|\bamount due\b|итого к оплате", 2),
+        (r"\biban\b|\bswift\b|\bbic\b", 1), (r"\bvat\b|\bндс\b", 1), (r"\bincoterms\b", 1),
+    ],
+    "pl": [
+        (r"\bpacking list\b", 6), (r"\bупаковочн\w* лист\w*", 6), (r"\bpackliste\b", 5),
+        (r"\bgross weight\b|\bбрутто\b", 2), (r"\bnet weight\b|\bнетто\b", 2),
+        (r"\bcartons?\b|\bpallets?\b|\bпаллет\w*|\bкоробк\w*", 1),
+        (r"\bdimensions?\b|\bгабарит\w*", 1), (r"\bmarks (?:and|&) numbers\b|маркировк\w*", 1),
+        (r"\bpackages?\b|\bмест\b", 1),
+    ],
+    "cmr": [
+        (r"\bcmr\b", 6), (r"convention relative au contrat", 5),
+        (r"международн\w* (?:товарно-)?транспортн\w* накладн\w*", 6),
+        (r"\bconsignor\b|\bsender\b|грузоотправител\w*", 2),
+        (r"\bconsignee\b|грузополучател\w*", 2), (r"\bcarrier\b|перевозчик\w*", 2),
+        (r"taking over|place of delivery|место погрузки|место разгрузки", 2),
+        (r"\btractor\b|\btrailer\b|тягач\w*|прицеп\w*", 1),
+    ],
+    "agreement": [
+        (r"\bcontract\b|\bagreement\b", 3), (r"\bдоговор\w*|\bконтракт\w*", 4),
+        (r"\bthe parties\b|\bстороны\b", 2), (r"\bhereinafter\b|именуем\w*", 3),
+        (r"\bsubject of the (?:contract|agreement)\b|предмет договора", 3),
+        (r"force majeure|форс-мажор\w*", 2), (r"\barbitration\b|арбитраж\w*", 1),
+        (r"\bsignatures?\b|подписи сторон", 1),
+    ],
+}
+
+# заголовок документа обычно в первых строках — там совпадение весит больше
+TITLE_PATTERNS: Dict[str, str] = {
+    "invoice": r"\b(?:commercial\s+)?invoice\b|\bинвойс\b|\bсч[её]т\b|\brechnung\b",
+    "pl": r"\bpacking\s+list\b|\bупаковочный\s+лист\b|\bpackliste\b",
+    "cmr": r"\bcmr\b|транспортная\s+накладная",
+    "agreement": r"\bcontract\b|\bagreement\b|\bдоговор\b|\bконтракт\b",
+}
+TITLE_WEIGHT = 5
+TITLE_LINES = 6
+
+# слабая подсказка по имени файла: сравниваем токены целиком ("sample" ≠ "pl")
+FILENAME_TOKENS: Dict[str, set] = {
+    "invoice": {"inv", "invoice", "rechnung"},
+    "pl": {"pl", "pack", "packing", "packinglist"},
+    "cmr": {"cmr"},
+    "agreement": {"dogovor", "agreement", "contract", "ved"},
+}
+FILENAME_WEIGHT = 2
+
+@dataclass
+class RoleGuess:
+    path: Path
+    role: Optional[str]
+    confidence: float
+    scores: Dict[str, float] = field(default_factory=dict)
+    source: str = "local"  # local | llm
+
+# ——— текстовый слой первой страницы ———
+_TJ_RE = re.compile(rb"\((?:\\.|[^\\)])*\)\s*Tj|\[(?:[^\]]*)\]\s*TJ", re.S)
+_STR_RE = re.compile(rb"\(((?:\\.|[^\\)])*)\)", re.S)
+_STREAM_RE = re.compile(rb"stream\r?\n(.*?)\s*endstream", re.S)
+
+def _decode_stream(data: bytes) -> bytes:
+    if data.endswith(b"~>"):  # /ASCII85Decode
+        try:
+            data = base64.a85decode(data[:-2], adobe=False, ignorechars=b" \t\r\n")
+        except ValueError:
+            return data
+    try:
+        return zlib.decompress(data)
+    except zlib.error:
+        return data
+
+def _fallback_first_page_text(path: Path, limit_bytes: int = 4 * 1024 * 1024) -> str:
+    """
+    Грубое извлечение текстовых операторов Tj/TJ из первых потоков файла.
+    Для CID-шрифтов получится мусор — это даст низкую уверенность и уйдёт в LLM.
+    """
+    with path.open("rb") as f:
+        raw = f.read(limit_bytes)
+    parts: List[str] = []
+    size = 0
+    for m in _STREAM_RE.finditer(raw):
+        data = _decode_stream(m.group(1))
+        for op in _TJ_RE.finditer(data):
+            for s in _STR_RE.findall(op.group(0)):
+                txt = re.sub(rb"\\([()\\])", rb"\1", s).decode("latin-1", errors="ignore")
+                parts.append(txt)
+                size += len(txt)
+            parts.append("\n" if op.group(0).rstrip().endswith(b"Tj") else " ")
+        if size >= MAX_TEXT_CHARS:
+            break
+    return "".join(parts)[:MAX_TEXT_CHARS]
+
+def _pdf_reader():
+    # pypdf грузится при первом файле, а не при старте бота
+    try:
+        from pypdf import PdfReader
+    except ImportError:  # без pypdf — упрощённый разбор текстового слоя
+        return None
+    return PdfReader
+
+def first_page_text(path: Path) -> str:
+    path = Path(path)
+    PdfReader = _pdf_reader()
+    if PdfReader is not None:
+        try:
+            reader = PdfReader(str(path))
+            if reader.pages:
+                return (reader.pages[0].extract_text() or "")[:MAX_TEXT_CHARS]
+            return ""
+        except Exception:
+            pass
+    try:
+        return _fallback_first_page_text(path)
+    except OSError:
+        return ""
+
+# ——— признаки и скоринг ———
+def _filename_tokens(name: str) -> set:
+    return {t for t in re.split(r"[^a-zа-я0-9]+", Path(name).stem.lower()) if t}
+
+def score_text(text: str, filename: str = "") -> Dict[str, float]:
+    low = text.lower()
+    scores = {r: 0.0 for r in ROLES}
+    for role, patterns in KEYWORDS.items():
+        for pattern, weight in patterns:
+            hits = len(re.findall(pattern, low))
+            if hits:
+                # повтор слова — слабый рост, чтобы длинные документы не доминировали
+                scores[role] += weight * (1 + min(hits - 1, 3) * 0.25)
+
+    head = "\n".join([ln for ln in low.splitlines() if ln.strip()][:TITLE_LINES])
+    for role, pattern in TITLE_PATTERNS.items():
+        if re.search(pattern, head):
+            scores[role] += TITLE_WEIGHT
+
+    # CMR: нумерованные графы 1..24 («1 Sender», «16 Carrier» и т.п.)
+    numbered_boxes = len(re.findall(r"(?m)^\s*(?:[1-9]|1\d|2[0-4])\s+[a-zа-я]", low))
+    if numbered_boxes >= 6:
+        scores["cmr"] += 3
+
+    # PL: таблица с весами без цен; invoice: таблица с ценами
+    has_weights = bool(re.search(r"\bkg\b|\bкг\b", low))
+    has_prices = bool(re.search(r"\b(?:eur|usd|rub|cny)\b|[€$₽]", low))
+    if has_weights and not has_prices:
+        scores["pl"] += 2
+    if has_prices:
+        scores["invoice"] += 1
+
+    tokens = _filename_tokens(filename)
+    for role, names in FILENAME_TOKENS.items():
+        if tokens & names:
+            scores[role] += FILENAME_WEIGHT
+    return scores
+
+def confidence_from_scores(scores: Dict[str, float]) -> tuple:
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    (top_role, top), (_, second) = ranked[0], ranked[1]
+    if top <= 0:
+        return None, 0.0
+    margin = (top - second) / top           # насколько лидер отрывается
+    strength = min(1.0, top / 12.0)         # насколько сильны сами признаки
+    return top_role, round(margin * 0.6 + strength * 0.4, 3)
+
+def classify_local(path: Path) -> RoleGuess:
+    path = Path(path)
+    text = first_page_text(path)
+    scores = score_text(text, path.name)
+    role, conf = confidence_from_scores(scores)
+    if role and score_text(text)[role] <= 0:
+        # роль подсказало только имя файла (скан без текстового слоя) — решает LLM
+        conf = min(conf, FILENAME_ONLY_CONFIDENCE)
+    return RoleGuess(path=path, role=role, confidence=conf, scores=scores)
+
+def classify_llm(path: Path, text: Optional[str] = None) -> RoleGuess:
+    """Запасной путь: спрашиваем модель (по тексту первой страницы или по самому PDF)."""
+    from request_2_ppx import _call_perplexity, extract_from_pdf_file
+    from promts import role_extraction as role_prompt
+
+    path = Path(path)
+    text = first_page_text(path) if text is None else text
+    if text.strip():
+        message = [
+            {"type": "text", "text": role_prompt.ROLE_INSTRUCTION_RU},
+            {"type": "text", "text": f"Имя файла: {path.name}\nТекст первой страницы:\n{text[:MAX_TEXT_CHARS]}"},
+        ]
+        res = _call_perplexity(message, role_prompt.ROLE_SCHEMA, temperature=0.0)
+    else:
+        res = extract_from_pdf_file(str(path), role_prompt.ROLE_INSTRUCTION_RU, role_prompt.ROLE_SCHEMA)
+    role = res.get("role")
+    return RoleGuess(path=path, role=role if role in ROLES else None,
+                     confidence=float(res.get("confidence") or 0.0), source="llm")
+
+def classify_document(path: Path, *, threshold: float = CONFIDENCE_THRESHOLD,
+                      llm_fallback: bool = True) -> RoleGuess:
+    guess = classify_local(path)
+    if guess.confidence >= threshold or not llm_fallback:
+        return guess
+    try:
+        llm_guess = classify_llm(path)
+    except Exception:
+        return guess
+    llm_guess.scores = guess.scores
+    return llm_guess if llm_guess.role else guess
+
+def classify_documents(paths: Iterable[Path], *, threshold: float = CONFIDENCE_THRESHOLD,
+                       llm_fallback: bool = True, max_workers: int = 8) -> List[RoleGuess]:
+    paths = [Path(p) for p in paths]
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as ex:
+        return list(ex.map(lambda p: classify_document(p, threshold=threshold, llm_fallback=llm_fallback), paths))
+
+def assign_roles(guesses: List[RoleGuess]) -> Dict[str, Optional[RoleGuess]]:
+    """Каждой роли — самый уверенный документ; один документ не занимает две роли."""
+    found: Dict[str, Optional[RoleGuess]] = {r: None for r in ROLES}
+    for g in sorted(guesses, key=lambda g: g.confidence, reverse=True):
+        if g.role in found and found[g.role] is None:
+            found[g.role] = g
+    return found
+
+def assign_documents(guesses: List[RoleGuess], multi: Iterable[str] = ("invoice", "pl")) -> Dict[str, List[RoleGuess]]:
+    """Как assign_roles, но ролям из multi (инвойс, упаковочный лист) — все их документы, по имени файла."""
+    multi = set(multi)
+    found = {r: ([g] if g else []) for r, g in assign_roles([g for g in guesses if g.role not in multi]).items()}
+    for r in multi & set(found):
+        found[r] = sorted((g for g in guesses if g.role == r), key=lambda g: g.path.name)
+    return found
@@ -0,0 +1,17 @@
+# hashing.py
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+
+def file_sha256(path: Path, chunk: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with Path(path).open("rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def content_hash(value: Any) -> str:
+    """SHA-256 канонического JSON (ключи отсортированы) — одинаковые данные дают одинаковый хэш."""
+    raw = json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
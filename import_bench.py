@@ -0,0 +1,75 @@
+# import_bench.py
+"""
+Время импорта модулей проекта в «холодном» интерпретаторе (без переменных окружения).
+Для каждого модуля — медиана по нескольким запускам за вычетом пустого запуска Python
+и самые дорогие вложенные импорты по -X importtime.
+
+    python import_bench.py                     # request_2_ppx, pipeline, worker, bot
+    python import_bench.py request_2_ppx -n 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+DEFAULT_MODULES = ["request_2_ppx", "pipeline", "worker", "bot"]
+HEAVY = ["requests", "jsonschema", "telegram", "httpx", "pypdf", "numpy"]
+
+def _clean_env() -> Dict[str, str]:
+    # без PPLX_API_KEY/PROXY_* — импорт не должен их требовать
+    return {k: os.environ[k] for k in ("PATH", "HOME", "SYSTEMROOT") if k in os.environ}
+
+def _wall(code: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True, env=_clean_env(),
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - start
+
+def top_imports(module: str, limit: int = 5) -> List[Tuple[int, str]]:
+    """(накопленное время в мкс, модуль) для самых дорогих прямых импортов модуля."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         capture_output=True, text=True, env=_clean_env(),
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    rows, children = [], []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # -X importtime печатает вложенные импорты до родителя, уровень — по отступу
+        if not name.startswith("   "):
+            if name.strip() == module:
+                rows = children
+            children = []
+        elif not name.startswith("     "):
+            children.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+def loaded_heavy(module: str) -> List[str]:
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY!r} if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=_clean_env(),
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    if out.returncode != 0:
+        return [f"ошибка импорта: {out.stderr.strip().splitlines()[-1]}"]
+    return [m for m in out.stdout.strip().split(",") if m]
+
+def main():
+    ap = argparse.ArgumentParser(description="Время импорта модулей проекта")
+    ap.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    ap.add_argument("-n", type=int, default=5, help="запусков на модуль")
+    args = ap.parse_args()
+    base = statistics.median(_wall("pass") for _ in range(args.n))
+    print(f"пустой запуск Python: {base * 1000:.0f} мс (вычитается)")
+    for module in args.modules:
+        t = statistics.median(_wall(f"import {module}") for _ in range(args.n)) - base
+        heavy = loaded_heavy(module)
+        print(f"\n{module}: {t * 1000:.0f} мс; тяжёлые зависимости: {', '.join(heavy) or 'нет'}")
+        for us, name in top_imports(module):
+            print(f"  {us / 1000:7.1f} мс  {name}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# json_stream.py
+"""
+Потоковый разбор JSON-объекта, который приходит кусками (SSE от модели).
+Элементы массива по ключу верхнего уровня (по умолчанию "items") отдаются сразу,
+как только элемент закрылся; завершённые поля верхнего уровня доступны в head —
+например, валюта и Инкотермс, которые в схеме инвойса идут раньше позиций.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+_WS = " \t\r\n"
+
+class JsonItemStream:
+    def __init__(self, array_key: str = "items"):
+        self.array_key = array_key
+        self.text = ""
+        self.head: Dict[str, Any] = {}   # завершённые поля верхнего уровня (кроме array_key)
+        self.count = 0                   # сколько элементов массива уже отдано
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_str = False
+        self._esc = False
+        self._str_start = 0
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._top_start: Optional[int] = None    # начало значения текущего поля верхнего уровня
+        self._item_start: Optional[int] = None   # начало текущего элемента массива
+
+    def _in_items(self) -> bool:
+        return len(self._stack) >= 2 and self._stack[1] == "[" and self._key == self.array_key
+
+    def feed(self, chunk: str) -> List[Tuple[int, Any]]:
+        """Добавляет кусок текста; возвращает [(индекс с 0, элемент)] для закрывшихся элементов."""
+        self.text += chunk
+        out: List[Tuple[int, Any]] = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            depth = len(self._stack)
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                    if depth == 1 and self._expect_key:
+                        self._key = json.loads(text[self._str_start:i + 1])
+                continue
+            if c in _WS:
+                continue
+            # начало значения поля верхнего уровня / элемента массива
+            if depth == 1 and not self._expect_key and self._top_start is None and c not in ",}:":
+                self._top_start = i
+            if depth == 2 and self._in_items() and self._item_start is None and c not in ",]":
+                self._item_start = i
+            if c == '"':
+                self._in_str, self._str_start = True, i
+            elif c in "{[":
+                self._stack.append(c)
+                if len(self._stack) == 1:
+                    self._expect_key = True
+            elif c in "}]":
+                if depth == 2 and self._in_items():
+                    self._flush_item(i, out)          # скалярный последний элемент
+                if depth == 1:
+                    self._flush_top(i)                # скалярное последнее поле
+                self._stack.pop()
+                if len(self._stack) == 2 and self._in_items() and self._item_start is not None:
+                    self._emit(text[self._item_start:i + 1], out)
+                    self._item_start = None
+                if len(self._stack) == 1 and self._top_start is not None:
+                    self._set_head(text[self._top_start:i + 1])
+                    self._top_start = None
+            elif c == ",":
+                if depth == 1:
+                    self._flush_top(i)
+                    self._expect_key = True
+                elif depth == 2 and self._in_items():
+                    self._flush_item(i, out)
+            elif c == ":" and depth == 1:
+                self._expect_key = False
+        self._pos = len(text)
+        return out
+
+    def _flush_item(self, end: int, out: List[Tuple[int, Any]]) -> None:
+        if self._item_start is not None:
+            self._emit(self.text[self._item_start:end], out)
+            self._item_start = None
+
+    def _flush_top(self, end: int) -> None:
+        if self._top_start is not None:
+            self._set_head(self.text[self._top_start:end])
+            self._top_start = None
+
+    def _emit(self, raw: str, out: List[Tuple[int, Any]]) -> None:
+        out.append((self.count, json.loads(raw)))
+        self.count += 1
+
+    def _set_head(self, raw: str) -> None:
+        if self._key != self.array_key:
+            self.head[self._key] = json.loads(raw)
+
+    def result(self) -> Any:
+        """Полный документ — после того, как поток закончился."""
+        return json.loads(self.text)
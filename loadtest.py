@@ -0,0 +1,354 @@
+# loadtest.py
+"""
+Нагрузочный тест бота без Telegram и без API модели: сотни виртуальных чатов шлют /start
+и нажатия кнопок (on_callback), обновления идут через update_processor приложения — с тем же
+ограничением BOT_CONCURRENT_UPDATES, что и в бою. Bot API подменён (FakeBotAPI: задержка ответа
+и, по --rate-limits, лимиты Telegram с ответом 429), хранилище, очередь и папки — временные,
+у каждого чата есть готовый отчёт заданного размера (выгрузка в чат — через очередь отправки outbox.py).
+Конвейер не запускается: «Демо» только ставит задачи в очередь, воркеров нет.
+
+Что измеряется:
+  - задержка обработки обновления по действиям (p50/p95/p99/max);
+  - задержка цикла событий (насколько позже срабатывает sleep(10 мс));
+  - пул asyncio.to_thread: пик занятых потоков, доля времени без свободных, ожидание в очереди;
+  - Bot API: вызовы по методам, отправки в секунду (средняя и пиковая), 429 и ошибки обработчиков.
+
+    python loadtest.py --chats 300 --actions 6 --api-latency 0.05 --rate-limits [--json out.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+import bot
+from result_store import ResultStore
+from shipments import ShipmentRegistry
+from tg_file_cache import FileIdCache
+from outbox import TG_FILE_AFTER_CHUNKS, split_text
+from work_queue import WorkQueue
+
+SEND_METHODS = {"sendMessage", "sendDocument", "sendMediaGroup", "editMessageText"}
+DEFAULT_MIX = "start=1,new=1,history=2,export_chat=3,export_txt=2,upload=1,back_to_menu=1"
+
+def pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+# ——— поддельный Bot API ———
+class FakeBotAPI(BaseRequest):
+    """
+    Отвечает на вызовы Bot API сам, с задержкой latency ± jitter. С limits — как Telegram:
+    в один чат не больше chat_rate сообщений в секунду, всего — global_rate; сверх — 429 с retry_after.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, limits: bool = False,
+                 chat_rate: float = 1.0, chat_burst: int = 3, global_rate: float = 30.0, seed: int = 1):
+        self.latency, self.jitter, self.limits = latency, jitter, limits
+        self.chat_rate, self.chat_burst, self.global_rate = chat_rate, chat_burst, global_rate
+        self.calls: Counter = Counter()
+        self.sends: List[float] = []          # время каждой отправленной (не отклонённой) записи
+        self.rejected = 0
+        self._chat_sends: Dict[Any, deque] = defaultdict(deque)
+        self._global: deque = deque()
+        self._ids = 0
+        self._rng = random.Random(seed)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _admit(self, chat_id: Any, n: int, now: float) -> Optional[int]:
+        # скользящее окно в 1 с: None — можно, иначе retry_after (с)
+        sent = self._chat_sends[chat_id]
+        for q in (sent, self._global):
+            while q and now - q[0] >= 1.0:
+                q.popleft()
+        # альбом больше запаса проходит, только если в чат за секунду ничего не уходило
+        if (sent and len(sent) + n > max(self.chat_burst, self.chat_rate)) or len(self._global) + n > self.global_rate:
+            return 1
+        sent.extend([now] * n)
+        self._global.extend([now] * n)
+        return None
+
+    def _message(self, chat_id: Any, **extra: Any) -> Dict[str, Any]:
+        self._ids += 1
+        return {"message_id": self._ids, "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    def _document(self, name: Optional[str]) -> Dict[str, Any]:
+        self._ids += 1
+        return {"file_id": f"F{self._ids}", "file_unique_id": f"U{self._ids}", "file_name": name or "file"}
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency * (1 + self.jitter * (2 * self._rng.random() - 1)))
+        chat_id = params.get("chat_id", 0)
+        if name in SEND_METHODS:
+            n = len(params.get("media") or []) or 1
+            now = time.monotonic()
+            retry = self._admit(chat_id, n, now) if self.limits else None
+            if retry is not None:
+                self.rejected += 1
+                return 429, json.dumps({"ok": False, "error_code": 429,
+                                        "description": f"Too Many Requests: retry after {retry}",
+                                        "parameters": {"retry_after": retry}}).encode()
+            self.sends.extend([now] * n)
+        if name == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif name == "sendMessage":
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif name == "sendDocument":
+            result = self._message(chat_id, document=self._document(None))
+        elif name == "sendMediaGroup":
+            result = [self._message(chat_id, document=self._document(None)) for _ in params.get("media") or []]
+        else:
+            result = True   # answerCallbackQuery, sendChatAction, …
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# ——— пул потоков с учётом занятости ———
+class MeteredExecutor(ThreadPoolExecutor):
+    """Пул по умолчанию для asyncio.to_thread: сколько задач выполняется/ждёт и сколько ждали."""
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix="to_thread")
+        self.size = max_workers
+        self.inflight = 0
+        self.peak = 0
+        self.waits: List[float] = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        queued = time.perf_counter()
+        with self._lock:
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+
+        def run():
+            self.waits.append(time.perf_counter() - queued)
+            return fn(*args, **kwargs)
+
+        fut = super().submit(run)
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, _) -> None:
+        with self._lock:
+            self.inflight -= 1
+
+# ——— синтетические обновления ———
+class Updates:
+    def __init__(self, app):
+        self.app = app
+        self._n = 0
+
+    def _user(self, chat_id: int) -> Dict[str, Any]:
+        return {"id": chat_id, "is_bot": False, "first_name": f"u{chat_id}"}
+
+    def command(self, chat_id: int, text: str) -> Update:
+        self._n += 1
+        cmd = text.split()[0]
+        return Update.de_json({"update_id": self._n, "message": {
+            "message_id": self._n, "date": int(time.time()), "text": text, "from": self._user(chat_id),
+            "chat": {"id": chat_id, "type": "private"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(cmd)}]}}, self.app.bot)
+
+    def callback(self, chat_id: int, data: str) -> Update:
+        self._n += 1
+        return Update.de_json({"update_id": self._n, "callback_query": {
+            "id": str(self._n), "from": self._user(chat_id), "chat_instance": str(chat_id), "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "text": "меню",
+                        "chat": {"id": chat_id, "type": "private"}}}}, self.app.bot)
+
+def synthetic_report(kb: int) -> str:
+    line = "[33] Позиция {}: код ТН ВЭД ЕАЭС 8471300000 (доверие 0.9) — обоснование по ОПИ 1 и 6, примечания к группе 84\n"
+    out, i = [], 0
+    while sum(map(len, out)) < kb * 1024:
+        i += 1
+        out.append(line.format(i))
+    return "".join(out)
+
+# ——— прогон ———
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.mix = [(k, float(v)) for k, v in (p.split("=") for p in args.mix.split(","))]
+        self.rng = random.Random(args.seed)
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.lag: List[float] = []
+        self.saturated = 0
+        self.samples = 0
+        self.errors: Counter = Counter()
+        self.tmp = Path(tempfile.mkdtemp(prefix="loadtest-"))
+
+    def isolate(self) -> None:
+        """Хранилище, очередь, папки и кэш file_id бота — временные; распознавание ролей — по имени файла."""
+        bot.STORE = ResultStore(self.tmp / "results.sqlite3")
+        bot.QUEUE = WorkQueue(self.tmp / "queue.sqlite3")
+        bot.REGISTRY = ShipmentRegistry(root=self.tmp / "jobs")
+        bot.FILE_IDS = FileIdCache(self.tmp / "file_ids.json")
+        bot.DOCS_DIR = self.tmp / "docs"
+        bot.DOCS_DIR.mkdir()
+        for role in ("agreement", "invoice", "cmr", "pl"):
+            (bot.DOCS_DIR / f"{role}.pdf").write_bytes(b"%PDF-1.4\n% " + role.encode() * 64 + b"\n%%EOF\n")
+        bot.detect_required_docs = lambda pdfs: {p.stem: [p] for p in pdfs}
+        report = synthetic_report(self.args.report_kb)
+        self.report_chunks = len(split_text(report))
+        for i in range(self.args.chats):
+            chat_id = self.chat_id(i)
+            bot.STORE.save_run(f"lt{chat_id}", chat_id, {}, "", [], report, "Инвойс LT · нагрузочный тест")
+
+    def chat_id(self, i: int) -> int:
+        return 100_000 + i
+
+    async def monitor(self, executor: MeteredExecutor, stop: asyncio.Event, interval: float = 0.01) -> None:
+        while not stop.is_set():
+            t = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag.append(max(0.0, time.perf_counter() - t - interval))
+            self.samples += 1
+            self.saturated += executor.inflight >= executor.size
+
+    async def user(self, app, updates: Updates, i: int) -> None:
+        chat_id = self.chat_id(i)
+        rng = random.Random(self.args.seed * 1_000_003 + i)
+        await asyncio.sleep(rng.uniform(0, self.args.ramp))
+        names, weights = zip(*self.mix)
+        for _ in range(self.args.actions):
+            action = rng.choices(names, weights)[0]
+            if action == "start":
+                update = updates.command(chat_id, "/start")
+            elif action in ("export_chat", "export_txt"):
+                update = updates.callback(chat_id, f"{action}:lt{chat_id}")
+            else:
+                update = updates.callback(chat_id, action)
+            t = time.perf_counter()
+            # как при получении из сети: через update_processor (ограничение BOT_CONCURRENT_UPDATES)
+            await app.update_processor.process_update(update, app.process_update(update))
+            self.latency[action].append(time.perf_counter() - t)
+            await asyncio.sleep(rng.expovariate(1 / self.args.think) if self.args.think > 0 else 0)
+
+    async def run(self) -> Dict[str, Any]:
+        self.isolate()
+        api = FakeBotAPI(latency=self.args.api_latency, limits=self.args.rate_limits, seed=self.args.seed)
+        app = bot.build_app(token="1:LOADTEST", request=api)
+
+        async def on_error(update, context):
+            self.errors[type(context.error).__name__] += 1
+
+        app.add_error_handler(on_error)
+        executor = MeteredExecutor(self.args.threads or min(32, (os.cpu_count() or 1) + 4))
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(executor)
+        await app.initialize()
+        await app.start()   # без Updater: обновления подаются напрямую
+        updates = Updates(app)
+        stop = asyncio.Event()
+        mon = asyncio.create_task(self.monitor(executor, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(self.user(app, updates, i) for i in range(self.args.chats)))
+        await bot.OUTBOX.drain()   # выгрузки в чат уходят из очереди отправки уже после обработчика
+        await app.stop()   # дожидается задач, оставленных обработчиками (отправка документов «Демо»)
+        wall = time.perf_counter() - start
+        stop.set()
+        await mon
+        await app.shutdown()
+        return self.result(api, executor, wall)
+
+    def result(self, api: FakeBotAPI, executor: MeteredExecutor, wall: float) -> Dict[str, Any]:
+        per_second = Counter(int(t) for t in api.sends)
+        n = sum(len(v) for v in self.latency.values())
+        return {
+            "config": {k: v for k, v in vars(self.args).items() if k != "json"},
+            "wall_s": round(wall, 2), "updates": n, "updates_per_s": round(n / wall, 1) if wall else 0,
+            "concurrent_updates": bot.CONCURRENT_UPDATES, "report_chunks": self.report_chunks,
+            "report_as_file": self.report_chunks > TG_FILE_AFTER_CHUNKS,
+            "handlers": {a: {"n": len(v), "p50": pct(v, .5), "p95": pct(v, .95), "p99": pct(v, .99), "max": max(v)}
+                         for a, v in sorted(self.latency.items())},
+            "loop_lag": {"p50": pct(self.lag, .5), "p99": pct(self.lag, .99), "max": max(self.lag, default=0.0)},
+            "to_thread": {"workers": executor.size, "peak_inflight": executor.peak,
+                          "saturated_share": round(self.saturated / self.samples, 3) if self.samples else 0.0,
+                          "wait_p50": pct(executor.waits, .5), "wait_p95": pct(executor.waits, .95),
+                          "wait_max": max(executor.waits, default=0.0), "calls": len(executor.waits)},
+            "bot_api": {"calls": dict(api.calls), "sent": len(api.sends),
+                        "sent_per_s": round(len(api.sends) / wall, 1) if wall else 0,
+                        "peak_sent_per_s": max(per_second.values(), default=0), "rejected_429": api.rejected},
+            "outbox": bot.OUTBOX.metrics(),
+            "errors": dict(self.errors),
+        }
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+def render(r: Dict[str, Any]) -> str:
+    ms = lambda s: f"{s * 1000:8.1f}"
+    lines = [f"Чатов {r['config']['chats']}, обновлений {r['updates']} за {r['wall_s']} с "
+             f"({r['updates_per_s']}/с), BOT_CONCURRENT_UPDATES={r['concurrent_updates']}",
+             "", f"{'действие':<14} {'n':>6} {'p50, мс':>8} {'p95, мс':>8} {'p99, мс':>8} {'max, мс':>8}"]
+    for a, h in r["handlers"].items():
+        lines.append(f"{a:<14} {h['n']:>6} {ms(h['p50'])} {ms(h['p95'])} {ms(h['p99'])} {ms(h['max'])}")
+    lag, pool, api = r["loop_lag"], r["to_thread"], r["bot_api"]
+    lines += ["", f"Задержка цикла событий, мс: p50 {ms(lag['p50']).strip()}, p99 {ms(lag['p99']).strip()}, "
+                  f"max {ms(lag['max']).strip()}",
+              f"Пул to_thread: потоков {pool['workers']}, пик задач (с ждущими) {pool['peak_inflight']}, "
+              f"без свободных {pool['saturated_share']:.0%} времени, ожидание p95 {ms(pool['wait_p95']).strip()} мс "
+              f"(max {ms(pool['wait_max']).strip()}), вызовов {pool['calls']}",
+              f"Bot API: отправлено {api['sent']} ({api['sent_per_s']}/с, пик {api['peak_sent_per_s']}/с), "
+              f"429: {api['rejected_429']}; отчёт — {r['report_chunks']} частей"
+              + (" (в чат — zip-файлом)" if r["report_as_file"] else ""),
+              "  " + ", ".join(f"{k} {v}" for k, v in sorted(api["calls"].items()))]
+    ob = r["outbox"]
+    lines.append(f"Очередь отправки: отправлено {ob['sent']}, склеено {ob['merged']}, файлом {ob['as_file']}, "
+                 f"RetryAfter {ob['retry_after']}, ошибок {ob['failed']}, макс. ожидание {ob['max_wait_s']} с")
+    if r["errors"]:
+        lines.append("Ошибки обработчиков: " + ", ".join(f"{k} {v}" for k, v in r["errors"].items()))
+    return "\n".join(lines)
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Нагрузочный тест бота на синтетических обновлениях")
+    ap.add_argument("--chats", type=int, default=200, help="виртуальных чатов")
+    ap.add_argument("--actions", type=int, default=5, help="действий на чат")
+    ap.add_argument("--think", type=float, default=0.2, help="средняя пауза между действиями, с")
+    ap.add_argument("--ramp", type=float, default=1.0, help="чаты подключаются в течение стольких секунд")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="веса действий")
+    ap.add_argument("--api-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    ap.add_argument("--rate-limits", action="store_true", help="лимиты отправки Telegram (429)")
+    ap.add_argument("--report-kb", type=int, default=24, help="размер отчёта для выгрузки, КБ")
+    ap.add_argument("--threads", type=int, default=0, help="потоков asyncio.to_thread (0 — как в Python)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", type=Path, help="сохранить результат в JSON")
+    args = ap.parse_args()
+    test = LoadTest(args)
+    try:
+        result = asyncio.run(test.run())
+    finally:
+        test.cleanup()
+    print(render(result))
+    if args.json:
+        args.json.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+if __name__ == "__main__":
+    main()
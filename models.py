@@ -0,0 +1,411 @@
+# models.py
+"""
+Типизированное представление извлечённых документов: slotted-датаклассы строятся один раз
+из провалидированного JSON и дальше общие для сборки ДТ, обогащения позиций для ТН ВЭД
+и расчёта стоимости/платежей — без копий словарей и цепочек .get(...) or ....
+
+В классах объявлены только поля, которые читает отчёт; остальные ключи документа лежат в _extra
+как есть (ссылкой, без копирования), а _keys помнит, какие ключи были в исходнике и в каком порядке.
+to_json() возвращает JSON, равный исходному: null и отсутствующий ключ различаются.
+
+Какие поля записей на самом деле читает отчёт, profiles выясняет по обращениям к ним (TracingRecord),
+а не по разбору from_json: тот читает все объявленные поля.
+
+Проверка и замер:  python models.py [-n 20000]
+"""
+import argparse
+import time
+import tracemalloc
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union, get_args, get_origin, get_type_hints
+
+_SPECS: Dict[type, Dict[str, Tuple[str, Optional[type]]]] = {}
+_KEYSETS: Dict[Tuple[str, ...], Tuple[str, ...]] = {}   # у тысяч строк один и тот же набор ключей
+
+@dataclass(slots=True, kw_only=True)
+class Record:
+    _keys: Tuple[str, ...] = field(default=(), repr=False, compare=False)
+    _extra: Optional[Dict[str, Any]] = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def spec(cls) -> Dict[str, Tuple[str, Optional[type]]]:
+        """Поле → ("record" | "list" | "raw", класс вложенной записи)."""
+        spec = _SPECS.get(cls)
+        if spec is None:
+            hints = get_type_hints(cls)
+            spec = {f.name: _kind(hints[f.name]) for f in fields(cls) if not f.name.startswith("_")}
+            _SPECS[cls] = spec
+        return spec
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]):
+        spec = cls.spec()
+        keys = tuple(dict.keys(data))
+        keys = _KEYSETS.setdefault(keys, keys)
+        values: Dict[str, Any] = {}
+        extra: Dict[str, Any] = {}
+        for key in keys:
+            kind = spec.get(key)
+            if kind is None:
+                extra[key] = dict.__getitem__(data, key)
+                continue
+            value = data[key]
+            if kind[0] == "record" and isinstance(value, dict):
+                value = kind[1].from_json(value)
+            elif kind[0] == "list" and isinstance(value, list):
+                value = [kind[1].from_json(v) if isinstance(v, dict) else v for v in value]
+            values[key] = value
+        return cls(**values, _keys=keys, _extra=extra or None)
+
+    def to_json(self) -> Dict[str, Any]:
+        spec = self.spec()
+        out: Dict[str, Any] = {}
+        # поля, заданные уже после разбора (или у записи, собранной в коде), — в конец
+        added = tuple(k for k in spec if k not in self._keys and _set(getattr(self, k)))
+        for key in self._keys + added:
+            if key not in spec:
+                out[key] = self._extra[key]
+                continue
+            value = getattr(self, key)
+            if isinstance(value, Record):
+                value = value.to_json()
+            elif isinstance(value, list):
+                value = [v.to_json() if isinstance(v, Record) else v for v in value]
+            out[key] = value
+        return out
+
+    # чтение «как у dict» — для кода, которому всё равно, запись это или JSON
+    def has(self, key: str) -> bool:
+        return key in self._keys or (key in self.spec() and _set(getattr(self, key)))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self.spec():
+            value = getattr(self, key)
+            return default if value is None and not self.has(key) else value
+        return (self._extra or {}).get(key, default)
+
+    def __bool__(self) -> bool:
+        # как у dict: пустой объект ({} в JSON или запись без полей) — ложь
+        return any(True for _ in self.keys())
+
+    def keys(self) -> Iterator[str]:
+        yield from self._keys
+        yield from (k for k in self.spec() if k not in self._keys and _set(getattr(self, k)))
+
+def _set(value: Any) -> bool:
+    # пустой список по умолчанию у списковых полей — то же, что отсутствующий ключ
+    return value is not None and value != []
+
+def _kind(hint: Any) -> Tuple[str, Optional[type]]:
+    if get_origin(hint) is Union:
+        hint = next(a for a in get_args(hint) if a is not type(None))
+    if isinstance(hint, type) and issubclass(hint, Record):
+        return "record", hint
+    if get_origin(hint) is list:
+        (arg,) = get_args(hint)
+        if isinstance(arg, type) and issubclass(arg, Record):
+            return "list", arg
+    return "raw", None
+
+# ——— общие части ———
+@dataclass(slots=True)
+class Party(Record):
+    name: Optional[str] = None
+    address: Optional[str] = None
+    legal_address: Optional[str] = None
+    country: Optional[str] = None
+    vat_or_reg_number: Optional[str] = None
+    inn: Optional[str] = None
+    kpp: Optional[str] = None
+
+    def merged(self, fallback: Optional["Party"]) -> "Party":
+        """Поля self, недостающие — из fallback (как {**fallback, **self} для словарей)."""
+        if fallback is None:
+            return self
+        picked = {k: getattr(self if self.has(k) else fallback, k) for k in self.spec()}
+        return Party(**picked, _keys=tuple(k for k in self.spec() if self.has(k) or fallback.has(k)))
+
+@dataclass(slots=True)
+class Incoterms(Record):
+    rule: Optional[str] = None
+    place: Optional[str] = None
+    version: Optional[str] = None
+
+    def text(self) -> Optional[str]:
+        if not (self.rule and self.place):
+            return None
+        return f"{self.rule} {self.place}" + (f", {self.version}" if self.version else "")
+
+@dataclass(slots=True)
+class CurrencyRef(Record):
+    code: Optional[str] = None
+
+@dataclass(slots=True)
+class DocRef(Record):
+    type: Optional[str] = None
+    number: Optional[str] = None
+    date: Optional[str] = None
+
+# поставка из нескольких инвойсов/упаковочных листов (multidoc): исходные документы и ссылка строки на свой
+@dataclass(slots=True)
+class SourceDoc(Record):
+    file: Optional[str] = None
+    number: Optional[str] = None
+    date: Optional[str] = None
+    currency: Optional[str] = None              # у инвойса
+    total_amount: Optional[float] = None        # у инвойсов в разных валютах
+    charges: Optional[Dict[str, Any]] = None    # (итоги и расходы тогда не сводятся)
+
+@dataclass(slots=True)
+class ItemSource(Record):
+    file: Optional[str] = None
+    number: Optional[str] = None
+    line: Optional[int] = None
+    currency: Optional[str] = None   # валюта инвойса, из которого строка
+
+# ——— инвойс ———
+@dataclass(slots=True)
+class InvoiceItem(Record):
+    description: Optional[str] = None
+    model_or_sku: Optional[str] = None
+    quantity: Optional[float] = None
+    uom: Optional[str] = None
+    unit_price: Optional[float] = None
+    line_total: Optional[float] = None
+    origin_country: Optional[str] = None
+    manufacturer: Optional[str] = None
+    source: Optional[ItemSource] = None
+
+@dataclass(slots=True)
+class Invoice(Record):
+    invoice_number: Optional[str] = None
+    invoice_date: Optional[str] = None
+    seller: Optional[Party] = None
+    buyer: Optional[Party] = None
+    incoterms: Optional[Incoterms] = None
+    currency: Optional[CurrencyRef] = None
+    total_amount: Optional[float] = None
+    items: List[InvoiceItem] = field(default_factory=list)
+    subtotal_ex_vat: Optional[float] = None
+    vat_amount: Optional[float] = None
+    grand_total: Optional[float] = None
+    charges: Optional[Dict[str, Any]] = None
+    contract_reference: Optional[DocRef] = None
+    documents: List[SourceDoc] = field(default_factory=list)
+    merge_notes: List[str] = field(default_factory=list)
+
+# ——— упаковочный лист ———
+@dataclass(slots=True)
+class Packaging(Record):
+    packages_qty: Optional[float] = None
+    package_type: Optional[str] = None
+    marks_range: Optional[str] = None
+
+@dataclass(slots=True)
+class PLItem(Record):
+    line_no: Optional[str] = None
+    description: Optional[str] = None
+    model_or_sku: Optional[str] = None
+    quantity: Optional[float] = None
+    uom: Optional[str] = None
+    net_weight: Optional[float] = None
+    gross_weight: Optional[float] = None
+    net_weight_kg: Optional[float] = None
+    gross_weight_kg: Optional[float] = None
+    packaging: Optional[Packaging] = None
+    origin_country: Optional[str] = None
+    manufacturer: Optional[str] = None
+    dimensions: Optional[Dict[str, Any]] = None
+    source: Optional[ItemSource] = None
+
+    @property
+    def gross(self) -> Optional[float]:
+        return self.gross_weight or self.gross_weight_kg
+
+    @property
+    def net(self) -> Optional[float]:
+        return self.net_weight or self.net_weight_kg
+
+@dataclass(slots=True)
+class Packages(Record):
+    total_packages: Optional[float] = None
+    package_type: Optional[str] = None
+    marks_and_numbers: Optional[str] = None
+
+@dataclass(slots=True)
+class PackingList(Record):
+    pl_number: Optional[str] = None
+    pl_date: Optional[str] = None
+    invoice_ref: Optional[DocRef] = None
+    packages: Optional[Packages] = None
+    gross_weight_total: Optional[float] = None
+    net_weight_total: Optional[float] = None
+    gross_weight_total_kg: Optional[float] = None
+    net_weight_total_kg: Optional[float] = None
+    items: List[PLItem] = field(default_factory=list)
+    documents: List[SourceDoc] = field(default_factory=list)
+    merge_notes: List[str] = field(default_factory=list)
+
+# ——— CMR ———
+@dataclass(slots=True)
+class Place(Record):
+    place: Optional[str] = None
+    country: Optional[str] = None
+
+@dataclass(slots=True)
+class Transport(Record):
+    tractor_plate: Optional[str] = None
+    trailer_plate: Optional[str] = None
+    plate_country_code: Optional[str] = None
+
+@dataclass(slots=True)
+class PackagesSummary(Record):
+    number_of_packages: Optional[float] = None
+
+@dataclass(slots=True)
+class CMRItem(Record):
+    gross_weight_kg: Optional[float] = None
+
+@dataclass(slots=True)
+class CMR(Record):
+    place_and_date_taking_over: Optional[Place] = None
+    place_of_delivery: Optional[Place] = None
+    route_countries: List[str] = field(default_factory=list)
+    transport: Optional[Transport] = None
+    packages_summary: Optional[PackagesSummary] = None
+    gross_weight_total_kg: Optional[float] = None
+    net_weight_total_kg: Optional[float] = None
+    cmr_number: Optional[str] = None
+    cmr_date: Optional[str] = None
+    related_documents: List[DocRef] = field(default_factory=list)
+    items: List[CMRItem] = field(default_factory=list)
+
+# ——— договор ———
+@dataclass(slots=True)
+class Agreement(Record):
+    contract_number: Optional[str] = None
+    contract_date: Optional[str] = None
+    seller: Optional[Party] = None
+    buyer: Optional[Party] = None
+    incoterms: Optional[Incoterms] = None
+    currency: Optional[CurrencyRef] = None
+    appendices: List[DocRef] = field(default_factory=list)
+    cross_links: Optional[Dict[str, Any]] = None
+
+# ——— комплект документов ———
+_EMPTY = (None, "", 0)
+
+class EnrichedItem:
+    """
+    Позиция инвойса, дополненная полями PL (пустое в инвойсе берётся из PL) — представление,
+    а не копия: чтение через get(), как у словаря.
+    """
+    __slots__ = ("item", "pl")
+
+    def __init__(self, item: InvoiceItem, pl: Optional[PLItem]):
+        self.item, self.pl = item, pl
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.item.get(key)
+        if value in _EMPTY and self.pl is not None and self.pl.has(key):
+            return self.pl.get(key)
+        return default if value is None and not self.item.has(key) else value
+
+    @property
+    def enriched(self) -> bool:
+        """PL что-то добавил к позиции (тогда ТН ВЭД по черновику стоит уточнить)."""
+        if self.pl is None:
+            return False
+        return any(self.item.get(k) in _EMPTY and (not self.item.has(k) or self.item.get(k) != self.pl.get(k))
+                   for k in self.pl.keys())
+
+Doc = Union[Dict[str, Any], Record, None]
+
+def _model(cls, doc: Doc):
+    if doc is None:
+        return cls()
+    return doc if isinstance(doc, cls) else cls.from_json(doc)
+
+@dataclass(slots=True)
+class Documents:
+    invoice: Invoice
+    pl: PackingList
+    cmr: CMR
+    agreement: Agreement
+    _matched: Optional[List[Optional[PLItem]]] = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def of(cls, invoice: Doc, pl: Doc = None, cmr: Doc = None, agreement: Doc = None) -> "Documents":
+        """Из JSON (или уже готовых записей — они не пересоздаются)."""
+        if isinstance(invoice, Documents):
+            return invoice
+        return cls(_model(Invoice, invoice), _model(PackingList, pl), _model(CMR, cmr), _model(Agreement, agreement))
+
+    def matched(self) -> List[Optional[PLItem]]:
+        """Строка PL для каждой позиции инвойса (или None); считается один раз."""
+        if self._matched is None:
+            from request_2_ppx import match_pl_items
+            self._matched = match_pl_items(self.invoice.items, self.pl.items)
+        return self._matched
+
+    def enriched(self) -> List[EnrichedItem]:
+        return [EnrichedItem(it, pli) for it, pli in zip(self.invoice.items, self.matched())]
+
+    def party(self, key: str) -> Party:
+        """key: seller | buyer — из инвойса, недостающее — из договора."""
+        own, other = getattr(self.invoice, key), getattr(self.agreement, key)
+        if own is None:
+            return other or Party()
+        return own.merged(other)
+
+    def incoterms(self) -> Optional[str]:
+        return ((self.invoice.incoterms and self.invoice.incoterms.text())
+                or (self.agreement.incoterms and self.agreement.incoterms.text()))
+
+    def currency_code(self) -> Optional[str]:
+        return self.invoice.currency.code if self.invoice.currency else None
+
+    def invoice_currencies(self) -> List[str]:
+        """Валюты сведённых инвойсов (multidoc); у одного инвойса — пусто."""
+        return sorted({d.currency for d in self.invoice.documents if d.currency})
+
+    def to_json(self) -> Dict[str, Dict[str, Any]]:
+        return {"invoice": self.invoice.to_json(), "pl": self.pl.to_json(),
+                "cmr": self.cmr.to_json(), "agreement": self.agreement.to_json()}
+
+# ——— проверка и замер ———
+def _sample_invoice(n: int) -> Dict[str, Any]:
+    return {
+        "invoice_number": "INV-1", "invoice_date": "2025-01-01",
+        "seller": {"name": "Seller GmbH", "address": "Berlin", "country": "DE"},
+        "buyer": {"name": "ООО Покупатель", "inn": "7700000000", "kpp": None},
+        "incoterms": {"rule": "FCA", "place": "Berlin"}, "currency": {"code": "EUR"},
+        "total_amount": 10.0 * n, "notes": "нет в модели — уходит в _extra",
+        "items": [{"description": f"Item {i}", "model_or_sku": f"SKU-{i}", "quantity": 2, "uom": "pcs",
+                   "unit_price": 5.0, "line_total": 10.0, "origin_country": "DE", "manufacturer": None}
+                  for i in range(n)],
+    }
+
+def benchmark(n: int) -> None:
+    data = _sample_invoice(n)
+    start = time.perf_counter()
+    inv = Invoice.from_json(data)
+    built = time.perf_counter() - start
+    assert inv.to_json() == data and list(inv.to_json()) == list(data), "JSON не совпал после разбора"
+    print(f"{n} позиций: разбор {built * 1000:.1f} мс, to_json() совпадает с исходником")
+
+    tracemalloc.start()
+    copies = [dict(it) for it in data["items"]]     # как делало обогащение позиций: копия на строку
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    records = Invoice.from_json(data)
+    rec_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"копии dict: {dict_bytes / n:.0f} байт/позицию; записи: {rec_bytes / n:.0f} байт/позицию")
+    del copies, records
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Разбор документов в записи и обратно")
+    ap.add_argument("-n", type=int, default=20000, help="позиций в синтетическом инвойсе")
+    benchmark(ap.parse_args().n)
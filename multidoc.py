@@ -0,0 +1,124 @@
+# multidoc.py
+"""
+Поставка из нескольких инвойсов и упаковочных листов: каждый документ извлекается отдельно
+(стадии extract:<роль>:<n>, параллельно), затем стадия extract:<роль> сводит их в один документ
+той же схемы — дальше конвейер работает с ним как с единственным.
+
+Сведение: позиции всех документов — одна таблица, у каждой строки ссылка на источник
+(source: файл, номер документа, строка, у инвойса — валюта); итоги и расходы суммируются;
+реквизиты шапки — из первого документа, а список всех исходных документов — в documents (для гр. 44).
+Всё, что свести нельзя (разные продавцы, условия поставки), попадает в merge_notes. Инвойсы в разных
+валютах не суммируются: итоги и расходы остаются у каждого документа в documents, а таможенная
+стоимость не считается (см. valuation.valuate_invoice).
+"""
+import copy
+from typing import Any, Callable, Dict, List, Optional
+
+MULTI_ROLES = ("invoice", "pl")   # остальные роли — один документ, новый файл заменяет прежний
+_STR = {"type": ["string", "null"]}
+
+def _sum(values: List[Any]) -> Optional[float]:
+    # итог по документам — только если он есть в каждом
+    if not values or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return None
+    return sum(values)
+
+def _lines(docs: List[Dict[str, Any]], files: List[str], number_key: str,
+           extra: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    extra = extra or [{} for _ in docs]
+    return [{**it, "source": {"file": f, "number": d.get(number_key), "line": j, **x}}
+            for d, f, x in zip(docs, files, extra) for j, it in enumerate(d.get("items") or [], 1)]
+
+def _put(out: Dict[str, Any], key: str, value: Any) -> None:
+    # неизвестное после сведения — поля нет (схема не допускает null), кроме обязательного total_amount
+    if value is None and key != "total_amount":
+        out.pop(key, None)
+    else:
+        out[key] = value
+
+def _differs(docs: List[Dict[str, Any]], get: Callable[[Dict[str, Any]], Any]) -> bool:
+    values = {str(get(d) or "").strip().casefold() for d in docs}
+    return len(values - {""}) > 1
+
+def merge_invoices(docs: List[Dict[str, Any]], files: List[str]) -> Dict[str, Any]:
+    from request_2_ppx import normalize_currency
+    out = dict(docs[0])
+    codes = [normalize_currency((d.get("currency") or {}).get("code")) for d in docs]
+    out["items"] = _lines(docs, files, "invoice_number", [{"currency": c} for c in codes])
+    out["documents"] = [{"file": f, "number": d.get("invoice_number"), "date": d.get("invoice_date"), "currency": c}
+                        for d, f, c in zip(docs, files, codes)]
+    notes = []
+    currencies = set(codes) - {None}
+    if len(currencies) > 1:
+        # суммировать суммы в разных валютах нельзя — итоги и расходы остаются у своих документов
+        notes.append(f"инвойсы в разных валютах ({', '.join(sorted(currencies))}) — итоги и расходы не сведены, "
+                     "таможенная стоимость не рассчитана")
+        for d, ref in zip(docs, out["documents"]):
+            ref.update({k: d[k] for k in ("total_amount", "charges") if d.get(k) is not None})
+        for key in ("total_amount", "subtotal_ex_vat", "vat_amount", "grand_total"):
+            _put(out, key, None)
+        out.pop("charges", None)
+    else:
+        for key in ("total_amount", "subtotal_ex_vat", "vat_amount", "grand_total"):
+            if any(key in d for d in docs):
+                _put(out, key, _sum([d.get(key) for d in docs]))
+        charges: Dict[str, float] = {}
+        for d in docs:
+            for k, v in (d.get("charges") or {}).items():
+                if isinstance(v, (int, float)):
+                    charges[k] = charges.get(k, 0) + v
+        if charges:
+            out["charges"] = charges
+    for role in ("seller", "buyer"):
+        if _differs(docs, lambda d: (d.get(role) or {}).get("name")):
+            notes.append(f"{'продавец' if role == 'seller' else 'покупатель'} отличается в инвойсах — в шапке взят из первого")
+    if _differs(docs, lambda d: (d.get("incoterms") or {}).get("rule")):
+        notes.append("условия поставки отличаются в инвойсах — в шапке взяты из первого")
+    out["merge_notes"] = notes
+    return out
+
+def merge_packing_lists(docs: List[Dict[str, Any]], files: List[str]) -> Dict[str, Any]:
+    out = dict(docs[0])
+    out["items"] = _lines(docs, files, "pl_number")
+    out["documents"] = [{"file": f, "number": d.get("pl_number"), "date": d.get("pl_date")}
+                        for d, f in zip(docs, files)]
+    for key in ("gross_weight_total", "net_weight_total"):
+        if any(key in d for d in docs):
+            _put(out, key, _sum([d.get(key) for d in docs]))
+    packages = [d.get("packages") or {} for d in docs]
+    if any(packages):
+        marks = [p.get("marks_and_numbers") for p in packages if p.get("marks_and_numbers")]
+        types = {p.get("package_type") for p in packages} - {None, ""}
+        out["packages"] = dict(packages[0])
+        _put(out["packages"], "total_packages", _sum([p.get("total_packages") for p in packages]))
+        _put(out["packages"], "package_type", ", ".join(sorted(types)) or None)
+        _put(out["packages"], "marks_and_numbers", "; ".join(marks) or None)
+    out["merge_notes"] = []
+    return out
+
+MERGERS = {"invoice": merge_invoices, "pl": merge_packing_lists}
+
+def merged_schema(role: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Полная схема роли, дополненная тем, что добавляет сведение: documents, merge_notes, source у строк;
+    total_amount может быть null (инвойсы в разных валютах). Модели эта схема не отправляется.
+    """
+    out = copy.deepcopy(schema)
+    props = out["properties"]
+    item = props["items"]["items"]
+    item["properties"]["source"] = {"type": "object", "additionalProperties": False, "properties": {
+        "file": {"type": "string"}, "number": _STR, "line": {"type": "integer"}, "currency": _STR}}
+    document = {"file": {"type": "string"}, "number": _STR, "date": _STR}
+    if role == "invoice":
+        document.update(currency=_STR, total_amount={"type": "number"}, charges=props["charges"])
+        props["total_amount"] = {**props["total_amount"], "type": ["number", "null"]}
+    props["documents"] = {"type": "array", "items": {"type": "object", "additionalProperties": False,
+                                                     "properties": document}}
+    props["merge_notes"] = {"type": "array", "items": {"type": "string"}}
+    return out
+
+def merge_documents(role: str, docs: List[Dict[str, Any]], files: List[str]) -> Dict[str, Any]:
+    """docs — извлечённые документы одной роли по порядку поступления, files — имена их файлов."""
+    if len(docs) == 1:
+        return docs[0]
+    return MERGERS[role](docs, files)
@@ -0,0 +1,272 @@
+# outbox.py
+"""
+Очередь исходящих сообщений бота с учётом лимитов Telegram. Выгрузка отчёта в чат — десятки
+сообщений подряд; отправленные напрямую, они упираются в лимиты (RetryAfter) и задерживают
+всех остальных. Через очередь:
+  - в один чат — не чаще TG_CHAT_RATE сообщений в секунду (с запасом TG_CHAT_BURST),
+    всего — не чаще TG_GLOBAL_RATE; альбом считается по числу документов;
+  - чаты обслуживаются по кругу: длинный отчёт одного чата не задерживает остальные;
+  - в чат сообщения уходят по порядку, следующее — после ответа на предыдущее;
+  - на RetryAfter сообщение возвращается в начало очереди чата и ждёт указанное время
+    (не больше TG_SEND_RETRIES раз), остальные чаты не ждут;
+  - стоящие подряд в очереди тексты одного чата склеиваются в одно сообщение до TG_CHUNK_LIMIT символов.
+Длинный текст (split_text даёт больше TG_FILE_AFTER_CHUNKS частей) уходит одним zip-файлом.
+"""
+import asyncio
+import functools
+import io
+import os
+import sys
+import time
+import zipfile
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+from telegram.error import RetryAfter
+
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.environ.get("TG_CHAT_BURST", "3"))
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "25"))   # у Telegram — около 30 в секунду
+TG_SEND_RETRIES = int(os.environ.get("TG_SEND_RETRIES", "5"))
+TG_CHUNK_LIMIT = 4000   # лимит Telegram — 4096 символов
+TG_FILE_AFTER_CHUNKS = int(os.environ.get("TG_FILE_AFTER_CHUNKS", "6"))
+
+def split_text(text: str, limit: int = TG_CHUNK_LIMIT) -> List[str]:
+    """Части не длиннее limit по границам строк; слишком длинная строка режется."""
+    chunks, chunk, size = [], [], 0
+    for line in text.splitlines(True):
+        while len(line) > limit:
+            if chunk:
+                chunks.append("".join(chunk))
+                chunk, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if size + len(line) > limit:
+            chunks.append("".join(chunk))
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        chunks.append("".join(chunk))
+    return chunks
+
+def zip_text(text: str, name: str) -> io.BytesIO:
+    """Текст в zip (отчёты сжимаются в 5–10 раз); name — имя файла внутри, архив — name.zip."""
+    bio = io.BytesIO()
+    with zipfile.ZipFile(bio, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        zf.writestr(name, text.encode("utf-8"))
+    bio.seek(0)
+    bio.name = f"{name}.zip"
+    return bio
+
+def merged_text(first: str, second: str) -> str:
+    return first + second if first.endswith("\n") else first + "\n" + second
+
+class Bucket:
+    """Маркерное ведро: rate в секунду, запас burst."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def wait(self, cost: int, now: float) -> float:
+        """Сколько ждать до отправки cost сообщений (0 — можно сейчас). Альбом больше запаса — при полном ведре."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        need = min(cost, self.burst)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self, cost: int) -> None:
+        self.tokens -= cost   # может уйти в минус: следующая отправка подождёт дольше
+
+@dataclass
+class Job:
+    bot: Any
+    chat_id: int
+    method: str                 # метод Bot: send_message, send_document, send_media_group
+    kwargs: Dict[str, Any]
+    cost: int = 1
+    futures: List[asyncio.Future] = field(default_factory=list)
+    retries: int = 0
+    queued: float = field(default_factory=time.monotonic)
+
+    def mergeable(self, other: "Job", limit: int) -> bool:
+        # к простому тексту можно дописать следующий текст; кнопки и прочее берутся у следующего
+        return (self.method == other.method == "send_message" and self.bot is other.bot
+                and set(self.kwargs) == {"text"} and "text" in other.kwargs
+                and len(merged_text(self.kwargs["text"], other.kwargs["text"])) <= limit)
+
+
+class _Chat:
+    def __init__(self, rate: float, burst: int):
+        self.jobs: Deque[Job] = deque()
+        self.bucket = Bucket(rate, burst)
+        self.busy = False            # сообщение отправляется — следующее ждёт ответа
+        self.paused_until = 0.0      # RetryAfter
+
+class Outbox:
+    def __init__(self, chat_rate: float = TG_CHAT_RATE, chat_burst: int = TG_CHAT_BURST,
+                 global_rate: float = TG_GLOBAL_RATE, retries: int = TG_SEND_RETRIES,
+                 chunk_limit: int = TG_CHUNK_LIMIT):
+        self.chat_rate, self.chat_burst, self.retries, self.chunk_limit = chat_rate, chat_burst, retries, chunk_limit
+        self.bucket = Bucket(global_rate, max(1.0, global_rate))
+        self._chats: Dict[int, _Chat] = {}
+        self._order: Deque[int] = deque()   # чаты с сообщениями в очереди, по кругу
+        self._wake: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.counters = {"sent": 0, "merged": 0, "retry_after": 0, "failed": 0, "as_file": 0}
+        self.max_wait = 0.0
+
+    # ——— постановка в очередь ———
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._wake, self._idle = asyncio.Event(), asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, bot, chat_id: int, method: str, **kwargs: Any) -> asyncio.Future:
+        """Ставит отправку в очередь чата; future — результат метода Bot (можно не ждать)."""
+        self._start()
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(functools.partial(self._done, chat_id, method))
+        cost = len(kwargs.get("media") or []) or 1
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self.chat_rate, self.chat_burst)
+        if not chat.jobs:
+            self._order.append(chat_id)
+        chat.jobs.append(Job(bot, chat_id, method, kwargs, cost, [fut]))
+        self._idle.clear()
+        self._wake.set()
+        return fut
+
+    async def send(self, bot, chat_id: int, method: str, **kwargs: Any) -> Any:
+        return await self.submit(bot, chat_id, method, **kwargs)
+
+    async def submit_text(self, bot, chat_id: int, text: str, filename: str,
+                          caption: Optional[str] = None) -> List[asyncio.Future]:
+        """Длинный текст частями, а если частей больше TG_FILE_AFTER_CHUNKS — одним zip-файлом."""
+        chunks = split_text(text, self.chunk_limit)
+        if len(chunks) <= TG_FILE_AFTER_CHUNKS:
+            return [self.submit(bot, chat_id, "send_message", text=c) for c in chunks]
+        self.counters["as_file"] += 1
+        archive = await asyncio.to_thread(zip_text, text, filename)
+        caption = caption or f"Текст длинный ({len(chunks)} сообщений) — отправляю файлом."
+        return [self.submit(bot, chat_id, "send_document", document=archive, caption=caption)]
+
+    def _done(self, chat_id: int, method: str, fut: asyncio.Future) -> None:
+        # ошибку ждущий получит сам; здесь — чтобы не потерялись и те, которых никто не ждёт
+        if not fut.cancelled() and fut.exception() is not None:
+            self.counters["failed"] += 1
+            print(f"[outbox] {method} в чат {chat_id} не доставлено: {fut.exception()!r}", file=sys.stderr)
+
+    async def drain(self) -> None:
+        """Дождаться, пока очередь опустеет (останов, нагрузочный тест)."""
+        if self._idle is not None:
+            await self._idle.wait()
+
+    # ——— отправка ———
+    def _pick(self, now: float):
+        """(чат, задание) к отправке сейчас или (None, сколько ждать)."""
+        wait = 1.0
+        for _ in range(len(self._order)):
+            chat_id = self._order[0]
+            self._order.rotate(-1)
+            chat = self._chats[chat_id]
+            if chat.busy:
+                continue
+            if chat.paused_until > now:
+                wait = min(wait, chat.paused_until - now)
+                continue
+            job = chat.jobs[0]
+            w = max(chat.bucket.wait(job.cost, now), self.bucket.wait(job.cost, now))
+            if w > 0:
+                wait = min(wait, w)
+                continue
+            return chat_id, self._merge(chat)
+        return None, wait
+
+    def _merge(self, chat: _Chat) -> Job:
+        job = chat.jobs.popleft()
+        while chat.jobs and job.mergeable(chat.jobs[0], self.chunk_limit):
+            nxt = chat.jobs.popleft()
+            job = Job(job.bot, job.chat_id, "send_message",
+                      {**nxt.kwargs, "text": merged_text(job.kwargs["text"], nxt.kwargs["text"])},
+                      1, job.futures + nxt.futures, job.retries, job.queued)
+            self.counters["merged"] += 1
+        return job
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            if not self._order:
+                self._prune(time.monotonic())
+                if not any(c.busy for c in self._chats.values()):
+                    self._idle.set()
+                await self._wake.wait()
+                continue
+            now = time.monotonic()
+            chat_id, picked = self._pick(now)
+            if chat_id is None:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=picked)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            chat = self._chats[chat_id]
+            chat.bucket.take(picked.cost)
+            self.bucket.take(picked.cost)
+            chat.busy = True
+            if not chat.jobs:
+                self._order.remove(chat_id)
+            self.max_wait = max(self.max_wait, now - picked.queued)
+            asyncio.get_running_loop().create_task(self._deliver(chat, picked))
+
+    def _prune(self, now: float) -> None:
+        # чат без очереди забывается, когда его лимит восстановился полностью
+        for chat_id, chat in list(self._chats.items()):
+            if not (chat.jobs or chat.busy) and chat.paused_until <= now \
+                    and chat.bucket.wait(chat.bucket.burst, now) == 0:
+                del self._chats[chat_id]
+
+    async def _deliver(self, chat: _Chat, job: Job) -> None:
+        document = job.kwargs.get("document")
+        if hasattr(document, "seek"):
+            document.seek(0)   # повтор после RetryAfter читает файл заново
+        try:
+            result = await getattr(job.bot, job.method)(chat_id=job.chat_id, **job.kwargs)
+        except RetryAfter as e:
+            self.counters["retry_after"] += 1
+            delay = e.retry_after
+            delay = delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+            job.retries += 1
+            if job.retries > self.retries:
+                self._settle(job, exc=e)
+            else:
+                if not chat.jobs:
+                    self._order.append(job.chat_id)
+                chat.jobs.appendleft(job)
+                chat.paused_until = time.monotonic() + delay
+        except Exception as e:
+            self._settle(job, exc=e)
+        else:
+            self.counters["sent"] += job.cost
+            self._settle(job, result=result)
+        finally:
+            chat.busy = False
+            self._wake.set()
+
+    def _settle(self, job: Job, result: Any = None, exc: Optional[BaseException] = None) -> None:
+        for fut in job.futures:
+            if fut.done():
+                continue
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {**self.counters, "queued": sum(len(c.jobs) for c in self._chats.values()),
+                "chats": len(self._order), "max_wait_s": round(self.max_wait, 3)}
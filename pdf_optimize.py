@@ -0,0 +1,266 @@
+# pdf_optimize.py
+"""
+Подготовка PDF перед отправкой в API. Сканы CMR и договоров — это 20–50 МБ картинок, которые
+иначе уходят как есть (+33% на base64) через SOCKS-прокси. Перед загрузкой:
+  - картинки с разрешением выше PDF_TARGET_DPI уменьшаются до него и пережимаются в JPEG
+    с качеством PDF_JPEG_QUALITY (если так выходит меньше); чёрно-белые (1 бит) не трогаются;
+  - одинаковые объекты объединяются, неиспользуемые — выбрасываются, потоки страниц сжимаются;
+  - по PDF_DROP_BLANK — удаляются пустые страницы (нет текста, картинки почти белые).
+Файлы меньше PDF_OPTIMIZE_MIN_KB и те, что не стали меньше, отправляются без изменений.
+
+Обработка идёт в пуле процессов (PDF_OPTIMIZE_WORKERS), результат кэшируется на диске по хэшу
+содержимого и настроек (PDF_CACHE_DIR), одновременные запросы одного файла объединяются.
+Кэш чистит evict_cache(): файлы, не читавшиеся PDF_CACHE_TTL_DAYS, и сверх PDF_CACHE_MAX_MB — самые давние.
+Размеры до/после, время подготовки и время извлечения — в metrics() (попадают в метрики воркера).
+
+Замер на своих файлах:  python pdf_optimize.py docs/*.pdf [--extract]
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from hashing import content_hash, file_sha256
+from singleflight import SingleFlight
+
+PDF_CACHE_DIR = Path(os.environ.get("PDF_CACHE_DIR", "./cache/pdf"))
+PDF_OPTIMIZE_WORKERS = int(os.environ.get("PDF_OPTIMIZE_WORKERS", "2"))
+PDF_CACHE_TTL_DAYS = float(os.environ.get("PDF_CACHE_TTL_DAYS", "14"))
+PDF_CACHE_MAX_MB = float(os.environ.get("PDF_CACHE_MAX_MB", "2048"))
+PART_TTL_SECONDS = 3600   # недописанный .part старше часа — остаток упавшего процесса
+BLANK_MEAN = 250      # средняя яркость (0–255) «белой» картинки
+BLANK_STDDEV = 4.0    # и разброс: на пустом скане — только шум
+
+@dataclass(frozen=True)
+class OptimizeSettings:
+    enabled: bool = True
+    dpi: int = 200
+    quality: int = 75
+    drop_blank: bool = False
+    min_bytes: int = 1024 * 1024
+
+    @classmethod
+    def from_env(cls) -> "OptimizeSettings":
+        flag = lambda name, default: os.environ.get(name, default).lower() in ("1", "true", "yes")
+        return cls(enabled=flag("PDF_OPTIMIZE", "1"),
+                   dpi=int(os.environ.get("PDF_TARGET_DPI", "200")),
+                   quality=int(os.environ.get("PDF_JPEG_QUALITY", "75")),
+                   drop_blank=flag("PDF_DROP_BLANK", ""),
+                   min_bytes=int(os.environ.get("PDF_OPTIMIZE_MIN_KB", "1024")) * 1024)
+
+SETTINGS = OptimizeSettings.from_env()
+
+# ——— обработка одного файла (в дочернем процессе) ———
+def _encoded_size(obj) -> int:
+    # размер потока картинки в файле — как есть, без распаковки
+    return len(getattr(obj, "_data", b"") or b"")
+
+def _is_blank_image(img) -> bool:
+    from PIL import ImageStat
+    thumb = img.convert("L")
+    thumb.thumbnail((128, 128))
+    stat = ImageStat.Stat(thumb)
+    return stat.mean[0] >= BLANK_MEAN and stat.stddev[0] <= BLANK_STDDEV
+
+def _page_dpi(page, img) -> float:
+    # скан — картинка на всю страницу: пиксели на дюйм по большей стороне
+    w_in, h_in = float(page.mediabox.width) / 72, float(page.mediabox.height) / 72
+    return max(img.width / w_in if w_in else 0, img.height / h_in if h_in else 0)
+
+def _optimize_page(page, s: OptimizeSettings) -> Tuple[bool, int]:
+    """(страница пустая, сколько картинок пережато)."""
+    from PIL import Image
+    images = list(page.images)
+    blank = s.drop_blank and not (page.extract_text() or "").strip()
+    if blank and not images:
+        contents = page.get_contents()
+        blank = contents is None or len(contents.get_data()) < 64
+    recoded = 0
+    for image in images:
+        img = image.image
+        if img is None or image.indirect_reference is None:
+            continue
+        if blank and not _is_blank_image(img):
+            blank = False
+        if img.mode in ("1", "P") or "A" in img.getbands():
+            continue   # чёрно-белые сканы уже сжаты лучше JPEG; палитра/прозрачность JPEG не переживут
+        dpi = _page_dpi(page, img)
+        if dpi > s.dpi * 1.1:
+            k = s.dpi / dpi
+            img = img.resize((max(1, round(img.width * k)), max(1, round(img.height * k))), Image.LANCZOS)
+        img = img.convert("L" if img.mode in ("L", "LA", "I", "I;16") else "RGB")
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=s.quality, optimize=True)
+        if buf.tell() < _encoded_size(image.indirect_reference.get_object()):
+            image.replace(img, quality=s.quality)
+            recoded += 1
+    return blank, recoded
+
+def optimize_file(src: str, dest: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Пишет подготовленный PDF в dest (или копию src, если меньше не стало); возвращает статистику."""
+    from pypdf import PdfWriter
+    s = OptimizeSettings(**settings)
+    start = time.perf_counter()
+    data = Path(src).read_bytes()
+    writer = PdfWriter(clone_from=io.BytesIO(data))
+    blank, recoded = [], 0
+    for i, page in enumerate(writer.pages):
+        is_blank, n = _optimize_page(page, s)
+        recoded += n
+        if is_blank:
+            blank.append(i)
+    if len(blank) == len(writer.pages):
+        blank = []   # пустой документ целиком — пусть решает модель
+    for i in reversed(blank):
+        writer.remove_page(i)
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    for page in writer.pages:
+        page.compress_content_streams()
+    buf = io.BytesIO()
+    writer.write(buf)
+    out = buf.getvalue() if buf.tell() < len(data) else data
+    # своё имя у каждого процесса: один файл могут готовить два воркера сразу
+    tmp = Path(dest).with_name(f"{Path(dest).stem}.{uuid.uuid4().hex}.part")
+    try:
+        tmp.write_bytes(out)
+        tmp.replace(dest)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return {"before": len(data), "after": len(out), "pages_dropped": len(blank) if out is not data else 0,
+            "images_recoded": recoded if out is not data else 0,
+            "optimize_s": round(time.perf_counter() - start, 3)}
+
+# ——— пул, кэш, метрики ———
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+_FLIGHT = SingleFlight(max_workers=4, name="pdf-opt")
+_STATS: deque = deque(maxlen=200)
+_STATS_LOCK = threading.Lock()
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: бот и воркер многопоточные, fork такого процесса небезопасен
+            _POOL = ProcessPoolExecutor(max_workers=PDF_OPTIMIZE_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _POOL
+
+def _optimize(path: Path, dest: Path, settings: OptimizeSettings) -> Dict[str, Any]:
+    global _POOL
+    pool = _pool()
+    try:
+        return pool.submit(optimize_file, str(path), str(dest), asdict(settings)).result()
+    except BrokenProcessPool:
+        # дочерний процесс упал (например, нехватка памяти на огромном скане) — такой пул
+        # больше не принимает задач; следующий вызов создаст новый
+        with _POOL_LOCK:
+            if _POOL is pool:
+                _POOL = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+def _record(stat: Dict[str, Any]) -> Dict[str, Any]:
+    with _STATS_LOCK:
+        _STATS.append(stat)
+    return stat
+
+def prepare(path: Path, settings: OptimizeSettings = SETTINGS) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Байты PDF для отправки и запись статистики (в неё же вызывающий дописывает "extract_s").
+    Любая ошибка подготовки — отправляется исходный файл.
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    stat: Dict[str, Any] = {"file": path.name, "before": size, "after": size, "cached": False}
+    if not settings.enabled or size < settings.min_bytes:
+        return path.read_bytes(), _record(stat)
+    key = content_hash(["pdf-opt", file_sha256(path), asdict(settings)])
+    dest = PDF_CACHE_DIR / f"{key}.pdf"
+    if dest.exists():
+        data = dest.read_bytes()
+        try:
+            os.utime(dest)   # время последнего чтения — для evict_cache
+        except OSError:
+            pass
+        return data, _record({**stat, "after": len(data), "cached": True})
+    try:
+        PDF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        info = _FLIGHT.do(key, lambda: _optimize(path, dest, settings))
+        return dest.read_bytes(), _record({**stat, **info})
+    except Exception as e:
+        return path.read_bytes(), _record({**stat, "error": str(e)})
+
+def evict_cache(max_age_days: float = PDF_CACHE_TTL_DAYS, max_mb: float = PDF_CACHE_MAX_MB) -> int:
+    """Удаляет из PDF_CACHE_DIR давно не читавшиеся файлы, затем самые давние сверх max_mb. Возвращает число удалённых."""
+    if not PDF_CACHE_DIR.is_dir():
+        return 0
+    now = time.time()
+    files = []
+    for p in PDF_CACHE_DIR.iterdir():
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+    files.sort()
+    budget = sum(size for _, size, _ in files) - max_mb * 1024 * 1024
+    removed = 0
+    for mtime, size, p in files:
+        stale = (now - mtime > PART_TTL_SECONDS) if p.suffix == ".part" else (now - mtime > max_age_days * 86400)
+        if not (stale or (budget > 0 and p.suffix == ".pdf")):
+            continue
+        p.unlink(missing_ok=True)
+        budget -= size
+        removed += 1
+    return removed
+
+def metrics() -> Dict[str, Any]:
+    with _STATS_LOCK:
+        recent = list(_STATS)
+    before = sum(s["before"] for s in recent)
+    after = sum(s["after"] for s in recent)
+    return {"files": len(recent), "bytes_before": before, "bytes_after": after,
+            "saved_ratio": round(1 - after / before, 3) if before else 0.0,
+            "cached": sum(1 for s in recent if s.get("cached")), "recent": recent[-20:]}
+
+# ——— замер ———
+def benchmark(paths: List[Path], extract: bool = False) -> None:
+    """Размер до/после и время подготовки; с extract — ещё и время извлечения до/после (живой API)."""
+    from doc_roles import classify_document
+    print(f"{'файл':<32} {'до, КБ':>9} {'после, КБ':>10} {'сжатие':>7} {'подг., с':>9}"
+          + (f" {'извл. до, с':>12} {'после, с':>9}" if extract else ""))
+    for path in paths:
+        t = time.perf_counter()
+        data, stat = prepare(path)
+        line = (f"{path.name[:32]:<32} {stat['before'] / 1024:>9.0f} {stat['after'] / 1024:>10.0f} "
+                f"{1 - stat['after'] / stat['before']:>7.0%} {time.perf_counter() - t:>9.2f}")
+        if extract:
+            from pipeline import DOC_SPECS
+            from profiles import wire_schema
+            from request_2_ppx import _extract_from_pdf_bytes
+            role = classify_document(path).role or "invoice"
+            instruction, schema = DOC_SPECS[role][0], wire_schema(role)
+            timings = []
+            for payload in (path.read_bytes(), data):
+                t = time.perf_counter()
+                _extract_from_pdf_bytes(payload, path.name, instruction, schema)
+                timings.append(time.perf_counter() - t)
+            line += f" {timings[0]:>12.1f} {timings[1]:>9.1f}"
+        print(line)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Подготовка PDF перед отправкой в API: размер и время")
+    ap.add_argument("files", nargs="+", type=Path)
+    ap.add_argument("--extract", action="store_true", help="замерить и время извлечения (запросы к API)")
+    args = ap.parse_args()
+    benchmark(args.files, args.extract)
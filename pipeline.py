@@ -0,0 +1,352 @@
+# pipeline.py
+"""
+Шаги обработки поставки: извлечение документа по роли, ДТ-текст, ТН ВЭД, сборка отчёта.
+
+Конвейер — граф стадий (STAGE_DEPS); стадия стартует, как только готовы её входы:
+  extract:<роль> ×4 (с валидацией) ─┬─ hs_draft (по одному инвойсу, спекулятивно)
+                                    └─ reconcile (сверка документов между собой; при ошибках —
+                                       │  повторное извлечение только подозрительных полей)
+                                       ├─ hs  (черновик + сверенные инвойс и PL; уточняет только изменившиеся строки)
+                                       ├─ dt  (шапка и строки ДТ)
+                                       ├─ payments (гр. 47: документы + коды из hs, локальные ставки)
+                                       └─ report
+Основная часть ТН ВЭД (hs_draft) идёт параллельно с извлечением CMR/договора. Один и тот же граф
+исполняется локально (DagRunner) и через очередь задач (каждая стадия — задача, см. shipments/worker).
+
+Несколько инвойсов/упаковочных листов (stage_graph): каждый документ — своя стадия extract:<роль>:<n>,
+а extract:<роль> сводит их в один документ (multidoc) — остальной граф не меняется.
+
+Инкрементальный пересчёт: результат стадии кэшируется по ключу из хэшей содержимого её входов
+(для извлечения — хэш PDF и спецификации роли). Замена одного документа меняет ключи только
+зависящих от него стадий: новый CMR пересчитывает extract:cmr, dt, payments и report, а JSON инвойса/PL/договора
+и результаты ТН ВЭД берутся из кэша.
+"""
+import os
+from datetime import date
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Set
+
+import refdata
+from dag import DagRunner, critical_path, format_critical_path
+from hashing import content_hash, file_sha256
+from models import Documents
+from multidoc import MULTI_ROLES, merge_documents, merged_schema
+from chunked_extract import extract_invoice_chunked, should_chunk
+from profiles import wire_schema, subset_schema
+from rates import RATES
+from reconcile import TOLERANCES, Issue, check, plan, errors, as_dicts, render_reconcile_text
+from tariff import compute_payments, render_payments_text, fingerprint as tariff_fingerprint
+from request_2_ppx import (
+    extract_from_pdf_file, validate_result, build_dt_text, classify_items_eaeu, enrich_items,
+    prefetch_hs_item, invoice, package_list, cmr, agreement
+)
+
+# роль → (инструкция, полная схема); модели уходит профиль схемы (profiles.wire_schema)
+DOC_SPECS = {
+    "invoice":   (invoice.INVOICE_INSTRUCTION_RU, invoice.INVOICE_SCHEMA),
+    "pl":        (package_list.PL_INSTRUCTION_RU, package_list.PACKING_LIST_SCHEMA),
+    "cmr":       (cmr.CMR_INSTRUCTION_RU, cmr.CMR_SCHEMA),
+    "agreement": (agreement.AGREEMENT_INSTRUCTION_RU, agreement.AGREEMENT_SCHEMA),
+}
+REQUIRED_ROLES = tuple(DOC_SPECS)
+ROLE_NAMES = {"invoice": "инвойс", "pl": "упаковочный лист", "cmr": "CMR", "agreement": "договор"}
+
+EXTRACT_STAGES = [f"extract:{r}" for r in REQUIRED_ROLES]
+STAGE_DEPS: Dict[str, List[str]] = {
+    **{s: [] for s in EXTRACT_STAGES},
+    "hs_draft": ["extract:invoice"],
+    "reconcile": list(EXTRACT_STAGES),
+    "hs": ["extract:invoice", "reconcile", "hs_draft"],
+    "dt": ["reconcile"],
+    "payments": ["hs", "reconcile"],
+    "report": ["dt", "hs", "payments", "reconcile"],
+}
+STAGE_ORDER = list(STAGE_DEPS)  # словарь уже в топологическом порядке
+
+# увеличить при изменении логики стадий — старые записи кэша перестанут совпадать
+STAGE_VERSION = 5
+
+# повторно извлекать поля, на которые указала сверка (0 — только показать расхождения в отчёте)
+RECONCILE_REEXTRACT = os.environ.get("RECONCILE_REEXTRACT", "1").lower() in ("1", "true", "yes")
+
+def doc_stage(role: str, n: int) -> str:
+    """Стадия извлечения n-го (с 1) документа роли, когда документов несколько."""
+    return f"extract:{role}:{n}"
+
+def stage_graph(counts: Optional[Dict[str, int]] = None) -> Dict[str, List[str]]:
+    """
+    Граф стадий поставки по числу документов каждой роли: при одном документе — STAGE_DEPS,
+    при нескольких — extract:<роль>:<n> для каждого и сведение extract:<роль> поверх них.
+    """
+    graph: Dict[str, List[str]] = {}
+    for role in REQUIRED_ROLES:
+        n = (counts or {}).get(role, 1)
+        stages = [doc_stage(role, k) for k in range(1, n + 1)] if n > 1 else []
+        graph.update({s: [] for s in stages})
+        graph[f"extract:{role}"] = stages
+    graph.update({name: deps for name, deps in STAGE_DEPS.items() if name not in graph})
+    return graph
+
+def stage_payload(name: str, paths: Dict[str, List[Path]]) -> Optional[Dict[str, Any]]:
+    """Параметры стадии, зависящие от файлов поставки (paths: роль → PDF по порядку поступления)."""
+    parts = name.split(":")
+    if parts[0] == "extract":
+        files = paths[parts[1]]
+        if len(parts) == 3:
+            return {"path": str(files[int(parts[2]) - 1])}
+        if len(files) == 1:
+            return {"path": str(files[0])}
+        return {"files": [Path(f).name for f in files]}
+    if name == "reconcile":
+        # сведённый документ целиком заново не извлекается — повторное извлечение только для одиночных
+        return {"paths": {r: str(files[0]) for r, files in paths.items() if len(files) == 1}}
+    return None
+
+def downstream(stage: str) -> List[str]:
+    """Стадии, транзитивно зависящие от stage, в топологическом порядке."""
+    hit: Set[str] = {stage}
+    for name in STAGE_ORDER:
+        if any(d in hit for d in STAGE_DEPS[name]):
+            hit.add(name)
+    return [n for n in STAGE_ORDER if n in hit and n != stage]
+
+def extract_document(role: str, path: Path) -> Dict[str, Any]:
+    instruction, schema = DOC_SPECS[role]
+    # при потоковом ответе ТН ВЭД позиций инвойса стартует до конца извлечения (см. hs_draft)
+    on_item = prefetch_hs_item if role == "invoice" else None
+    if role == "invoice" and should_chunk(path):
+        # длинный инвойс — шапка и диапазоны позиций отдельными запросами (chunked_extract)
+        data = extract_invoice_chunked(path, instruction, on_item=on_item)
+    else:
+        data = extract_from_pdf_file(str(path), instruction, wire_schema(role), on_item=on_item)
+    validate_result(data, schema)  # проверка — по полной схеме
+    return data
+
+def reextract_fields(role: str, path: Path, base: Dict[str, Any], fields: List[str],
+                     issues: List[Issue]) -> Dict[str, Any]:
+    """
+    Повторное извлечение только полей fields (схема из одних этих полей — ответ короче и быстрее);
+    остальное берётся из base. Результат проверяется по полной схеме.
+    """
+    instruction, schema = DOC_SPECS[role]
+    hints = "\n".join(f"- {i.message}" for i in issues
+                      if i.severity == "error" and any(r == role for r, _ in i.suspects))
+    instruction += (f"\n\nПОВТОРНОЕ ИЗВЛЕЧЕНИЕ. Верни только поля: {', '.join(fields)}. "
+                    f"При первом извлечении документы не сошлись между собой:\n{hints}\n"
+                    "Перепроверь эти значения по документу; не подгоняй их под другие документы.")
+    data = extract_from_pdf_file(str(path), instruction, subset_schema(role, fields))
+    merged = {**base, **{f: data[f] for f in fields if f in data}}
+    validate_result(merged, schema)
+    return merged
+
+def render_hs_text(hs_results: List[Dict[str, Any]]) -> str:
+    lines = []
+    for r in hs_results:
+        if "error" in r:
+            lines.append(f"[33] Позиция {r['line_index']}: ошибка — {r['error']}\n")
+            continue
+        if r.get("same_as"):
+            # тот же товар уже классифицирован — без повтора обоснования
+            lines.append(f"[33] Позиция {r['line_index']}: код ТН ВЭД ЕАЭС {r['eaeu_hs_code']} "
+                         f"(как позиция {r['same_as']})\n")
+            continue
+        lines.append(f"[33] Позиция {r['line_index']}: код ТН ВЭД ЕАЭС {r['eaeu_hs_code']} (доверие {r.get('confidence')})")
+        for s in r.get("explanations") or []:
+            lines.append(f"  - {s}")
+        if r.get("candidate_codes"):
+            lines.append("  Альтернативы:")
+            for c in r["candidate_codes"]:
+                lines.append(f"    • {c['code']}: {c['why_not']}")
+        if r.get("evidence_urls"):
+            lines.append("  Источники:")
+            for url in r["evidence_urls"]:
+                lines.append(f"    - {url}")
+        lines.append("")
+    return "\n".join(lines).rstrip()
+
+def assemble_report(dt_text: str, hs_text: str, payments_text: str = "", reconcile_text: str = "") -> str:
+    payments = f"=====================\nТаможенные платежи (гр. 47):\n{payments_text}\n\n" if payments_text else ""
+    reconcile = f"=====================\nСверка документов:\n{reconcile_text}\n\n" if reconcile_text else ""
+    return (
+        "Поле декларации | Вставляемый тектс:\n"
+        f"{dt_text}\n\n"
+        "=====================\n"
+        "Товар | ТН ВЭД:\n"
+        f"{hs_text}\n\n"
+        f"{payments}"
+        f"{reconcile}"
+        "Важно: это юридическая подсказка и не более; не является юридическим заключением."
+    )
+
+def run_title(extracted: Dict[str, Dict[str, Any]]) -> str:
+    inv = extracted.get("invoice") or {}
+    seller = (inv.get("seller") or {}).get("name") or "—"
+    return f"Инвойс {inv.get('invoice_number') or '—'} · {seller}"
+
+# ——— стадии ———
+def reconcile_documents(docs: Dict[str, Dict[str, Any]], paths: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Сверка документов и (если известны PDF) повторное извлечение подозрительных полей.
+    Исправление роли принимается, только если ошибок сверки не стало больше.
+    Возвращает {"docs", "issues", "reextracted", "fixed", "errors"}.
+    """
+    docs = dict(docs)
+    issues = check(docs)
+    before = errors(issues)
+    reextracted: Dict[str, List[str]] = {}
+    failed: Dict[str, str] = {}
+    for role, fields in plan(issues).items():
+        if not RECONCILE_REEXTRACT or role not in paths:
+            continue
+        try:
+            candidate = {**docs, role: reextract_fields(role, Path(paths[role]), docs[role], fields, issues)}
+        except Exception as e:
+            failed[role] = str(e)
+            continue
+        found = check(candidate)
+        if errors(found) <= errors(issues):
+            docs, issues = candidate, found
+            reextracted[role] = fields
+    return {"docs": docs, "issues": as_dicts(issues), "reextracted": reextracted,
+            "fixed": max(0, before - errors(issues)), "errors": failed}
+
+def hs_draft(invoice_json: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Спекулятивная классификация только по инвойсу — стартует, не дожидаясь PL."""
+    return classify_items_eaeu(invoice_json, None)
+
+def hs_refine(invoice_json: Dict[str, Any], pl_json: Dict[str, Any],
+              draft: List[Dict[str, Any]], draft_invoice: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    Уточнение после прихода PL: переклассифицируются только строки, которые PL дополнил
+    (вес, происхождение, упаковка…), которые изменила сверка (draft_invoice — инвойс,
+    по которому строился черновик) или по которым черновик не получен.
+    """
+    items = invoice_json.get("items") or []
+    drafted = (draft_invoice or invoice_json).get("items") or []
+    merged = enrich_items(invoice_json, pl_json)
+    by_line = {r["line_index"]: r for r in draft}
+    redo = [i for i in range(1, len(items) + 1)
+            if merged[i - 1].enriched or i > len(drafted) or drafted[i - 1] != items[i - 1]
+            or "error" in by_line.get(i, {"error": True})]
+    fresh = {r["line_index"]: r for r in classify_items_eaeu(invoice_json, pl_json, only=redo)}
+    return [fresh.get(i) or by_line[i] for i in range(1, len(items) + 1)]
+
+def run_stage(name: str, inputs: Dict[str, Any], payload: Optional[Dict[str, Any]] = None) -> Any:
+    """Выполняет одну стадию графа. inputs: имя зависимости → её результат."""
+    if name.startswith("extract:"):
+        role = name.split(":")[1]
+        if "path" in payload:
+            return extract_document(role, Path(payload["path"]))
+        ordered = sorted(inputs, key=lambda d: int(d.rsplit(":", 1)[1]))
+        merged = merge_documents(role, [inputs[d] for d in ordered], payload["files"])
+        validate_result(merged, merged_schema(role, DOC_SPECS[role][1]))
+        return merged
+    if name == "hs_draft":
+        return hs_draft(inputs["extract:invoice"])
+    if name == "reconcile":
+        return reconcile_documents({r: inputs[f"extract:{r}"] for r in REQUIRED_ROLES},
+                                   (payload or {}).get("paths") or {})
+    docs = inputs["reconcile"]["docs"] if "reconcile" in inputs else None
+    if name == "hs":
+        return hs_refine(docs["invoice"], docs["pl"], inputs["hs_draft"], inputs["extract:invoice"])
+    if name == "dt":
+        return build_dt_text(Documents.of(docs["invoice"], docs["pl"], docs["cmr"], docs["agreement"]))
+    if name == "payments":
+        return compute_payments(Documents.of(docs["invoice"], docs["pl"], docs["cmr"], docs["agreement"]), inputs["hs"])
+    if name == "report":
+        return {
+            "dt_text": inputs["dt"],
+            "hs_results": inputs["hs"],
+            "payments": inputs["payments"],
+            "reconcile": {k: v for k, v in inputs["reconcile"].items() if k != "docs"},
+            "report": assemble_report(inputs["dt"], render_hs_text(inputs["hs"]),
+                                      render_payments_text(inputs["payments"]),
+                                      render_reconcile_text(inputs["reconcile"])),
+        }
+    raise KeyError(f"неизвестная стадия: {name}")
+
+# ——— кэш стадий ———
+def stage_input_hashes(name: str, inputs: Dict[str, Any], payload: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    """Хэши содержимого, из которого выводится результат стадии."""
+    if name.startswith("extract:") and "path" in (payload or {}):
+        role = name.split(":")[1]
+        return {"file": file_sha256(Path(payload["path"])),
+                "spec": content_hash([DOC_SPECS[role][0], wire_schema(role)])}
+    hashes = {dep: content_hash(value) for dep, value in inputs.items()}
+    if name.startswith("extract:"):
+        hashes["files"] = content_hash(payload["files"])
+    if name == "hs":
+        # из сверки hs читает только инвойс и PL — новый CMR или договор ТН ВЭД не пересчитывает
+        docs = inputs["reconcile"]["docs"]
+        hashes["reconcile"] = content_hash([docs["invoice"], docs["pl"]])
+    if name == "reconcile":
+        hashes["tolerances"] = content_hash(TOLERANCES)
+    if name in ("dt", "payments"):
+        # гр. 45–47 и коды ОКЕИ/стран зависят ещё от курсов на сегодня и справочников
+        hashes["rates"] = RATES.fingerprint(date.today())
+        hashes["refdata"] = refdata.source_hash()
+    if name == "payments":
+        hashes["tariff"] = tariff_fingerprint(date.today())
+    return hashes
+
+def stage_key(name: str, input_hashes: Dict[str, str]) -> str:
+    # извлечение документа кэшируется по содержимому, а не по номеру в поставке:
+    # extract:invoice:2 и extract:invoice с тем же PDF — одна запись
+    if name.count(":") == 2:
+        name = name.rsplit(":", 1)[0]
+    return content_hash([STAGE_VERSION, name, input_hashes])
+
+def _has_errors(value: Any) -> bool:
+    # строки ТН ВЭД с ошибкой и неудачное повторное извлечение не кэшируем — их стоит повторить
+    if isinstance(value, dict):
+        return bool(value.get("errors"))
+    return isinstance(value, list) and any(isinstance(r, dict) and "error" in r for r in value)
+
+def run_stage_cached(name: str, inputs: Dict[str, Any], payload: Optional[Dict[str, Any]], store) -> Any:
+    """run_stage с кэшем в ResultStore: при тех же входах результат берётся из кэша."""
+    if store is None:
+        return run_stage(name, inputs, payload)
+    hashes = stage_input_hashes(name, inputs, payload)
+    key = stage_key(name, hashes)
+    value = store.cached(key)
+    if value is not None:
+        return value
+    value = run_stage(name, inputs, payload)
+    if not _has_errors(value):
+        store.put_cached(key, name, hashes, value)
+    return value
+
+def _runner(payloads: Dict[str, Dict[str, Any]], store=None, graph: Optional[Dict[str, List[str]]] = None) -> DagRunner:
+    graph = graph or STAGE_DEPS
+    funcs = {name: (lambda inputs, n=name: run_stage_cached(n, inputs, payloads.get(n), store)) for name in graph}
+    return DagRunner(graph, funcs)
+
+def _finish(results: Dict[str, Any], timings, graph: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+    path = critical_path(graph or STAGE_DEPS, timings, "report")
+    total = timings["report"][1] - min(start for start, _ in timings.values())
+    return {
+        "extracted": results["reconcile"]["docs"],
+        **results["report"],
+        "critical_path": format_critical_path(path, total),
+    }
+
+def build_report(extracted: Dict[str, Dict[str, Any]], store=None) -> Dict[str, Any]:
+    """
+    extracted: роль → провалидированный JSON (все четыре роли).
+    Возвращает {"extracted", "dt_text", "hs_results", "payments", "reconcile", "report", "critical_path"}.
+    Без путей к PDF сверка только отмечает расхождения, повторного извлечения нет.
+    store: ResultStore для кэша стадий (необязательно).
+    """
+    results, timings = _runner({}, store).run(done={f"extract:{r}": extracted[r] for r in REQUIRED_ROLES})
+    return _finish(results, timings)
+
+def run_pipeline(docs: Dict[str, Any], store=None) -> Dict[str, Any]:
+    """docs: роль → PDF или список PDF (несколько документов — только для MULTI_ROLES)."""
+    paths = {r: [Path(p) for p in ([docs[r]] if isinstance(docs[r], (str, Path)) else docs[r])] for r in REQUIRED_ROLES}
+    extra = [r for r, files in paths.items() if len(files) > 1 and r not in MULTI_ROLES]
+    if extra:
+        raise ValueError(f"несколько документов допускается только для {', '.join(MULTI_ROLES)}: {', '.join(extra)}")
+    graph = stage_graph({r: len(files) for r, files in paths.items()})
+    payloads = {name: stage_payload(name, paths) for name in graph}
+    results, timings = _runner(payloads, store, graph).run()
+    return _finish(results, timings, graph)
@@ -0,0 +1,284 @@
+# profiles.py
+"""
+«Лёгкие» профили схем извлечения: модели отправляется только то, что реально читает отчёт.
+
+Какие поля нужны, определяется автоматически: build_dt_text, расчёт платежей, подготовка ТН ВЭД,
+сверка и заголовок прогона выполняются на синтетических документах, построенных по полным схемам,
+а обращения к полям записываются: к JSON — TracingDict, к записям models — TracingRecord (разбор
+from_json читает все объявленные поля, поэтому записи строятся из нетрассируемого JSON, а следится
+за тем, что читают потребители). Проходы — «все поля заполнены», «только обязательные» и «только
+обязательные в одном документе» — чтобы учесть и запасные ветки (например, продавец из договора,
+если в инвойсе его нет, или веса из CMR, если их нет в PL).
+
+Профиль lean: неиспользуемые свойства убраны (обязательные по схеме остаются), как и объекты,
+у которых не осталось свойств; description/title вырезаны. Локальная проверка по-прежнему идёт
+по полной схеме — обязательные поля в профиле есть.
+
+Сравнение с полными схемами:  python profiles.py [--live]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import date
+from functools import lru_cache
+from types import FunctionType, MethodType
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from promts import invoice_extraction as invoice
+from promts import pl_extraction as package_list
+from promts import CMR_extraction as cmr
+from promts import agreement_extraction as agreement
+
+EXTRACTION_PROFILE = os.environ.get("EXTRACTION_PROFILE", "lean")  # lean | full
+
+FULL_SCHEMAS = {
+    "invoice": invoice.INVOICE_SCHEMA,
+    "pl": package_list.PACKING_LIST_SCHEMA,
+    "cmr": cmr.CMR_SCHEMA,
+    "agreement": agreement.AGREEMENT_SCHEMA,
+}
+STRIP_KEYS = {"description", "title", "examples", "$comment"}
+
+Path_ = Tuple[str, ...]  # путь к полю; "[]" — элемент массива
+
+# ——— трассировка обращений ———
+def _wrap(value: Any, path: Path_, sink: Set[Path_]) -> Any:
+    from models import Record
+    if isinstance(value, Record):
+        return TracingRecord(value, path, sink)
+    if isinstance(value, dict) and not isinstance(value, TracingDict):
+        return TracingDict(value, path, sink)
+    if isinstance(value, list) and not isinstance(value, TracingList):
+        return TracingList(value, path, sink)
+    return value
+
+class TracingDict(dict):
+    """dict, запоминающий пути прочитанных ключей (в т.ч. отсутствующих — через get)."""
+
+    def __init__(self, data: Dict[str, Any], path: Path_, sink: Set[Path_]):
+        super().__init__(data)
+        self._path, self._sink = path, sink
+
+    def _touch(self, key) -> Path_:
+        p = self._path + (str(key),)
+        self._sink.add(p)
+        return p
+
+    def __getitem__(self, key):
+        p = self._touch(key)
+        return _wrap(super().__getitem__(key), p, self._sink)
+
+    def get(self, key, default=None):
+        p = self._touch(key)
+        return _wrap(super().get(key, default), p, self._sink)
+
+    def __iter__(self):
+        # переопределённый __iter__ заставляет dict(x)/{**x} читать значения через __getitem__
+        return iter(list(super().keys()))
+
+    def items(self):
+        return [(k, self[k]) for k in super().keys()]
+
+    def values(self):
+        return [self[k] for k in super().keys()]
+
+class TracingList(list):
+    def __init__(self, data: List[Any], path: Path_, sink: Set[Path_]):
+        super().__init__(data)
+        self._path, self._sink = path, sink
+
+    def __getitem__(self, i):
+        value = super().__getitem__(i)
+        if isinstance(i, slice):
+            return [_wrap(v, self._path + ("[]",), self._sink) for v in value]
+        return _wrap(value, self._path + ("[]",), self._sink)
+
+    def __iter__(self):
+        for v in super().__iter__():
+            yield _wrap(v, self._path + ("[]",), self._sink)
+
+class TracingRecord:
+    """
+    Запись models, запоминающая пути прочитанных полей. Свойства и методы записи выполняются
+    с self = TracingRecord, так что обращения внутри них (gross → gross_weight) тоже видны.
+    """
+    __slots__ = ("_rec", "_path", "_sink")
+
+    def __init__(self, rec, path: Path_, sink: Set[Path_]):
+        object.__setattr__(self, "_rec", rec)
+        object.__setattr__(self, "_path", path)
+        object.__setattr__(self, "_sink", sink)
+
+    @property
+    def __class__(self):
+        return type(self._rec)   # isinstance(x, Invoice) — как у самой записи
+
+    def __getattr__(self, name: str):
+        rec = self._rec
+        if name in rec.spec():
+            p = self._path + (name,)
+            self._sink.add(p)
+            return _wrap(getattr(rec, name), p, self._sink)
+        attr = getattr(type(rec), name, None)
+        if isinstance(attr, property):
+            return attr.fget(self)
+        if isinstance(attr, FunctionType):
+            return MethodType(attr, self)
+        return getattr(rec, name)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        # поле, не объявленное в записи, тоже считается прочитанным
+        self._sink.add(self._path + (key,))
+        return MethodType(type(self._rec).get, self)(key, default)
+
+    def __bool__(self) -> bool:
+        return bool(self._rec)
+
+# ——— синтетические документы ———
+def _types(node: Dict[str, Any]) -> List[str]:
+    t = node.get("type", [])
+    return [t] if isinstance(t, str) else list(t)
+
+def sample(node: Dict[str, Any], required_only: bool = False) -> Any:
+    """Экземпляр по схеме: все свойства (или только обязательные), массивы — по одному элементу."""
+    if "enum" in node:
+        return node["enum"][0]
+    t = [x for x in _types(node) if x != "null"] or ["string"]
+    if "object" in t:
+        req = set(node.get("required", []))
+        return {k: sample(v, required_only) for k, v in (node.get("properties") or {}).items()
+                if not required_only or k in req}
+    if "array" in t:
+        return [sample(node.get("items") or {}, required_only)]
+    if "number" in t or "integer" in t:
+        return 1
+    if "boolean" in t:
+        return True
+    if "pattern" in node or node.get("format") == "date":
+        return "2024-01-01"
+    return "X"
+
+def _run_consumers(raw: Dict[str, Any], sinks: Dict[str, Set[Path_]], fx) -> None:
+    # всё, что читает извлечённые данные при сборке отчёта: JSON — через TracingDict, записи — через TracingRecord
+    from models import CMR, Agreement, Documents, Invoice, PackingList
+    from pipeline import run_title
+    from reconcile import check
+    from request_2_ppx import build_dt_text, hs_context, _build_hs_prompt_for_item
+    from tariff import compute_payments
+    docs = {role: TracingDict(raw[role], (), sinks[role]) for role in FULL_SCHEMAS}
+    classes = {"invoice": Invoice, "pl": PackingList, "cmr": CMR, "agreement": Agreement}
+    records = Documents(*(TracingRecord(classes[r].from_json(raw[r]), (), sinks[r]) for r in classes))
+    build_dt_text(records)
+    compute_payments(records, [{"line_index": 1, "eaeu_hs_code": "0000000000"}], on=date(2025, 1, 2), fx=fx)
+    currency, incoterms_str = hs_context(docs["invoice"])
+    for item in records.enriched():
+        _build_hs_prompt_for_item(item, currency, incoterms_str)
+    run_title({"invoice": docs["invoice"]})
+    check(docs)
+
+@lru_cache(maxsize=None)
+def used_paths() -> Dict[str, frozenset]:
+    from rates import RateTable
+    sinks: Dict[str, Set[Path_]] = {role: set() for role in FULL_SCHEMAS}
+    with tempfile.TemporaryDirectory() as tmp:
+        # курс нужен, чтобы расчёт стоимости и платежей дошёл до конца
+        fx = RateTable(os.path.join(tmp, "rates.json"))
+        fx.update("2025-01-01", {"EUR": ["1", "100"], "USD": ["1", "90"]})
+        # все поля; только обязательные; только обязательные в одном документе (запасные ветки
+        # вроде весов из CMR, когда их нет в PL, срабатывают, только если другой документ заполнен)
+        for sparse in [(), tuple(FULL_SCHEMAS)] + [(role,) for role in FULL_SCHEMAS]:
+            raw = {role: sample(schema, role in sparse) for role, schema in FULL_SCHEMAS.items()}
+            if "currency" in raw["invoice"]:
+                raw["invoice"]["currency"]["code"] = "EUR"
+            _run_consumers(raw, sinks, fx)
+    return {role: frozenset(paths) for role, paths in sinks.items()}
+
+# ——— профиль ———
+def _is_used(path: Path_, used: Iterable[Path_]) -> bool:
+    n = len(path)
+    return any(u[:n] == path for u in used)
+
+def _emptied(pruned: Dict[str, Any], original: Dict[str, Any]) -> bool:
+    # объект (или массив объектов), у которого после отбора не осталось свойств
+    if isinstance(original.get("items"), dict):
+        return _emptied(pruned["items"], original["items"])
+    return bool(original.get("properties")) and not pruned.get("properties")
+
+def prune(node: Dict[str, Any], used: frozenset, path: Path_ = ()) -> Dict[str, Any]:
+    out = {k: v for k, v in node.items() if k not in STRIP_KEYS}
+    if "properties" in node:
+        req = set(node.get("required", []))
+        props = {}
+        for name, sub in node["properties"].items():
+            if name not in req and not _is_used(path + (name,), used):
+                continue
+            child = prune(sub, used, path + (name,))
+            if name not in req and _emptied(child, sub):
+                continue
+            props[name] = child
+        out["properties"] = props
+    if isinstance(node.get("items"), dict):
+        out["items"] = prune(node["items"], used, path + ("[]",))
+    return out
+
+@lru_cache(maxsize=None)
+def _lean(role: str) -> Dict[str, Any]:
+    return prune(FULL_SCHEMAS[role], used_paths()[role])
+
+def wire_schema(role: str, profile: Optional[str] = None) -> Dict[str, Any]:
+    """Схема, отправляемая модели в response_format."""
+    if (profile or EXTRACTION_PROFILE) == "full":
+        return FULL_SCHEMAS[role]
+    return _lean(role)
+
+def subset_schema(role: str, fields: Iterable[str], profile: Optional[str] = None) -> Dict[str, Any]:
+    """Схема только с указанными полями верхнего уровня — для повторного извлечения (см. reconcile)."""
+    base = wire_schema(role, profile)
+    props = base.get("properties") or {}
+    keep = [f for f in fields if f in props]
+    return {**base, "properties": {f: props[f] for f in keep},
+            "required": [f for f in base.get("required", []) if f in keep]}
+
+# ——— сравнение ———
+def count_fields(node: Dict[str, Any]) -> int:
+    n = 0
+    for sub in (node.get("properties") or {}).values():
+        n += 1 + count_fields(sub)
+    if isinstance(node.get("items"), dict):
+        n += count_fields(node["items"])
+    return n
+
+def _size(schema: Dict[str, Any]) -> int:
+    return len(json.dumps(schema, ensure_ascii=False).encode("utf-8"))
+
+def benchmark(live: bool = False, docs_dir: str = "./docs") -> None:
+    print(f"{'роль':<10} {'полей full→lean':>16} {'байт схемы full→lean':>22}")
+    for role in FULL_SCHEMAS:
+        full, lean = wire_schema(role, "full"), wire_schema(role, "lean")
+        print(f"{role:<10} {count_fields(full):>7} → {count_fields(lean):<6} "
+              f"{_size(full):>10} → {_size(lean):<8} (−{100 - 100 * _size(lean) // _size(full)}%)")
+    if not live:
+        return
+    # живой прогон: те же PDF с полной и лёгкой схемой (нужен ключ API)
+    from pathlib import Path
+    from doc_roles import classify_documents, assign_roles
+    from request_2_ppx import _extract_from_pdf_file, validate_result
+    from pipeline import DOC_SPECS
+    roles = assign_roles(classify_documents(sorted(Path(docs_dir).glob("*.pdf"))))
+    for role, guess in roles.items():
+        if guess is None:
+            continue
+        for profile in ("full", "lean"):
+            start = time.monotonic()
+            data = _extract_from_pdf_file(str(guess.path), DOC_SPECS[role][0], wire_schema(role, profile))
+            elapsed = time.monotonic() - start
+            validate_result(data, FULL_SCHEMAS[role])
+            out = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+            print(f"{role:<10} {profile:<5} {elapsed:6.1f} c, ответ {out} байт")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Лёгкие профили схем против полных")
+    ap.add_argument("--live", action="store_true", help="прогнать PDF из ./docs через API с обоими профилями")
+    benchmark(ap.parse_args().live)
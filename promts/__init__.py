@@ -3,11 +3,13 @@ from .pl_extraction import PACKING_LIST_SCHEMA, PL_INSTRUCTION_RU as INSTRUCTION
 from .CMR_extraction import CMR_SCHEMA, CMR_INSTRUCTION_RU as CMR_INSTRUCTION
 from .agreement_extraction import AGREEMENT_SCHEMA, AGREEMENT_INSTRUCTION_RU as AGREEMENT_INSTRUCTION
 from .DT_extraction import HS_SCHEMA, DT_INSTRUCTION_RU as DT_INSTRUCTION
+from .role_extraction import ROLE_SCHEMA, ROLE_INSTRUCTION_RU as ROLE_INSTRUCTION
 
 __all__ = [
     INVOICE_SCHEMA, INSTRUCTION_INVOICE,
     PACKING_LIST_SCHEMA, INSTRUCTION_PL,
     CMR_SCHEMA, CMR_INSTRUCTION, 
     AGREEMENT_SCHEMA, AGREEMENT_INSTRUCTION, 
-    HS_SCHEMA, DT_INSTRUCTION
+    HS_SCHEMA, DT_INSTRUCTION,
+    ROLE_SCHEMA, ROLE_INSTRUCTION
 ]
\ No newline at end of file
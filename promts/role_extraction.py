@@ -0,0 +1,24 @@
+from typing import Dict, Any
+
+ROLE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "properties": {
+        "role": {
+            "type": "string",
+            "enum": ["invoice", "pl", "cmr", "agreement", "other"],
+            "description": "Тип документа: инвойс / упаковочный лист / CMR / договор / другое"
+        },
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1}
+    },
+    "required": ["role", "confidence"]
+}
+
+ROLE_INSTRUCTION_RU = """Определи тип документа внешнеторговой поставки по его первой странице.
+Варианты:
+- invoice — коммерческий инвойс / счёт (цены, суммы к оплате, банковские реквизиты);
+- pl — упаковочный лист (места, веса брутто/нетто, габариты, маркировка);
+- cmr — международная автотранспортная накладная CMR (отправитель/получатель/перевозчик, пронумерованные графы, номера ТС);
+- agreement — договор/контракт поставки (стороны, предмет договора, условия, подписи);
+- other — ничего из перечисленного.
+Верни СТРОГО JSON по схеме: {role, confidence}. Без текста вне JSON."""
@@ -0,0 +1,99 @@
+# rates.py
+"""
+Локальная таблица курсов ЦБ РФ (рублей за единицу валюты) для расчёта таможенной
+и статистической стоимости. Хранится в RATES_PATH (JSON: дата → код → [номинал, курс]);
+расчёт ДТ берёт курс на последнюю дату не позже нужной и в сеть не ходит.
+
+Обновление (ЦБ публикует курсы на следующий рабочий день):
+    python rates.py                  # курсы на сегодня
+    python rates.py 2025-03-01 2025-03-03
+"""
+import argparse
+import json
+import os
+import threading
+from datetime import date
+from fractions import Fraction
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from hashing import content_hash
+
+RATES_PATH = Path(os.environ.get("RATES_PATH", "./data/rates.json"))
+CBR_URL = "https://www.cbr.ru/scripts/XML_daily.asp"
+NATIONAL = "RUB"
+
+class RateTable:
+    def __init__(self, path: Path = RATES_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._data: Dict[str, Dict[str, List[str]]] = {}
+
+    def data(self) -> Dict[str, Dict[str, List[str]]]:
+        # файл перечитывается, если его обновили (python rates.py в соседнем процессе)
+        with self._lock:
+            try:
+                mtime = self.path.stat().st_mtime
+            except FileNotFoundError:
+                self._mtime, self._data = None, {}
+                return self._data
+            if mtime != self._mtime:
+                self._data = json.loads(self.path.read_text(encoding="utf-8"))
+                self._mtime = mtime
+            return self._data
+
+    def snapshot(self, on: date) -> Tuple[Optional[str], Dict[str, List[str]]]:
+        """(дата курсов, курсы) — последняя дата не позже on."""
+        data = self.data()
+        past = [d for d in data if d <= on.isoformat()]
+        if not past:
+            return None, {}
+        day = max(past)
+        return day, data[day]
+
+    def rate(self, code: str, on: date) -> Tuple[Optional[Fraction], Optional[str]]:
+        """(рублей за 1 единицу валюты, дата курса); для рубля — (1, None)."""
+        if code == NATIONAL:
+            return Fraction(1), None
+        day, rates = self.snapshot(on)
+        if code not in rates:
+            return None, day
+        nominal, value = rates[code]
+        return Fraction(value) / int(nominal), day
+
+    def fingerprint(self, on: date) -> str:
+        """Хэш курсов, действующих на дату (для ключа кэша стадии dt)."""
+        return content_hash(self.snapshot(on))
+
+    def update(self, day: str, rates: Dict[str, List[str]]) -> None:
+        with self._lock:
+            data = json.loads(self.path.read_text(encoding="utf-8")) if self.path.exists() else {}
+            data[day] = rates
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False, sort_keys=True, indent=1), encoding="utf-8")
+            os.replace(tmp, self.path)
+
+RATES = RateTable()
+
+def fetch_cbr(on: date) -> Tuple[str, Dict[str, List[str]]]:
+    """Курсы ЦБ на дату: (фактическая дата курсов ISO, {код: [номинал, курс]})."""
+    import requests
+    import xml.etree.ElementTree as ET
+    r = requests.get(CBR_URL, params={"date_req": on.strftime("%d/%m/%Y")}, timeout=30)
+    r.raise_for_status()
+    root = ET.fromstring(r.content)
+    d, m, y = root.attrib["Date"].split(".")
+    rates = {v.findtext("CharCode"): [v.findtext("Nominal"), v.findtext("Value").replace(",", ".")]
+             for v in root.iter("Valute")}
+    return f"{y}-{m}-{d}", rates
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Загрузка курсов ЦБ РФ в локальную таблицу")
+    ap.add_argument("dates", nargs="*", help="даты YYYY-MM-DD (по умолчанию — сегодня)")
+    args = ap.parse_args()
+    for s in args.dates or [date.today().isoformat()]:
+        day, rates = fetch_cbr(date.fromisoformat(s))
+        RATES.update(day, rates)
+        print(f"{day}: {len(rates)} валют → {RATES.path}")
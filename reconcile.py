@@ -0,0 +1,267 @@
+# reconcile.py
+"""
+Локальная сверка четырёх извлечённых документов между собой — без обращения к модели.
+
+Проверяется то, что в комплекте документов обязано сходиться:
+  - строки инвойса: количество × цена = сумма строки; сумма строк (± расходы, НДС) = total_amount;
+  - веса брутто/нетто: сумма по строкам PL, итог PL и итог CMR; нетто не больше брутто;
+  - число мест: PL против CMR;
+  - число позиций и количества по сопоставленным строкам инвойса и PL;
+  - ссылки: номер договора в инвойсе, номер инвойса в PL и CMR.
+
+Каждое расхождение (Issue) называет документ и поле-«подозреваемое»: если из трёх значений два
+сходятся, виновато третье; иначе подозреваются все. plan() собирает из ошибок (не предупреждений)
+список полей верхнего уровня по ролям — только их и имеет смысл извлекать повторно.
+
+Допуски — TOLERANCES; переопределяются JSON в RECONCILE_TOLERANCES, например
+    RECONCILE_TOLERANCES='{"weight_rel": 0.01}'
+"""
+import json
+import os
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+TOLERANCES: Dict[str, float] = {
+    "money_abs": 0.01,       # в валюте инвойса
+    "money_rel": 0.001,
+    "price_step": 0.01,      # шаг округления цены: строка может расходиться на qty × step / 2
+    "weight_abs": 0.5,       # кг
+    "weight_rel": 0.005,
+    "qty_abs": 0.0,
+    "qty_rel": 0.0,
+}
+TOLERANCES.update(json.loads(os.environ.get("RECONCILE_TOLERANCES") or "{}"))
+
+Suspect = Tuple[str, str]    # (роль, поле верхнего уровня)
+
+@dataclass
+class Issue:
+    code: str
+    severity: str                                       # error | warning
+    message: str
+    values: Dict[str, Any] = field(default_factory=dict)  # "роль.поле" → значение
+    suspects: List[Suspect] = field(default_factory=list)
+
+# ——— числа ———
+def _num(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.replace(" ", "").replace(",", "."))
+        except ValueError:
+            return None
+    return None
+
+def close(a: float, b: float, kind: str, tol: Optional[Dict[str, float]] = None, extra: float = 0.0) -> bool:
+    """|a − b| в пределах допуска kind (money | weight | qty): max(abs, rel × max(|a|, |b|)) + extra."""
+    t = tol or TOLERANCES
+    return abs(a - b) <= max(t[f"{kind}_abs"], t[f"{kind}_rel"] * max(abs(a), abs(b))) + extra
+
+def _sum(items: List[Dict[str, Any]], key: str) -> Optional[float]:
+    # сумма по строкам — только если значение есть в каждой строке
+    values = [_num(it.get(key)) for it in items]
+    if not values or any(v is None for v in values):
+        return None
+    return sum(values)
+
+def _vote(code: str, what: str, kind: str, values: Dict[Suspect, Optional[float]],
+          tol: Dict[str, float]) -> Optional[Issue]:
+    """Сверяет несколько оценок одной величины; при расхождении виновато несогласное меньшинство."""
+    known = {s: v for s, v in values.items() if v is not None}
+    if len(known) < 2 or all(close(a, b, kind, tol) for a in known.values() for b in known.values()):
+        return None
+    suspects = list(known)
+    if len(known) >= 3:
+        agree = lambda s: [o for o in known if o != s and close(known[s], known[o], kind, tol)]
+        majority = max(known, key=lambda s: len(agree(s)))
+        if len(agree(majority)) + 1 > len(known) / 2:
+            suspects = [s for s in known if s != majority and s not in agree(majority)]
+    shown = ", ".join(f"{r}.{f} = {v:g}" for (r, f), v in known.items())
+    return Issue(code, "error", f"{what} не сходится: {shown}",
+                 {f"{r}.{f}": v for (r, f), v in known.items()}, suspects)
+
+def _ref(value: Any) -> str:
+    # номера документов сравниваются без «№», пробелов, дефисов и регистра
+    return re.sub(r"[\s№#\-_/.]+", "", str(value or "")).casefold()
+
+def _total_candidates(inv: Dict[str, Any], lines: float) -> Tuple[List[float], float, Optional[float]]:
+    # чему может равняться total_amount: строки ± расходы, с НДС и без, промежуточные итоги
+    ch = inv.get("charges") or {}
+    charges = sum(_num(ch.get(k)) or 0 for k in ("freight", "insurance", "packing")) - (_num(ch.get("discount")) or 0)
+    vat, subtotal, grand = (_num(inv.get(k)) for k in ("vat_amount", "subtotal_ex_vat", "grand_total"))
+    candidates = [lines, lines + charges]
+    candidates += [c + vat for c in candidates] if vat else []
+    candidates += [v for v in (subtotal, grand) if v is not None]
+    if subtotal is not None and vat:
+        candidates.append(subtotal + vat)
+    return candidates, charges, vat
+
+def totals_match(inv: Dict[str, Any], tol: Optional[Dict[str, float]] = None) -> Optional[bool]:
+    """Сходится ли сумма строк инвойса с total_amount (с учётом расходов и НДС); None — нечем проверить."""
+    lines = _sum(inv.get("items") or [], "line_total")
+    total = _num(inv.get("total_amount"))
+    if lines is None or total is None:
+        return None
+    return any(close(total, c, "money", tol) for c in _total_candidates(inv, lines)[0])
+
+# ——— проверки ———
+def _check_invoice(inv: Dict[str, Any], pl_count: Optional[int], tol: Dict[str, float]) -> List[Issue]:
+    issues: List[Issue] = []
+    items = inv.get("items") or []
+    bad_lines = []
+    for i, it in enumerate(items, 1):
+        q, p, t = _num(it.get("quantity")), _num(it.get("unit_price")), _num(it.get("line_total"))
+        if None in (q, p, t):
+            continue
+        if not close(q * p, t, "money", tol, extra=abs(q) * tol["price_step"] / 2):
+            bad_lines.append(i)
+            issues.append(Issue("invoice_line", "error",
+                                f"Инвойс, позиция {i}: {q:g} × {p:g} = {q * p:.2f}, а сумма строки {t:g}",
+                                {f"invoice.items[{i}]": [q, p, t]}, [("invoice", "items")]))
+
+    lines = _sum(items, "line_total")
+    total = _num(inv.get("total_amount"))
+    if lines is None or total is None:
+        return issues
+    candidates, charges, vat = _total_candidates(inv, lines)
+    if any(close(total, c, "money", tol) for c in candidates):
+        return issues
+    # строки сходятся сами с собой и их столько же, сколько в PL, — скорее неверен итог
+    if not bad_lines and (pl_count is None or pl_count == len(items)):
+        suspects = [("invoice", "total_amount"), ("invoice", "charges")]
+    else:
+        suspects = [("invoice", "items"), ("invoice", "total_amount")]
+    issues.append(Issue("invoice_total", "error",
+                        f"Инвойс: сумма строк {lines:.2f} (расходы {charges:g}, НДС {vat or 0:g}) "
+                        f"не сходится с total_amount {total:g}",
+                        {"invoice.items.line_total": lines, "invoice.total_amount": total,
+                         "invoice.charges": charges, "invoice.vat_amount": vat}, suspects))
+    return issues
+
+def _check_weights(pl: Dict[str, Any], cmr: Dict[str, Any], tol: Dict[str, float]) -> List[Issue]:
+    issues: List[Issue] = []
+    items = pl.get("items") or []
+    for kind, name, pl_key, cmr_key in (("gross", "Вес брутто", "gross_weight", "gross_weight_total_kg"),
+                                        ("net", "Вес нетто", "net_weight", "net_weight_total_kg")):
+        issue = _vote(f"{kind}_weight", name, "weight", {
+            ("pl", "items"): _sum(items, pl_key),
+            ("pl", f"{kind}_weight_total"): _num(pl.get(f"{kind}_weight_total")),
+            ("cmr", cmr_key): _num(cmr.get(cmr_key)),
+        }, tol)
+        if issue:
+            issues.append(issue)
+
+    pairs = [(("pl", "net_weight_total"), ("pl", "gross_weight_total"), pl.get("net_weight_total"), pl.get("gross_weight_total")),
+             (("cmr", "net_weight_total_kg"), ("cmr", "gross_weight_total_kg"), cmr.get("net_weight_total_kg"), cmr.get("gross_weight_total_kg"))]
+    for net_s, gross_s, net, gross in pairs:
+        net, gross = _num(net), _num(gross)
+        if net is not None and gross is not None and net > gross and not close(net, gross, "weight", tol):
+            issues.append(Issue("net_over_gross", "error", f"{net_s[0]}: нетто {net:g} больше брутто {gross:g}",
+                                {f"{net_s[0]}.{net_s[1]}": net, f"{gross_s[0]}.{gross_s[1]}": gross}, [net_s, gross_s]))
+    bad = [i for i, it in enumerate(items, 1)
+           if None not in (_num(it.get("net_weight")), _num(it.get("gross_weight")))
+           and _num(it["net_weight"]) > _num(it["gross_weight"]) + tol["weight_abs"]]
+    if bad:
+        issues.append(Issue("net_over_gross", "error", f"PL, позиции {', '.join(map(str, bad))}: нетто больше брутто",
+                            {"pl.items": bad}, [("pl", "items")]))
+    return issues
+
+def _check_items(inv: Dict[str, Any], pl: Dict[str, Any], tol: Dict[str, float]) -> List[Issue]:
+    from request_2_ppx import match_pl_items
+    inv_items, pl_items = inv.get("items") or [], pl.get("items") or []
+    if not inv_items or not pl_items:
+        return []
+    issues: List[Issue] = []
+    if len(inv_items) != len(pl_items):
+        # PL может группировать позиции по местам — это предупреждение, а не повод переизвлекать
+        issues.append(Issue("item_count", "warning",
+                            f"Позиций в инвойсе {len(inv_items)}, в упаковочном листе {len(pl_items)}",
+                            {"invoice.items": len(inv_items), "pl.items": len(pl_items)},
+                            [("invoice", "items"), ("pl", "items")]))
+    for i, (it, pli) in enumerate(zip(inv_items, match_pl_items(inv_items, pl_items)), 1):
+        a, b = _num(it.get("quantity")), _num((pli or {}).get("quantity"))
+        if a is None or b is None or close(a, b, "qty", tol):
+            continue
+        issues.append(Issue("item_quantity", "warning",
+                            f"Позиция {i}: количество в инвойсе {a:g}, в упаковочном листе {b:g}",
+                            {f"invoice.items[{i}].quantity": a, f"pl.items[{i}].quantity": b},
+                            [("invoice", "items"), ("pl", "items")]))
+    return issues
+
+def _check_refs(inv: Dict[str, Any], pl: Dict[str, Any], cmr: Dict[str, Any], contract: Dict[str, Any],
+                tol: Dict[str, float]) -> List[Issue]:
+    issues: List[Issue] = []
+    issue = _vote("packages", "Число мест", "qty", {
+        ("pl", "packages"): _num((pl.get("packages") or {}).get("total_packages")),
+        ("cmr", "packages_summary"): _num((cmr.get("packages_summary") or {}).get("number_of_packages")),
+    }, tol)
+    if issue:
+        issues.append(issue)
+
+    number = inv.get("invoice_number")
+    # сведённый из нескольких инвойсов (multidoc): ссылка на любой из них — верна
+    numbers = {_ref(d.get("number")) for d in inv.get("documents") or [] if d.get("number")} or {_ref(number)}
+    pl_ref = (pl.get("invoice_ref") or {}).get("number")
+    if number and pl_ref and _ref(pl_ref) not in numbers:
+        issues.append(Issue("invoice_ref", "warning", f"PL ссылается на инвойс {pl_ref}, а номер инвойса {number}",
+                            {"pl.invoice_ref": pl_ref, "invoice.invoice_number": number}, [("pl", "invoice_ref")]))
+    cmr_refs = [d.get("number") for d in cmr.get("related_documents") or []
+                if d.get("number") and re.search(r"invoice|инвойс|сч[её]т", str(d.get("type") or ""), re.I)]
+    if number and cmr_refs and all(_ref(r) not in numbers for r in cmr_refs):
+        issues.append(Issue("invoice_ref", "warning",
+                            f"CMR ссылается на инвойс {', '.join(cmr_refs)}, а номер инвойса {number}",
+                            {"cmr.related_documents": cmr_refs, "invoice.invoice_number": number},
+                            [("cmr", "related_documents")]))
+
+    contract_no = contract.get("contract_number")
+    inv_contract = (inv.get("contract_reference") or {}).get("number")
+    if contract_no and inv_contract and _ref(contract_no) not in _ref(inv_contract) \
+            and _ref(inv_contract) not in _ref(contract_no):
+        issues.append(Issue("contract_ref", "warning",
+                            f"Инвойс ссылается на договор {inv_contract}, а номер договора {contract_no}",
+                            {"invoice.contract_reference": inv_contract, "agreement.contract_number": contract_no},
+                            [("invoice", "contract_reference")]))
+    return issues
+
+def check(docs: Dict[str, Dict[str, Any]], tol: Optional[Dict[str, float]] = None) -> List[Issue]:
+    """docs: роль → JSON (invoice, pl, cmr, agreement). Возвращает найденные расхождения."""
+    t = {**TOLERANCES, **(tol or {})}
+    inv, pl, cmr, contract = (docs.get(r) or {} for r in ("invoice", "pl", "cmr", "agreement"))
+    pl_count = len(pl.get("items") or []) or None
+    return (_check_invoice(inv, pl_count, t) + _check_weights(pl, cmr, t)
+            + _check_items(inv, pl, t) + _check_refs(inv, pl, cmr, contract, t))
+
+def plan(issues: List[Issue]) -> Dict[str, List[str]]:
+    """Роль → поля верхнего уровня, которые стоит извлечь повторно (только по ошибкам)."""
+    out: Dict[str, List[str]] = {}
+    for issue in issues:
+        if issue.severity != "error":
+            continue
+        for role, name in issue.suspects:
+            if name not in out.setdefault(role, []):
+                out[role].append(name)
+    return out
+
+def errors(issues: List[Issue]) -> int:
+    return sum(1 for i in issues if i.severity == "error")
+
+def as_dicts(issues: List[Issue]) -> List[Dict[str, Any]]:
+    return [asdict(i) for i in issues]
+
+def render_reconcile_text(result: Dict[str, Any]) -> str:
+    """Текст раздела отчёта по результату стадии reconcile (pipeline.reconcile_documents)."""
+    lines = []
+    for role, fields in (result.get("reextracted") or {}).items():
+        lines.append(f"Повторно извлечено ({role}): {', '.join(fields)}")
+    for role, err in (result.get("errors") or {}).items():
+        lines.append(f"Повторное извлечение ({role}) не удалось: {err}")
+    if result.get("fixed"):
+        lines.append(f"Устранено расхождений: {result['fixed']}")
+    for issue in result.get("issues") or []:
+        mark = "!" if issue["severity"] == "error" else "?"
+        lines.append(f"  {mark} {issue['message']}")
+    return "\n".join(lines) or "Расхождений между документами не найдено."
@@ -0,0 +1,203 @@
+# refdata/__init__.py
+"""
+Справочники для заполнения ДТ без обращения к модели: ОКЕИ (единицы измерения),
+ISO 3166-1 (страны, с русскими/английскими названиями и синонимами) и ISO 4217 (валюты).
+
+Исходные данные — CSV рядом с модулем (правятся руками). При первом обращении из них
+строятся индексы и сохраняются в pickle (REFDATA_CACHE); следующие процессы загружают
+готовые индексы одним pickle.load, пока не изменились CSV или этот модуль (сверка по хэшу).
+
+Поиск: точное совпадение нормализованной строки (код, обозначение, название, синоним) — O(1);
+если не нашлось — нечёткий поиск по триграммам синонимов (опечатки, «Germny», «Китайская Нар. Респ.»).
+"""
+import csv
+import os
+import pickle
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from hashing import content_hash, file_sha256
+
+SOURCE_DIR = Path(__file__).resolve().parent
+SOURCES = {"okei": "okei.csv", "country": "countries.csv", "currency": "currencies.csv"}
+CACHE_PATH = Path(os.environ.get("REFDATA_CACHE", "./data/refdata.pickle"))
+FUZZY_CUTOFF = 0.6      # коэффициент Дайса по триграммам
+FUZZY_MIN_LEN = 4       # короче — только точное совпадение (коды, «шт», «кг»)
+
+class Unit(NamedTuple):
+    code: str           # код ОКЕИ, "796"
+    symbol: str         # условное обозначение, "шт"
+    intl: str           # международное кодовое буквенное обозначение, "PCE"
+    name: str
+
+class Country(NamedTuple):
+    alpha2: str
+    alpha3: str
+    numeric: str
+    name_ru: str
+    name_en: str
+
+class Currency(NamedTuple):
+    code: str
+    numeric: str
+    minor_unit: Optional[int]   # знаков после запятой; None — для драгметаллов и т.п.
+    name_ru: str
+    name_en: str
+
+# ——— нормализация ———
+_SEPARATORS = re.compile(r"[\s·\-_*]+")
+_DROP = re.compile(r"[.,;:()\[\]'`«»]")
+
+def normalize(value: str) -> str:
+    """Ключ поиска: регистр, ё/е, ударения, ²/³, точки и скобки, лишние пробелы."""
+    s = unicodedata.normalize("NFKD", value.casefold())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = unicodedata.normalize("NFC", s)
+    s = _DROP.sub("", s)
+    return _SEPARATORS.sub(" ", s).strip()
+
+def _grams(key: str) -> List[str]:
+    padded = f"  {key} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+# ——— индекс ———
+class _Table:
+    __slots__ = ("rows", "exact", "keys", "key_row", "grams")
+
+    def __init__(self, rows: list, names: List[Tuple[int, str]]):
+        self.rows = rows
+        self.exact: Dict[str, int] = {}
+        for row, name in names:
+            key = normalize(name)
+            if key:
+                self.exact.setdefault(key, row)   # коды и обозначения идут первыми и не перекрываются синонимами
+        self.keys = [k for k in self.exact if len(k) >= FUZZY_MIN_LEN]
+        self.key_row = [self.exact[k] for k in self.keys]
+        grams: Dict[str, List[int]] = {}
+        for i, key in enumerate(self.keys):
+            for g in set(_grams(key)):
+                grams.setdefault(g, []).append(i)
+        self.grams = {g: tuple(ids) for g, ids in grams.items()}
+
+    def get(self, value: str, fuzzy: bool = True):
+        key = normalize(value)
+        row = self.exact.get(key)
+        if row is None and fuzzy and len(key) >= FUZZY_MIN_LEN:
+            row = self._fuzzy(key)
+        return None if row is None else self.rows[row]
+
+    def _fuzzy(self, key: str) -> Optional[int]:
+        query = set(_grams(key))
+        common: Dict[int, int] = {}
+        for g in query:
+            for i in self.grams.get(g, ()):
+                common[i] = common.get(i, 0) + 1
+        best, best_score = None, FUZZY_CUTOFF
+        for i, n in common.items():
+            score = 2 * n / (len(query) + len(set(_grams(self.keys[i]))))
+            if score > best_score:
+                best, best_score = i, score
+        return None if best is None else self.key_row[best]
+
+def _read(name: str) -> List[Dict[str, str]]:
+    with (SOURCE_DIR / name).open(encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+def _aliases(rec: Dict[str, str]) -> List[str]:
+    return [a for a in (rec.get("aliases") or "").split("|") if a]
+
+def _build_okei() -> _Table:
+    rows, names = [], []
+    recs = _read(SOURCES["okei"])
+    for i, rec in enumerate(recs):
+        symbols = [s.strip() for s in rec["symbol"].split(";")]
+        rows.append(Unit(rec["code"], symbols[0], rec["intl"], rec["name"]))
+        names += [(i, rec["code"])] + [(i, s) for s in symbols]
+    # синонимы — после кодов и обозначений, международные коды — последними:
+    # в инвойсах "KGS" — это килограммы, а не KGS (кг/с) из ОКЕИ
+    for i, rec in enumerate(recs):
+        names += [(i, n.strip()) for n in rec["name"].split(";")] + [(i, a) for a in _aliases(rec)]
+    names += [(i, rec["intl"]) for i, rec in enumerate(recs)]
+    return _Table(rows, names)
+
+def _build_country() -> _Table:
+    rows, names = [], []
+    recs = _read(SOURCES["country"])
+    for i, rec in enumerate(recs):
+        rows.append(Country(rec["alpha2"], rec["alpha3"], rec["numeric"], rec["name_ru"], rec["name_en"]))
+        names += [(i, rec["alpha2"]), (i, rec["alpha3"]), (i, rec["numeric"])]
+    for i, rec in enumerate(recs):
+        names += [(i, rec["name_ru"]), (i, rec["name_en"])] + [(i, a) for a in _aliases(rec)]
+    return _Table(rows, names)
+
+def _build_currency() -> _Table:
+    rows, names = [], []
+    recs = _read(SOURCES["currency"])
+    for i, rec in enumerate(recs):
+        minor = int(rec["minor_unit"]) if rec["minor_unit"] else None
+        rows.append(Currency(rec["code"], rec["numeric"], minor, rec["name_ru"], rec["name_en"]))
+        names += [(i, rec["code"]), (i, rec["numeric"])]
+    for i, rec in enumerate(recs):
+        names += [(i, rec["name_ru"]), (i, rec["name_en"])] + [(i, a) for a in _aliases(rec)]
+    return _Table(rows, names)
+
+_BUILDERS = {"okei": _build_okei, "country": _build_country, "currency": _build_currency}
+
+def source_hash() -> str:
+    # вместе с кодом построения индексов: изменился он — старый pickle тоже не годится
+    files = {kind: file_sha256(SOURCE_DIR / name) for kind, name in SOURCES.items()}
+    return content_hash([file_sha256(Path(__file__)), files])
+
+def build() -> Dict[str, _Table]:
+    """Строит индексы из CSV и сохраняет их в CACHE_PATH (если каталог доступен на запись)."""
+    tables = {kind: builder() for kind, builder in _BUILDERS.items()}
+    try:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp = CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump({"hash": source_hash(), "tables": tables}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, CACHE_PATH)
+    except OSError:
+        pass
+    return tables
+
+_tables: Optional[Dict[str, _Table]] = None
+_tables_lock = threading.Lock()
+
+def tables() -> Dict[str, _Table]:
+    global _tables
+    if _tables is None:
+        with _tables_lock:
+            if _tables is None:
+                loaded = None
+                try:
+                    with CACHE_PATH.open("rb") as f:
+                        loaded = pickle.load(f)
+                except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                    pass
+                if loaded and loaded.get("hash") == source_hash():
+                    _tables = loaded["tables"]
+                else:
+                    _tables = build()
+    return _tables
+
+# ——— поиск ———
+@lru_cache(maxsize=4096)
+def lookup(kind: str, value: Optional[str], fuzzy: bool = True):
+    """kind: okei | country | currency. None — не нашлось."""
+    if not value or not str(value).strip():
+        return None
+    return tables()[kind].get(str(value), fuzzy)
+
+def okei(value: Optional[str], fuzzy: bool = True) -> Optional[Unit]:
+    return lookup("okei", value, fuzzy)
+
+def country(value: Optional[str], fuzzy: bool = True) -> Optional[Country]:
+    return lookup("country", value, fuzzy)
+
+def currency(value: Optional[str], fuzzy: bool = True) -> Optional[Currency]:
+    return lookup("currency", value, fuzzy)
@@ -1,41 +1,122 @@
-import requests
-from dotenv import load_dotenv
+# Импорт модуля не требует ни сети, ни переменных окружения: конфигурация и HTTP-клиент
+# создаются при первом обращении к API (client()), requests/jsonschema/промпты грузятся лениво —
+# build_dt_text и прочие локальные функции работают без PPLX_API_KEY и прокси.
 import base64
-import jsonschema
-
+import hashlib
+import importlib
 import os
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, Any, List, Tuple, Optional
 
-from promts import invoice_extraction as invoice
-from promts import pl_extraction as package_list
-from promts import CMR_extraction as cmr
-from promts import agreement_extraction as agreement
-from promts import DT_extraction as dt
-
-load_dotenv()
+import cassette
+import refdata
+import resilience
+from hashing import content_hash, file_sha256
+from singleflight import SingleFlight
+from json_stream import JsonItemStream
 
-PPLX_API_KEY = os.environ["PPLX_API_KEY"]
 API_URL = "https://api.perplexity.ai/chat/completions"
 MODEL = "sonar-pro"  
-
-PROXY_USER = os.environ["PROXY_USER"]
-PROXY_PASSWORD = os.environ["PROXY_PASSWORD"]
-PROXY_HOST = os.environ["PROXY_HOST"]
-PROXY_PORT = os.environ["PROXY_PORT"]
-
-proxies = {
-    "http":  f"socks5h://{PROXY_USER}:{PROXY_PASSWORD}@{PROXY_HOST}:{PROXY_PORT}",
-    "https": f"socks5h://{PROXY_USER}:{PROXY_PASSWORD}@{PROXY_HOST}:{PROXY_PORT}"
+HS_MAX_WORKERS = 4  # параллельных запросов ТН ВЭД на одну поставку
+
+# одинаковые одновременные запросы (тот же PDF, та же позиция) идут в API один раз
+INFLIGHT = SingleFlight(name="ppx-flight")
+HS_PREFETCH_LINGER = 600  # сколько держать упреждающий результат ТН ВЭД для стадии hs_draft
+# ResultStore, общий для процессов-воркеров (задаёт Worker): упреждающий результат ТН ВЭД, полученный
+# при извлечении инвойса, достаётся стадии hs_draft, даже если та выполняется в другом процессе
+HS_STORE = None
+
+# промпты подгружаются при первом обращении: request_2_ppx.invoice, from request_2_ppx import dt, …
+_PROMPT_MODULES = {
+    "invoice": "promts.invoice_extraction",
+    "package_list": "promts.pl_extraction",
+    "cmr": "promts.CMR_extraction",
+    "agreement": "promts.agreement_extraction",
+    "dt": "promts.DT_extraction",
 }
 
-OKEI = {
-    "pcs": ("796", "шт"),
-    "pc":  ("796", "шт"),
-    "kg":  ("166", "кг"),
-    "kilogram": ("166", "кг"),
-}
+def _prompt(name: str):
+    return importlib.import_module(_PROMPT_MODULES[name])
+
+def __getattr__(name: str):
+    if name in _PROMPT_MODULES:
+        return _prompt(name)
+    if name == "PPLX_API_KEY":
+        return client().config.api_key
+    if name == "proxies":
+        return client().config.proxies
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# ——— конфигурация и клиент API ———
+@dataclass(frozen=True)
+class PerplexityConfig:
+    api_key: str
+    proxies: Optional[Dict[str, str]]   # None — без прокси
+    stream: bool                        # STREAM_RESPONSES: позиции инвойса разбираются по мере генерации
+
+    @classmethod
+    def from_env(cls) -> "PerplexityConfig":
+        from dotenv import load_dotenv
+        load_dotenv()
+        api_key = os.environ.get("PPLX_API_KEY")
+        if not api_key:
+            raise RuntimeError("Переменная окружения PPLX_API_KEY не задана.")
+        proxies = None
+        host = os.environ.get("PROXY_HOST")
+        if host:
+            user, password = os.environ.get("PROXY_USER"), os.environ.get("PROXY_PASSWORD")
+            auth = f"{user}:{password}@" if user else ""
+            url = f"socks5h://{auth}{host}:{os.environ.get('PROXY_PORT') or 1080}"
+            proxies = {"http": url, "https": url}
+        stream = os.environ.get("STREAM_RESPONSES", "").lower() in ("1", "true", "yes")
+        return cls(api_key=api_key, proxies=proxies, stream=stream)
+
+class PerplexityClient:
+    """HTTP-сессия на поток (keep-alive к API и прокси) поверх общей конфигурации."""
+
+    def __init__(self, config: PerplexityConfig):
+        self.config = config
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        sess = getattr(self._local, "session", None)
+        if sess is None:
+            import requests
+            sess = requests.Session()
+            sess.headers.update({
+                "Authorization": f"Bearer {self.config.api_key}",
+                "Content-Type": "application/json",
+            })
+            self._local.session = sess
+        return sess
+
+    def post(self, payload: Dict[str, Any], *, stream: bool = False):
+        # proxies — явно в запросе: session.proxies перекрывались бы переменными HTTP(S)_PROXY
+        return self.session.post(API_URL, data=json.dumps(payload), proxies=self.config.proxies,
+                                 timeout=120, stream=stream)
+
+_client: Optional[PerplexityClient] = None
+_client_lock = threading.Lock()
+
+def client() -> PerplexityClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PerplexityClient(PerplexityConfig.from_env())
+    return _client
+
+def configure(config: Optional[PerplexityConfig] = None) -> None:
+    """Задать конфигурацию явно (или сбросить, чтобы перечитать окружение при следующем вызове)."""
+    global _client
+    with _client_lock:
+        _client = PerplexityClient(config) if config is not None else None
 
 def _build_hs_prompt_for_item(item: Dict[str, Any],
                               invoice_currency: Optional[str],
@@ -63,131 +144,171 @@ def _build_hs_prompt_for_item(item: Dict[str, Any],
     details = "\n".join([x for x in details_lines if x])
 
     return [
-        {"type": "text", "text": dt.DT_INSTRUCTION_RU},  # ИНСТРУКЦИЯ из DT_extraction
+        {"type": "text", "text": _prompt("dt").DT_INSTRUCTION_RU},  # ИНСТРУКЦИЯ из DT_extraction
         {"type": "text", "text": "Данные позиции (используй для классификации и веб-поиска):\n" + details}
     ]
 
-def classify_items_eaeu(invoice_json: Dict[str, Any], pl_json: Dict[str, Any]) -> List[Dict[str, Any]]:
-    # Индексируем PL, чтобы дополнить недостающие поля (масса, происхождение, упаковка)
-    pl_index = {}
-    for it in pl_json.get("items", []) or []:
-        key = ((it.get("model_or_sku") or "").strip().lower(),
-               (it.get("description") or "").strip().lower())
-        pl_index[key] = it
-
-    def enrich(inv_item: Dict[str, Any]) -> Dict[str, Any]:
-        k = ((inv_item.get("model_or_sku") or "").strip().lower(),
-             (inv_item.get("description") or "").strip().lower())
-        extra = pl_index.get(k, {})
-        merged = dict(inv_item)
-        # берём поля из PL, которых нет в инвойсе
-        for kk, vv in extra.items():
-            if merged.get(kk) in (None, "", 0):
-                merged[kk] = vv
-        return merged
-
-    currency = ((invoice_json.get("currency") or {}).get("code") or "").upper() or None
-    inc = invoice_json.get("incoterms") or {}
-    incoterms_str = (f"{inc.get('rule','')} {inc.get('place','')}".strip()
-                     + (f", {inc.get('version')}" if inc.get('version') else "")) or None
-
-    results: List[Dict[str, Any]] = []
-    for idx, inv_item in enumerate(invoice_json.get("items") or [], start=1):
-        merged_item = enrich(inv_item)
-        message = _build_hs_prompt_for_item(merged_item, currency, incoterms_str)
-
-        try:
-            hs = _call_perplexity(message, dt.HS_SCHEMA, temperature=0.1, web_search=True)  # СХЕМА из DT_extraction
-            # быстрая проверка
-            code = hs.get("eaeu_hs_code")
-            if not code or len(code) != 10 or not code.isdigit():
-                raise ValueError(f"некорректный код: {code}")
-            if len(hs.get("explanations", [])) != 5:
-                raise ValueError("нужно ровно 5 строк объяснений.")
-            results.append({
-                "line_index": idx,
-                "description": inv_item.get("description"),
-                "model_or_sku": inv_item.get("model_or_sku"),
-                "eaeu_hs_code": code,
-                "confidence": hs.get("confidence"),
-                "explanations": hs.get("explanations"),
-                "candidate_codes": hs.get("candidate_codes", []),
-                "evidence_urls": hs.get("evidence_urls", []),
-                "notes": hs.get("notes", "")
-            })
-        except Exception as e:
-            results.append({
-                "line_index": idx,
-                "description": inv_item.get("description"),
-                "model_or_sku": inv_item.get("model_or_sku"),
-                "error": f"HS-классификация не получена: {e}"
-            })
-    return results
-
-def classify_items_eaeu(invoice_json: Dict[str, Any], pl_json: Dict[str, Any]) -> List[Dict[str, Any]]:
-    # Индексируем PL, чтобы дополнить недостающие поля (масса, происхождение, упаковка)
-    pl_index = {}
-    for it in pl_json.get("items", []) or []:
-        key = ((it.get("model_or_sku") or "").strip().lower(),
-               (it.get("description") or "").strip().lower())
-        pl_index[key] = it
-
-    def enrich(inv_item: Dict[str, Any]) -> Dict[str, Any]:
-        k = ((inv_item.get("model_or_sku") or "").strip().lower(),
-             (inv_item.get("description") or "").strip().lower())
-        extra = pl_index.get(k, {})
-        merged = dict(inv_item)
-        # берём поля из PL, которых нет в инвойсе
-        for kk, vv in extra.items():
-            if merged.get(kk) in (None, "", 0):
-                merged[kk] = vv
-        return merged
-
-    currency = ((invoice_json.get("currency") or {}).get("code") or "").upper() or None
+def hs_context(invoice_json: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    currency = normalize_currency((invoice_json.get("currency") or {}).get("code"))
     inc = invoice_json.get("incoterms") or {}
     incoterms_str = (f"{inc.get('rule','')} {inc.get('place','')}".strip()
                      + (f", {inc.get('version')}" if inc.get('version') else "")) or None
+    return currency, incoterms_str
 
-    results: List[Dict[str, Any]] = []
-    for idx, inv_item in enumerate(invoice_json.get("items") or [], start=1):
-        merged_item = enrich(inv_item)
-        message = _build_hs_prompt_for_item(merged_item, currency, incoterms_str)
+def enrich_items(invoice_json, pl_json=None) -> list:
+    """
+    Позиции инвойса (models.EnrichedItem), дополненные полями PL (масса, происхождение, упаковка).
+    Без PL — как есть. Принимает JSON, models.Invoice или models.Documents (тогда pl_json не нужен).
+    """
+    from models import Documents
+    return Documents.of(invoice_json, pl_json).enriched()
+
+def _check_hs(hs: Dict[str, Any]) -> Dict[str, Any]:
+    code = hs.get("eaeu_hs_code")
+    if not code or len(code) != 10 or not code.isdigit():
+        raise ValueError(f"некорректный код: {code}")
+    if len(hs.get("explanations", [])) != 5:
+        raise ValueError("нужно ровно 5 строк объяснений.")
+    return hs
+
+def _hs_request(message: list):
+    schema = _prompt("dt").HS_SCHEMA
+    key = content_hash(["hs", message, schema])
+
+    def fn():
+        store = HS_STORE
+        if store is not None:
+            hit = store.cached(key)
+            if hit is not None:
+                return hit
+        hs = _check_hs(_call_perplexity(message, schema, temperature=0.1, web_search=True, policy="hs"))
+        if store is not None:
+            store.put_cached(key, "hs_item", {"request": key}, hs)
+        return hs
+    return key, fn
+
+def prefetch_hs_item(idx: int, item: Dict[str, Any], head: Dict[str, Any]) -> None:
+    """
+    Упреждающая ТН ВЭД позиции, пока модель ещё пишет остальные (без PL — как hs_draft).
+    Валюта и Инкотермс в схеме идут раньше позиций, поэтому уже есть в head.
+    Результат — в HS_STORE (если задан) и на HS_PREFETCH_LINGER секунд в INFLIGHT этого процесса.
+    """
+    currency, incoterms_str = hs_context(head)
+    key, fn = _hs_request(_build_hs_prompt_for_item(item, currency, incoterms_str))
+    INFLIGHT.start(key, fn, linger=HS_PREFETCH_LINGER)
 
+def classify_item_eaeu(idx: int, inv_item: Dict[str, Any], merged_item: Dict[str, Any],
+                       currency: Optional[str], incoterms_str: Optional[str]) -> Dict[str, Any]:
+    message = _build_hs_prompt_for_item(merged_item, currency, incoterms_str)
+    try:
+        key, fn = _hs_request(message)
+        hs = INFLIGHT.do(key, fn, linger=HS_PREFETCH_LINGER)  # СХЕМА из DT_extraction, проверена _check_hs
+        code = hs.get("eaeu_hs_code")
+        return {
+            "line_index": idx,
+            "description": inv_item.get("description"),
+            "model_or_sku": inv_item.get("model_or_sku"),
+            "eaeu_hs_code": code,
+            "confidence": hs.get("confidence"),
+            "explanations": hs.get("explanations"),
+            "candidate_codes": hs.get("candidate_codes", []),
+            "evidence_urls": hs.get("evidence_urls", []),
+            "notes": hs.get("notes", "")
+        }
+    except Exception as e:
+        return {
+            "line_index": idx,
+            "description": inv_item.get("description"),
+            "model_or_sku": inv_item.get("model_or_sku"),
+            "error": f"HS-классификация не получена: {e}"
+        }
+
+def goods_key(item) -> Tuple[str, ...]:
+    """Один и тот же товар в разных строках/инвойсах: артикул, описание, происхождение, производитель."""
+    norm = lambda v: " ".join(str(v or "").casefold().split())
+    return (norm(item.get("model_or_sku")), norm(item.get("description")),
+            normalize_country(item.get("origin_country")) or "", norm(item.get("manufacturer")))
+
+def classify_items_eaeu(invoice_json: Dict[str, Any], pl_json: Optional[Dict[str, Any]],
+                        *, max_workers: int = HS_MAX_WORKERS,
+                        only: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """
+    Классификация позиций инвойса (строки — параллельно). pl_json=None — только по инвойсу.
+    only: номера строк (с 1), которые нужно классифицировать; остальные пропускаются.
+    Повторы одного товара (goods_key) классифицируются один раз: у копий — "same_as" (номер строки).
+    """
+    from models import Documents
+    docs = Documents.of(invoice_json, pl_json)
+    currency, incoterms_str = hs_context(docs.invoice)
+    inv_items = docs.invoice.items
+    merged_items = docs.enriched()
+    todo = [i for i in range(1, len(inv_items) + 1) if only is None or i in only]
+    if not todo:
+        return []
+    first: Dict[Tuple[str, ...], int] = {}
+    for i in todo:
+        first.setdefault(goods_key(merged_items[i - 1]), i)
+    unique = list(first.values())
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique)))) as ex:
+        done = dict(zip(unique, ex.map(
+            lambda i: classify_item_eaeu(i, inv_items[i - 1], merged_items[i - 1], currency, incoterms_str),
+            unique
+        )))
+    out = []
+    for i in todo:
+        j = first[goods_key(merged_items[i - 1])]
+        out.append(done[i] if i == j else {**done[j], "line_index": i, "same_as": j,
+                                           "description": inv_items[i - 1].get("description"),
+                                           "model_or_sku": inv_items[i - 1].get("model_or_sku")})
+    return out
+
+def _call_perplexity(message_content: list, schema, *, temperature: float = 0.2, web_search: bool = False,
+                     policy: str = "extract", on_item=None) -> Dict[str, Any]:
+    """
+    Запрос к API через политику resilience (хеджирование, автомат отключения, запасная модель).
+    Ответ проверяется по схеме: при хеджировании побеждает первый корректный.
+    on_item(idx, item, head): в режиме STREAM_RESPONSES вызывается для каждой готовой позиции
+    "items" ещё до конца ответа; такой запрос не хеджируется (дубль повторил бы вызовы).
+    С CASSETTE_MODE обмен записывается в кассету или воспроизводится из неё (см. cassette).
+    """
+    tape = cassette.current()
+    request = dict(temperature=temperature, web_search=web_search, policy=policy)
+    if tape is not None and tape.mode == "replay":
+        return tape.replay(message_content, schema, on_item=on_item, **request)
+    streaming = on_item is not None and client().config.stream
+    if streaming:
+        fn = lambda model, meta: _stream_perplexity(message_content, schema, model, temperature, web_search,
+                                                    on_item, meta)
+    else:
+        fn = lambda model, meta: _post_perplexity(message_content, schema, model, temperature, web_search, meta)
+    attempts: List[Dict[str, Any]] = []
+
+    def attempt(model: str) -> Dict[str, Any]:
+        if tape is None:
+            return fn(model, None)
+        meta: Dict[str, Any] = {"model": model}
+        attempts.append(meta)
+        start = time.perf_counter()
         try:
-            hs = _call_perplexity(message, dt.HS_SCHEMA, temperature=0.1, web_search=True)  # СХЕМА из DT_extraction
-            # быстрая проверка
-            code = hs.get("eaeu_hs_code")
-            if not code or len(code) != 10 or not code.isdigit():
-                raise ValueError(f"некорректный код: {code}")
-            if len(hs.get("explanations", [])) != 5:
-                raise ValueError("нужно ровно 5 строк объяснений.")
-            results.append({
-                "line_index": idx,
-                "description": inv_item.get("description"),
-                "model_or_sku": inv_item.get("model_or_sku"),
-                "eaeu_hs_code": code,
-                "confidence": hs.get("confidence"),
-                "explanations": hs.get("explanations"),
-                "candidate_codes": hs.get("candidate_codes", []),
-                "evidence_urls": hs.get("evidence_urls", []),
-                "notes": hs.get("notes", "")
-            })
+            return fn(model, meta)
         except Exception as e:
-            results.append({
-                "line_index": idx,
-                "description": inv_item.get("description"),
-                "model_or_sku": inv_item.get("model_or_sku"),
-                "error": f"HS-классификация не получена: {e}"
-            })
-    return results
-
-def _call_perplexity(message_content: list, schema, *, temperature: float = 0.2, web_search: bool = False) -> Dict[str, Any]:
-    headers = {
-        "Authorization": f"Bearer {PPLX_API_KEY}",
-        "Content-Type": "application/json",
-    }
+            meta["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            meta["latency_s"] = round(time.perf_counter() - start, 3)
+
+    call = lambda: resilience.call(
+        resilience.POLICIES[policy], attempt, MODEL,
+        validate=lambda data: validate_result(data, schema),
+        hedge=resilience.HEDGE_REQUESTS and not streaming,
+    )
+    if tape is None:
+        return call()
+    return tape.record(call, attempts, message_content, schema, **request)
+
+def _payload(message_content: list, schema, model: str, temperature: float, web_search: bool) -> Dict[str, Any]:
     payload = {
-        "model": MODEL,
+        "model": model,
         "messages": [{"role": "user", "content": message_content}],
         "response_format": {"type": "json_schema", "json_schema": {"schema": schema}},
         "temperature": temperature
@@ -195,54 +316,100 @@ def _call_perplexity(message_content: list, schema, *, temperature: float = 0.2,
     if web_search:
         # ключевое: просим Perplexity сравнить с интернет-источниками
         payload["web_search_options"] = {"search": True, "search_type": "pro"}
+    return payload
 
-    resp = requests.post(API_URL, headers=headers, proxies=proxies, data=json.dumps(payload), timeout=120)
+def _post_perplexity(message_content: list, schema, model: str, temperature: float, web_search: bool,
+                     meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """meta (для кассеты) получает usage ответа."""
+    payload = _payload(message_content, schema, model, temperature, web_search)
+    resp = client().post(payload)
     resp.raise_for_status()
-    content = resp.json()["choices"][0]["message"]["content"]
+    body = resp.json()
+    if meta is not None:
+        meta["usage"] = body.get("usage")
+    content = body["choices"][0]["message"]["content"]
     return json.loads(content)
 
-def extract_from_pdf_file(path_to_pdf: str, instruction, schema) -> Dict[str, Any]:
+def _stream_perplexity(message_content: list, schema, model: str, temperature: float, web_search: bool,
+                       on_item, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """SSE-поток: JSON разбирается по мере прихода, готовые позиции сразу отдаются в on_item."""
+    payload = {**_payload(message_content, schema, model, temperature, web_search), "stream": True}
+    parser = JsonItemStream("items")
+    with client().post(payload, stream=True) as resp:
+        resp.raise_for_status()
+        resp.encoding = resp.encoding or "utf-8"
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if meta is not None and chunk.get("usage"):
+                meta["usage"] = chunk["usage"]   # приходит в последних событиях потока
+            delta = ((chunk.get("choices") or [{}])[0].get("delta") or {}).get("content") or ""
+            for idx, item in parser.feed(delta):
+                on_item(idx, item, parser.head)
+    return parser.result()
+
+def extract_from_pdf_file(path_to_pdf: str, instruction, schema, on_item=None) -> Dict[str, Any]:
     """
     Вариант 2: локальный PDF — шлем base64 (без data: префикса).
+    Одновременные запросы по одному и тому же содержимому PDF объединяются.
+    on_item: см. _call_perplexity (потоковая выдача позиций).
     """
-    with open(path_to_pdf, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
+    key = content_hash(["extract", file_sha256(Path(path_to_pdf)), instruction, schema])
+    return INFLIGHT.do(key, lambda: _extract_from_pdf_file(path_to_pdf, instruction, schema, on_item))
+
+def _extract_from_pdf_file(path_to_pdf: str, instruction, schema, on_item=None) -> Dict[str, Any]:
+    # сканы перед отправкой уменьшаются (pdf_optimize); время извлечения — в его статистику
+    from pdf_optimize import prepare
+    data, stat = prepare(Path(path_to_pdf))
+    start = time.perf_counter()
+    try:
+        return _extract_from_pdf_bytes(data, os.path.basename(path_to_pdf), instruction, schema, on_item)
+    finally:
+        stat["extract_s"] = round(time.perf_counter() - start, 3)
+
+def extract_from_pdf_bytes(data: bytes, file_name: str, instruction, schema, on_item=None) -> Dict[str, Any]:
+    """Как extract_from_pdf_file, но PDF уже в памяти (например, диапазон страниц — см. chunked_extract)."""
+    key = content_hash(["extract", hashlib.sha256(data).hexdigest(), instruction, schema])
+    return INFLIGHT.do(key, lambda: _extract_from_pdf_bytes(data, file_name, instruction, schema, on_item))
+
+def _extract_from_pdf_bytes(data: bytes, file_name: str, instruction, schema, on_item=None) -> Dict[str, Any]:
+    b64 = base64.b64encode(data).decode("utf-8")
     message_content = [
         {"type": "text", "text": instruction},
-        {"type": "file_url", "file_url": {"url": b64}, "file_name": os.path.basename(path_to_pdf)},
+        {"type": "file_url", "file_url": {"url": b64}, "file_name": file_name},
     ]
-    return _call_perplexity(message_content, schema)
+    return _call_perplexity(message_content, schema, on_item=on_item)
 
 def validate_result(data: Dict[str, Any], schema) -> None:
+    import jsonschema
     jsonschema.validate(instance=data, schema=schema)
 
 def load_json(p: str | Path) -> Dict[str, Any]:
     with open(p, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def fmt_incoterms(src: Dict[str, Any]) -> Optional[str]:
-    if not src:
-        return None
-    rule = src.get("rule")
-    place = src.get("place")
-    version = src.get("version")
-    if not (rule and place):
+def normalize_country(c: Optional[str]) -> Optional[str]:
+    """ISO 3166 alpha-2 по коду/названию/синониму (refdata); не распознали — исходная строка."""
+    if not c or not c.strip():
         return None
-    return f"{rule} {place}" + (f", {version}" if version else "")
+    found = refdata.country(c)
+    return found.alpha2 if found else c.strip()
 
-def party_from_invoice_or_contract(invoice: Dict, contract: Dict, key: str) -> Dict[str, Any]:
-    """
-    key: 'seller' | 'buyer'
-    Предпочтение инвойсу (там чаще финальные наимен./адреса), иначе договор.
-    """
-    a = (invoice.get(key) or {}) if invoice else {}
-    b = (contract.get(key) or {}) if contract else {}
-    return {**b, **a}  # invoice override
+def fmt_country(c: Optional[str]) -> Optional[str]:
+    """'DE (Германия)' для граф 15/17/34."""
+    found = refdata.country(c) if c else None
+    return f"{found.alpha2} ({found.name_ru})" if found else c
 
-def normalize_country(c: Optional[str]) -> Optional[str]:
-    if not c:
+def normalize_currency(c: Optional[str]) -> Optional[str]:
+    """Буквенный код ISO 4217 ('€', 'евро', 'RUR' → EUR/RUB)."""
+    if not c or not c.strip():
         return None
-    return c.strip()
+    found = refdata.currency(c)
+    return found.code if found else c.strip().upper()
 
 def money(v: Any, cur: Optional[str]) -> str:
     if v is None:
@@ -254,10 +421,11 @@ def money(v: Any, cur: Optional[str]) -> str:
     return f"{val:,.2f}".replace(",", " ").replace(".00", ".00") + (f" {cur}" if cur else "")
 
 def uom_okei(uom: Optional[str]) -> Tuple[str, str]:
+    """(код ОКЕИ, условное обозначение); не распознали — ("", uom)."""
     if not uom:
         return ("", "")
-    key = uom.strip().lower()
-    return OKEI.get(key, ("", uom))
+    unit = refdata.okei(uom)
+    return (unit.code, unit.symbol) if unit else ("", uom)
 
 # ——— сопоставление позиций invoice ↔ PL ———
 def index_items(items: List[Dict[str, Any]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
@@ -277,90 +445,129 @@ def best_key(model_or_sku: Optional[str], description: Optional[str]) -> Tuple[s
     d = (description or "").strip().lower()
     return (m or "", d or "")
 
+def match_pl_items(inv_items: List[Dict[str, Any]], pl_items: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Строка PL для каждой позиции инвойса (или None). Один товар в нескольких строках
+    (в т.ч. в разных инвойсах/PL поставки) сопоставляется по порядку: i-я строка инвойса
+    с этим ключом — i-й строке PL с ним же; лишние — последней.
+    """
+    idx_pl = index_items(pl_items)
+    same: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for it in pl_items or []:
+        same.setdefault(best_key(it.get("model_or_sku"), it.get("description")), []).append(it)
+    seen: Dict[Tuple[str, str], int] = {}
+    matched = []
+    for inv in inv_items:
+        key = best_key(inv.get("model_or_sku"), inv.get("description"))
+        n = seen[key] = seen.get(key, -1) + 1
+        pli = same[key][n] if n < len(same.get(key, ())) else idx_pl.get(key)
+        # если не нашли по ключу, попробуем тупо по description
+        if not pli and key[1]:
+            pli = next((x for x in pl_items if (x.get("description") or "").strip().lower() == key[1]), None)
+        matched.append(pli)
+    return matched
+
 # ——— генерация текста для ДТ ———
-def build_dt_text(invoice: Dict, pl: Dict, cmr: Dict, contract: Dict) -> str:
+def build_dt_text(invoice, pl=None, cmr=None, contract=None) -> str:
+    """Текст граф ДТ. Документы — JSON по ролям или готовый models.Documents (первым аргументом)."""
+    from models import Documents, PLItem
+    docs = Documents.of(invoice, pl, cmr, contract)
+    inv, pl, cmr, contract = docs.invoice, docs.pl, docs.cmr, docs.agreement
+
     # базовые источники
-    currency_code = ((invoice.get("currency") or {}).get("code") or "").upper() or None
-    total_amount = invoice.get("total_amount")
+    currency_code = normalize_currency(docs.currency_code())
+    total_amount = inv.total_amount
 
     # стороны: продавец/покупатель (инвойс > договор)
-    seller = party_from_invoice_or_contract(invoice, contract, "seller")
-    buyer  = party_from_invoice_or_contract(invoice, contract, "buyer")
+    seller = docs.party("seller")
+    buyer  = docs.party("buyer")
 
     # страны отправления/назначения из CMR
     country_dispatch = None
-    if cmr.get("place_and_date_taking_over", {}).get("place"):
+    taking_over = cmr.place_and_date_taking_over
+    if taking_over and taking_over.place:
         # попытаемся ISO, если уже ISO — ок; иначе оставим как есть
-        country_dispatch = normalize_country(cmr.get("route_countries", [None])[0] or None) \
-                           or normalize_country((cmr["place_and_date_taking_over"]["place"] or "").split(",")[-1])
+        country_dispatch = normalize_country((cmr.route_countries or [None])[0]) \
+                           or normalize_country(taking_over.place.split(",")[-1])
 
-    country_destination = None
-    if cmr.get("place_of_delivery", {}).get("country"):
-        country_destination = normalize_country(cmr["place_of_delivery"]["country"])
+    delivery = cmr.place_of_delivery
+    if delivery and delivery.country:
+        country_destination = normalize_country(delivery.country)
     else:
         # fallback: последний код маршрута
-        rc = cmr.get("route_countries") or []
+        rc = cmr.route_countries or []
         country_destination = normalize_country(rc[-1] if rc else None)
 
     # Incoterms (инвойс > договор)
-    incoterms_str = fmt_incoterms(invoice.get("incoterms") or {}) or fmt_incoterms(contract.get("incoterms") or {})
+    incoterms_str = docs.incoterms()
 
     # транспорт
-    tr = cmr.get("transport") or {}
-    tractor = tr.get("tractor_plate")
-    trailer = tr.get("trailer_plate")
-    plate_cc = tr.get("plate_country_code")
+    tr = cmr.transport
+    tractor = tr.tractor_plate if tr else None
+    trailer = tr.trailer_plate if tr else None
+    plate_cc = normalize_country(tr.plate_country_code if tr else None)
 
     # упаковка/марки PL
-    pl_packages = pl.get("packages", {})
-    pl_marks = (pl_packages or {}).get("marks_and_numbers") or ""
+    packages = pl.packages
+    pl_marks = (packages.marks_and_numbers if packages else None) or ""
 
     # документы для гр. 44
     doc_44 = []
     if contract:
-        doc_44.append(("Contract", contract.get("contract_number"), contract.get("contract_date")))
-        for app in contract.get("appendices", []) or []:
-            doc_44.append((app.get("type") or "Appendix", app.get("number"), app.get("date")))
-        for link_name, ref in (contract.get("cross_links") or {}).items():
+        doc_44.append(("Contract", contract.contract_number, contract.contract_date))
+        for app in contract.appendices or []:
+            doc_44.append((app.type or "Appendix", app.number, app.date))
+        for link_name, ref in (contract.cross_links or {}).items():
             if ref:
                 doc_44.append((link_name.replace("_", " ").title(), ref.get("number"), ref.get("date")))
-    if invoice:
-        doc_44.append(("Invoice", invoice.get("invoice_number"), invoice.get("invoice_date")))
-        if (invoice.get("contract_reference") or {}).get("number"):
-            cr = invoice["contract_reference"]
-            doc_44.append(("Contract (ref in invoice)", cr.get("number"), cr.get("date")))
-    if pl:
-        doc_44.append(("Packing List", pl.get("pl_number"), pl.get("pl_date")))
+    if inv.documents:
+        # поставка из нескольких инвойсов — каждый отдельной строкой гр. 44
+        doc_44 += [("Invoice", d.number, d.date) for d in inv.documents]
+    elif inv:
+        doc_44.append(("Invoice", inv.invoice_number, inv.invoice_date))
+    if inv:
+        cr = inv.contract_reference
+        if cr and cr.number:
+            doc_44.append(("Contract (ref in invoice)", cr.number, cr.date))
+    if pl.documents:
+        doc_44 += [("Packing List", d.number, d.date) for d in pl.documents]
+    elif pl:
+        doc_44.append(("Packing List", pl.pl_number, pl.pl_date))
     if cmr:
-        doc_44.append(("CMR", cmr.get("cmr_number"), cmr.get("cmr_date")))
-        for r in cmr.get("related_documents") or []:
-            doc_44.append((r.get("type"), r.get("number"), r.get("date")))
+        doc_44.append(("CMR", cmr.cmr_number, cmr.cmr_date))
+        for r in cmr.related_documents or []:
+            doc_44.append((r.type, r.number, r.date))
 
     # ——— шапка по графам ———
     header_lines = []
-    header_lines.append(f"[2] Отправитель (продавец) — {seller.get('name') or '—'}; "
-                        f"{seller.get('address') or seller.get('legal_address') or '—'}; "
-                        f"VAT/рег: {seller.get('vat_or_reg_number') or '—'}")
-    header_lines.append(f"[8] Получатель (покупатель/импортер) — {buyer.get('name') or '—'}; "
-                        f"{buyer.get('address') or buyer.get('legal_address') or '—'}; "
-                        f"ИНН: {buyer.get('inn') or '—'}; КПП: {buyer.get('kpp') or '—'}")
-    header_lines.append(f"[15] Страна отправления — {country_dispatch or '—'}")
-    header_lines.append(f"[17] Страна назначения — {country_destination or '—'}")
+    header_lines.append(f"[2] Отправитель (продавец) — {seller.name or '—'}; "
+                        f"{seller.address or seller.legal_address or '—'}; "
+                        f"VAT/рег: {seller.vat_or_reg_number or '—'}")
+    header_lines.append(f"[8] Получатель (покупатель/импортер) — {buyer.name or '—'}; "
+                        f"{buyer.address or buyer.legal_address or '—'}; "
+                        f"ИНН: {buyer.inn or '—'}; КПП: {buyer.kpp or '—'}")
+    header_lines.append(f"[15] Страна отправления — {fmt_country(country_dispatch) or '—'}")
+    header_lines.append(f"[17] Страна назначения — {fmt_country(country_destination) or '—'}")
     header_lines.append(f"[20] Условия поставки — {incoterms_str or '—'}")
     header_lines.append(f"[21] Идентификация ТС — тягач: {tractor or '—'}; прицеп: {trailer or '—'}; "
                         f"страна номера: {plate_cc or '—'}")
-    header_lines.append(f"[22] Валюта и сумма по счёту — {currency_code or '—'}; Итого: {money(total_amount, currency_code)}")
+    mixed = len(docs.invoice_currencies()) > 1   # сведённые инвойсы в разных валютах: суммы — по документам
+    if mixed:
+        header_lines.append("[22] Валюта и сумма по счёту — по инвойсам: " + "; ".join(
+            f"№{d.number or d.file} — {money(d.total_amount, d.currency or '—')}" for d in inv.documents))
+    else:
+        header_lines.append(f"[22] Валюта и сумма по счёту — {currency_code or '—'}; Итого: {money(total_amount, currency_code)}")
     header_lines.append(f"[25] Вид транспорта на границе — 30 (автодорожный)")
     header_lines.append(f"[26] Вид транспорта внутри страны — 30 (автодорожный)")
     # 31 (общий): краткое резюме упаковки/маркировок
-    header_lines.append(f"[31] Упаковка/маркировка (сводно) — {pl.get('packages', {}).get('total_packages') or '—'} мест; "
-                        f"{pl.get('packages', {}).get('package_type') or '—'}; Marks: {pl_marks or '—'}")
+    header_lines.append(f"[31] Упаковка/маркировка (сводно) — {(packages and packages.total_packages) or '—'} мест; "
+                        f"{(packages and packages.package_type) or '—'}; Marks: {pl_marks or '—'}")
     header_lines.append(f"[33] Код товара (ТН ВЭД ЕАЭС) — требуется классификация")
     # 34 (общий): может отсутствовать — заполняется по позициям/сертификатам, оставим примечание
     header_lines.append(f"[34] Страна происхождения — по позициям/документам происхождения (если указаны)")
     # 35/38 общие — лучше из PL + сверка с CMR
-    g_total = pl.get("gross_weight_total") or pl.get("gross_weight_total_kg") or cmr.get("gross_weight_total_kg")
-    n_total = pl.get("net_weight_total") or pl.get("net_weight_total_kg") or cmr.get("net_weight_total_kg")
+    g_total = pl.gross_weight_total or pl.gross_weight_total_kg or cmr.gross_weight_total_kg
+    n_total = pl.net_weight_total or pl.net_weight_total_kg or cmr.net_weight_total_kg
     header_lines.append(f"[35] Вес брутто (общий) — {g_total if g_total is not None else '—'} кг")
     header_lines.append(f"[38] Вес нетто (общий) — {n_total if n_total is not None else '—'} кг")
     header_lines.append(f"[41] Доп. ед. изм./количество — см. по позициям; привести к кодам ОКЕИ/ЕАЭС")
@@ -371,66 +578,90 @@ def build_dt_text(invoice: Dict, pl: Dict, cmr: Dict, contract: Dict) -> str:
     else:
         doc_lines = "—"
     header_lines.append(f"[44] Доп. документы — {doc_lines}")
-    header_lines.append(f"[46] Статистическая стоимость — расчётная (по правилам статистики/курсам)")
-    header_lines.append(f"[47] Налоги/платежи — расчётные (ставки по коду ТН ВЭД)")
+    for note in inv.merge_notes + pl.merge_notes:
+        header_lines.append(f"[44] Примечание — {note}")
+    # ——— гр. 45/46: расчёт сразу по всем позициям ———
+    from valuation import valuate_invoice
+    matched = docs.matched()
+    cur_info = refdata.currency(currency_code) if currency_code else None
+    exp = cur_info.minor_unit if cur_info and cur_info.minor_unit is not None else 2
+    val = valuate_invoice(docs, currency=currency_code, exp=exp)
+    if val.customs is not None:
+        rate_note = "" if currency_code == "RUB" else f" (курс {currency_code} {float(val.rate):.4f} на {val.rate_date})"
+        header_lines.append(f"[45] Таможенная стоимость (итого) — {money(val.customs.sum() / 100, 'RUB')}{rate_note}")
+    elif mixed:
+        header_lines.append(f"[45] Таможенная стоимость (итого) — не рассчитана (инвойсы в разных валютах)")
+    else:
+        header_lines.append(f"[45] Таможенная стоимость (итого) — "
+                            f"{money(val.value.sum() / 10 ** exp, currency_code)} в валюте инвойса, нет курса")
+    if val.statistical is not None:
+        header_lines.append(f"[46] Статистическая стоимость (итого) — {money(val.statistical.sum() / 100, 'USD')}")
+    else:
+        header_lines.append(f"[46] Статистическая стоимость — не рассчитана"
+                            + (" (инвойсы в разных валютах)" if mixed else " (нет курса)"))
+    for note in val.notes:
+        header_lines.append(f"[45] Примечание — {note}")
+    header_lines.append(f"[47] Налоги/платежи — по позициям после классификации (раздел «Таможенные платежи»)")
 
     # ——— построчно по позициям ———
-    # индексы
-    inv_items = invoice.get("items") or []
-    pl_items  = pl.get("items") or []
-    idx_pl = index_items(pl_items)
-
     lines_block = []
-    for i, inv in enumerate(inv_items, start=1):
-        key = best_key(inv.get("model_or_sku"), inv.get("description"))
-        pli = idx_pl.get(key)
-        # если не нашли по ключу, попробуем тупо по description
-        if not pli and key[1]:
-            pli = next((x for x in pl_items if (x.get("description") or "").strip().lower() == key[1]), None)
-
-        desc = inv.get("description") or (pli or {}).get("description") or "—"
-        model = inv.get("model_or_sku") or (pli or {}).get("model_or_sku") or ""
+    for i, (item, pli) in enumerate(zip(inv.items, matched), start=1):
+        pli = pli or PLItem()
+        desc = item.description or pli.description or "—"
+        model = item.model_or_sku or pli.model_or_sku or ""
         if model and model.lower() not in desc.lower():
             desc_show = f"{desc}; модель/артикул: {model}"
         else:
             desc_show = desc
 
-        qty = inv.get("quantity")
-        uom = inv.get("uom") or (pli or {}).get("uom")
+        qty = item.quantity
+        uom = item.uom or pli.uom
         okei_code, okei_name = uom_okei(uom)
-        gross = (pli or {}).get("gross_weight") or (pli or {}).get("gross_weight_kg")
-        net   = (pli or {}).get("net_weight") or (pli or {}).get("net_weight_kg")
-        packaging = (pli or {}).get("packaging") or {}
+        gross = pli.gross
+        net   = pli.net
+        packaging = pli.packaging
         packs_str = []
         if packaging:
-            if packaging.get("packages_qty"): packs_str.append(f"{packaging['packages_qty']} мест")
-            if packaging.get("package_type"): packs_str.append(str(packaging['package_type']))
-            if packaging.get("marks_range"): packs_str.append(f"Marks: {packaging['marks_range']}")
+            if packaging.packages_qty: packs_str.append(f"{packaging.packages_qty} мест")
+            if packaging.package_type: packs_str.append(str(packaging.package_type))
+            if packaging.marks_range: packs_str.append(f"Marks: {packaging.marks_range}")
         packs_show = ", ".join(packs_str) or "—"
 
-        origin = (inv.get("origin_country")
-                  or (pli or {}).get("origin_country")
-                  or "—")
-        unit_price = inv.get("unit_price")
-        line_total = inv.get("line_total")
+        origin = fmt_country(normalize_country(item.origin_country or pli.origin_country)) or "—"
 
-        lines_block.append(f"[31] Позиция {i}: {desc_show}. Упаковка/маркировка: {packs_show}")
+        src = item.source
+        where = f" (инвойс №{src.number or src.file}, стр. {src.line})" if src else ""
+        lines_block.append(f"[31] Позиция {i}{where}: {desc_show}. Упаковка/маркировка: {packs_show}")
         lines_block.append(f"[34] Страна происхождения — {origin}")
         lines_block.append(f"[35] Вес брутто (кг) — {gross if gross is not None else '—'}")
         lines_block.append(f"[38] Вес нетто (кг) — {net if net is not None else '—'}")
         if qty is not None or uom:
             lines_block.append(f"[41] Кол-во/ед. — {qty if qty is not None else '—'} {uom or ''}"
                                + (f" (ОКЕИ {okei_code} {okei_name})" if okei_code else ""))
-        lines_block.append(f"[42] Цена за единицу — {money(unit_price, currency_code)}")
-        lines_block.append(f"[45] Таможенная стоимость по строке — требуется расчёт (учёт Incoterms/фрахта/страховки)")
-        lines_block.append(f"[46] Стат. стоимость по строке — расчёт от таможенной стоимости (валюта статистики)")
-        
+        line_currency = (src.currency if mixed and src and src.currency else currency_code)
+        lines_block.append(f"[42] Цена за единицу — {money(item.unit_price, line_currency)}")
+        j = i - 1
+        adds = [(name, part[j]) for name, part in (("фрахт", val.freight), ("страховка", val.insurance),
+                                                   ("упаковка/скидка", val.other)) if part[j]]
+        basis = f"цена {money(val.invoice_value[j] / 10 ** exp, currency_code)}" + "".join(
+            f" + {name} {money(amount / 10 ** exp, None)}" for name, amount in adds)
+        if val.customs is not None:
+            lines_block.append(f"[45] Таможенная стоимость по строке — {money(val.customs[j] / 100, 'RUB')} ({basis})")
+        elif mixed:
+            lines_block.append(f"[45] Таможенная стоимость по строке — не рассчитана; "
+                               f"стоимость {money(item.line_total, line_currency)} в валюте инвойса строки")
+        else:
+            lines_block.append(f"[45] Таможенная стоимость по строке — {money(val.value[j] / 10 ** exp, currency_code)} "
+                               f"в валюте инвойса ({basis}), нет курса")
+        if val.statistical is not None:
+            lines_block.append(f"[46] Стат. стоимость по строке — {money(val.statistical[j] / 100, 'USD')}")
         lines_block.append("")
 
     text = "\n".join(header_lines) + "\n\n" + "\n".join(lines_block).rstrip()
     return text
 
 if __name__ == "__main__":
+    invoice, package_list, cmr, agreement = (_prompt(n) for n in ("invoice", "package_list", "cmr", "agreement"))
     invoice_ = extract_from_pdf_file("./docs/invoice_GM-INV-2025-384.pdf", 
                                  invoice.INVOICE_INSTRUCTION_RU, 
                                  invoice.INVOICE_SCHEMA)
@@ -0,0 +1,189 @@
+# resilience.py
+"""
+Защита вызовов API от «хвостов» и отказов:
+  * хеджирование — если ответа нет дольше наблюдаемого p95, отправляется дубль запроса,
+    побеждает первый ответ, прошедший проверку схемы;
+  * автомат отключения (circuit breaker) — при явной недоступности API/прокси вызовы сразу
+    падают или уходят на запасную модель (FALLBACK_MODEL).
+Политики у извлечения документов и классификации ТН ВЭД разные (POLICIES).
+Каждый фактический запрос (в т.ч. дубль) занимает слот адаптивного лимита своей политики
+и поток из пула своей политики.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Optional
+
+from adaptive_limit import LIMITERS
+
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "").lower() in ("1", "true", "yes")
+FALLBACK_MODEL = os.environ.get("FALLBACK_MODEL") or None
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+@dataclass(frozen=True)
+class CallPolicy:
+    name: str
+    hedge: bool                    # разрешён ли дубль запроса
+    hedge_percentile: float        # после какого перцентиля задержки слать дубль
+    hedge_min_delay: float         # не раньше, чем через столько секунд
+    hedge_default_delay: float     # пока статистики мало
+    failure_threshold: int         # подряд отказов до размыкания
+    reset_timeout: float           # сколько держать разомкнутым до пробного вызова
+
+POLICIES: Dict[str, CallPolicy] = {
+    # PDF в base64 тяжёлый — дубль дорог, поэтому ждём дольше
+    "extract": CallPolicy("extract", hedge=True, hedge_percentile=0.95, hedge_min_delay=20.0,
+                          hedge_default_delay=60.0, failure_threshold=3, reset_timeout=60.0),
+    # запросы ТН ВЭД лёгкие, но с веб-поиском и с большим разбросом времени
+    "hs": CallPolicy("hs", hedge=True, hedge_percentile=0.95, hedge_min_delay=8.0,
+                     hedge_default_delay=30.0, failure_threshold=5, reset_timeout=30.0),
+}
+
+MIN_SAMPLES = 20
+
+def is_outage(exc: BaseException) -> bool:
+    """Отказ канала (сеть, прокси, таймаут, 5xx/429), а не ошибка содержимого ответа."""
+    import requests  # к этому моменту уже загружен клиентом API
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code >= 500 or exc.response.status_code == 429
+    return False
+
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return None
+            data = sorted(self._samples)
+        return data[min(len(data) - 1, int(p * len(data)))]
+
+class CircuitBreaker:
+    """closed → (N отказов подряд) → open → (reset_timeout) → half_open → один пробный вызов."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probe = False
+            if self.state == "half_open" and not self._probe:
+                self._probe = True
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self.state, self.failures, self._probe = "closed", 0, False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state, self.opened_at, self._probe = "open", time.monotonic(), False
+
+_latency: Dict[str, LatencyTracker] = {}
+_pools: Dict[str, ThreadPoolExecutor] = {}
+_breakers: Dict[tuple, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+
+def latency(policy: CallPolicy) -> LatencyTracker:
+    with _registry_lock:
+        return _latency.setdefault(policy.name, LatencyTracker())
+
+def breaker(policy: CallPolicy, model: str) -> CircuitBreaker:
+    with _registry_lock:
+        key = (policy.name, model)
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+        return _breakers[key]
+
+def pool(policy: CallPolicy) -> ThreadPoolExecutor:
+    """Свой пул у каждой политики: потоки, ждущие слота извлечения, не занимают места запросов ТН ВЭД."""
+    with _registry_lock:
+        if policy.name not in _pools:
+            # на каждый слот лимита — запрос и его дубль
+            _pools[policy.name] = ThreadPoolExecutor(max_workers=2 * LIMITERS[policy.name].max_limit,
+                                                     thread_name_prefix=f"api-{policy.name}")
+        return _pools[policy.name]
+
+def hedge_delay(policy: CallPolicy) -> float:
+    p = latency(policy).percentile(policy.hedge_percentile)
+    return max(policy.hedge_min_delay, p if p is not None else policy.hedge_default_delay)
+
+def pick_model(policy: CallPolicy, model: str, fallback: Optional[str] = FALLBACK_MODEL) -> str:
+    if breaker(policy, model).allow():
+        return model
+    if fallback and fallback != model and breaker(policy, fallback).allow():
+        return fallback
+    raise CircuitOpenError(f"API недоступно ({policy.name}, {model}): автомат разомкнут")
+
+def call(policy: CallPolicy, fn: Callable[[str], Any], model: str, *,
+         validate: Optional[Callable[[Any], None]] = None, hedge: bool = HEDGE_REQUESTS,
+         fallback: Optional[str] = FALLBACK_MODEL) -> Any:
+    """
+    fn(model) → ответ. validate(ответ) бросает исключение, если ответ не годится.
+    С hedge=True после hedge_delay() отправляется дубль; побеждает первый годный ответ,
+    опоздавший дубль дорабатывает в фоне и игнорируется.
+    """
+    model = pick_model(policy, model, fallback)
+    brk, lat = breaker(policy, model), latency(policy)
+
+    def attempt():
+        try:
+            with LIMITERS[policy.name].slot():
+                start = time.monotonic()
+                value = fn(model)
+        except BaseException as e:
+            if is_outage(e):
+                brk.failure()
+            raise
+        brk.success()
+        lat.add(time.monotonic() - start)
+        if validate is not None:
+            validate(value)
+        return value
+
+    executor = pool(policy)
+    pending = {executor.submit(attempt)}
+    hedged = not (hedge and policy.hedge)
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, timeout=None if hedged else hedge_delay(policy),
+                             return_when=FIRST_COMPLETED)
+        for fut in done:
+            try:
+                return fut.result()
+            except BaseException as e:
+                error = e
+        if not hedged and not done and LIMITERS[policy.name].saturated:
+            continue  # все слоты заняты — дубль только удлинит очередь
+        if not hedged and (not done or not pending):
+            # ответа нет дольше p95 (или первая попытка уже упала) — шлём дубль
+            hedged = True
+            if not done or not is_outage(error):
+                pending.add(executor.submit(attempt))
+    raise error
@@ -0,0 +1,190 @@
+# result_store.py
+"""
+Постоянное хранилище результатов (SQLite): извлечённые JSON, результаты ТН ВЭД и готовые отчёты
+по каждой поставке (run). Переживает рестарт и доступно нескольким процессам бота/воркеров.
+Старые записи сжимаются (zlib) методом compact(), устаревшие кэш стадий и промежуточные
+выходы задач (out:<task_id>) удаляются методом evict().
+
+Кэш стадий (stage_cache) — результаты стадий конвейера по ключу из хэшей их входов
+(см. pipeline.stage_key); общий для всех поставок, так что неизменившиеся стадии не пересчитываются.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+DB_PATH = Path(os.environ.get("RESULT_DB", "./data/results.sqlite3"))
+COMPRESS_AFTER_DAYS = float(os.environ.get("RESULT_COMPRESS_AFTER_DAYS", "7"))
+CACHE_TTL_DAYS = float(os.environ.get("RESULT_CACHE_TTL_DAYS", "30"))
+OUT_TTL_DAYS = float(os.environ.get("RESULT_OUT_TTL_DAYS", "3"))   # дольше жизни поставки (JOB_TTL_HOURS)
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id     TEXT PRIMARY KEY,
+    chat_id    INTEGER NOT NULL,
+    created_at REAL    NOT NULL,
+    status     TEXT    NOT NULL DEFAULT 'new',
+    title      TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_runs_chat_created ON runs(chat_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_runs_created ON runs(created_at);
+
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id     TEXT NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    kind       TEXT NOT NULL,          -- extracted:<role> | hs_results | dt_text | report
+    codec      TEXT NOT NULL,          -- raw:text | raw:json | zlib:text | zlib:json
+    data       BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (run_id, kind)
+);
+
+CREATE TABLE IF NOT EXISTS stage_cache (
+    key        TEXT PRIMARY KEY,       -- sha256(стадия, версия, хэши входов)
+    stage      TEXT NOT NULL,
+    inputs     TEXT NOT NULL,          -- JSON: вход → хэш содержимого
+    codec      TEXT NOT NULL,
+    data       BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_stage_cache_created ON stage_cache(created_at);
+"""
+
+def _encode(value: Any):
+    if isinstance(value, str):
+        return "raw:text", value.encode("utf-8")
+    return "raw:json", json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+def _decode(codec: str, data: bytes) -> Any:
+    comp, _, fmt = codec.partition(":")
+    if comp == "zlib":
+        data = zlib.decompress(data)
+    text = data.decode("utf-8")
+    return json.loads(text) if fmt == "json" else text
+
+class ResultStore:
+    def __init__(self, path: Path = DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as c:
+            c.executescript(SCHEMA_SQL)
+
+    def _conn(self) -> sqlite3.Connection:
+        # отдельное соединение на поток; WAL — параллельное чтение при записи из другого процесса
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    # ——— runs ———
+    def create_run(self, run_id: str, chat_id: int, title: Optional[str] = None, status: str = "new") -> None:
+        with self._conn() as c:
+            c.execute(
+                "INSERT INTO runs(run_id, chat_id, created_at, status, title) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(run_id) DO UPDATE SET status = excluded.status, title = COALESCE(excluded.title, runs.title)",
+                (run_id, chat_id, time.time(), status, title),
+            )
+
+    def set_status(self, run_id: str, status: str) -> None:
+        with self._conn() as c:
+            c.execute("UPDATE runs SET status = ? WHERE run_id = ?", (status, run_id))
+
+    def get_run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list_runs(self, chat_id: int, limit: int = 10, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Последние прогоны чата; со status — только в этом статусе (фильтр до LIMIT)."""
+        sql, args = "SELECT * FROM runs WHERE chat_id = ?", [chat_id]
+        if status is not None:
+            sql += " AND status = ?"
+            args.append(status)
+        rows = self._conn().execute(sql + " ORDER BY created_at DESC LIMIT ?", (*args, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    # ——— artifacts ———
+    def put(self, run_id: str, kind: str, value: Any) -> None:
+        codec, raw = _encode(value)
+        with self._conn() as c:
+            c.execute(
+                "INSERT OR REPLACE INTO artifacts(run_id, kind, codec, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                (run_id, kind, codec, raw, time.time()),
+            )
+
+    def get(self, run_id: str, kind: str) -> Any:
+        row = self._conn().execute(
+            "SELECT codec, data FROM artifacts WHERE run_id = ? AND kind = ?", (run_id, kind)
+        ).fetchone()
+        return _decode(row["codec"], row["data"]) if row else None
+
+    def save_run(self, run_id: str, chat_id: int, extracted: Dict[str, Dict[str, Any]],
+                 dt_text: str, hs_results: List[Dict[str, Any]], report: str, title: Optional[str] = None) -> None:
+        self.create_run(run_id, chat_id, title=title, status="done")
+        for role, data in extracted.items():
+            self.put(run_id, f"extracted:{role}", data)
+        self.put(run_id, "hs_results", hs_results)
+        self.put(run_id, "dt_text", dt_text)
+        self.put(run_id, "report", report)
+
+    def report(self, run_id: str, chat_id: Optional[int] = None) -> Optional[str]:
+        """Готовый отчёт; если задан chat_id — только для своего чата."""
+        if chat_id is not None:
+            run = self.get_run(run_id)
+            if not run or run["chat_id"] != chat_id:
+                return None
+        return self.get(run_id, "report")
+
+    # ——— кэш стадий ———
+    def cached(self, key: str) -> Any:
+        row = self._conn().execute("SELECT codec, data FROM stage_cache WHERE key = ?", (key,)).fetchone()
+        return _decode(row["codec"], row["data"]) if row else None
+
+    def put_cached(self, key: str, stage: str, inputs: Dict[str, str], value: Any) -> None:
+        codec, raw = _encode(value)
+        with self._conn() as c:
+            c.execute(
+                "INSERT OR REPLACE INTO stage_cache(key, stage, inputs, codec, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, stage, json.dumps(inputs, sort_keys=True), codec, raw, time.time()),
+            )
+
+    # ——— обслуживание ———
+    def compact(self, older_than_days: float = COMPRESS_AFTER_DAYS) -> int:
+        """Сжимает несжатые артефакты старше порога. Возвращает число сжатых записей."""
+        cutoff = time.time() - older_than_days * 86400
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT rowid, codec, data FROM artifacts WHERE codec LIKE 'raw:%' AND created_at < ?", (cutoff,)
+        ).fetchall()
+        cached = conn.execute(
+            "SELECT rowid, codec, data FROM stage_cache WHERE codec LIKE 'raw:%' AND created_at < ?", (cutoff,)
+        ).fetchall()
+        with conn as c:
+            for table, batch in (("artifacts", rows), ("stage_cache", cached)):
+                for r in batch:
+                    fmt = r["codec"].partition(":")[2]
+                    c.execute(
+                        f"UPDATE {table} SET codec = ?, data = ? WHERE rowid = ?",
+                        (f"zlib:{fmt}", zlib.compress(r["data"], 9), r["rowid"]),
+                    )
+        return len(rows) + len(cached)
+
+    def evict(self, cache_days: float = CACHE_TTL_DAYS, out_days: float = OUT_TTL_DAYS) -> int:
+        """
+        Удаляет записи кэша стадий старше cache_days и выходы задач (out:<task_id>) старше out_days:
+        они нужны, только пока поставка открыта, итог прогона сохраняется отдельно (save_run).
+        Возвращает число удалённых записей.
+        """
+        now = time.time()
+        with self._conn() as c:
+            cached = c.execute("DELETE FROM stage_cache WHERE created_at < ?", (now - cache_days * 86400,))
+            outs = c.execute("DELETE FROM artifacts WHERE kind LIKE 'out:%' AND created_at < ?",
+                             (now - out_days * 86400,))
+        return cached.rowcount + outs.rowcount
@@ -0,0 +1,217 @@
+# shipments.py
+"""
+Сессии поставок: у каждого чата может быть несколько поставок (job) одновременно,
+у каждой — своя рабочая папка ./jobs/<chat_id>/<job_id>. Файлы скачиваются потоково
+на диск, роль определяется сразу по приходу файла, и тут же в очередь ставится его извлечение.
+Инвойсов и упаковочных листов в поставке может быть несколько (multidoc) — каждый извлекается
+своей задачей, а сводный документ пересобирается при поступлении нового.
+Папка ./jobs должна быть общей для бота и воркеров.
+"""
+import asyncio
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional, List, Tuple
+
+import httpx
+
+from doc_roles import classify_document, RoleGuess
+from hashing import file_sha256
+from multidoc import MULTI_ROLES
+from pipeline import REQUIRED_ROLES, doc_stage, downstream, stage_graph, stage_payload
+from work_queue import WorkQueue
+
+JOBS_ROOT = Path("./jobs")
+JOB_TTL_SECONDS = 24 * 3600
+DOWNLOAD_CHUNK = 64 * 1024
+
+@dataclass
+class Shipment:
+    job_id: str
+    chat_id: int
+    workdir: Path
+    created_at: float = field(default_factory=time.time)
+    touched_at: float = field(default_factory=time.time)
+    docs: Dict[str, List[Path]] = field(default_factory=dict)      # роль → файлы по порядку поступления
+    guesses: Dict[str, RoleGuess] = field(default_factory=dict)    # роль → результат классификации
+    stage_tasks: Dict[str, str] = field(default_factory=dict)      # стадия → последний task_id
+    unassigned: List[RoleGuess] = field(default_factory=list)
+
+    @property
+    def missing_roles(self) -> List[str]:
+        return [r for r in REQUIRED_ROLES if r not in self.docs]
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing_roles
+
+    @property
+    def report_submitted(self) -> bool:
+        return "report" in self.stage_tasks
+
+    def graph(self) -> Dict[str, List[str]]:
+        return stage_graph({r: len(files) for r, files in self.docs.items()})
+
+    def submit_stage(self, queue: WorkQueue, name: str, payload: Optional[dict] = None) -> str:
+        """
+        Ставит стадию графа в очередь; её входы — последние задачи стадий-зависимостей.
+        Прежняя задача стадии и всё, что от неё зависит, отменяются: иначе старая цепочка
+        тоже дошла бы до отчёта и перезаписала бы прогон.
+        """
+        inputs = {dep: self.stage_tasks[dep] for dep in self.graph()[name]}
+        if name in self.stage_tasks:
+            queue.cancel(self.stage_tasks[name])
+        self.stage_tasks[name] = queue.enqueue(self.job_id, self.chat_id, name,
+                                               {**(payload or {}), "inputs": inputs},
+                                               depends_on=inputs.values())
+        return self.stage_tasks[name]
+
+    def stage_payload(self, name: str) -> Optional[dict]:
+        # извлечению и сверке нужны пути к PDF (сверке — для повторного извлечения отдельных полей)
+        return stage_payload(name, {r: [p.resolve() for p in files] for r, files in self.docs.items()})
+
+    def submit_extraction(self, queue: WorkQueue, role: str, path: Path) -> List[str]:
+        """
+        Ставит извлечение документа и все зависящие от него стадии, для которых уже есть входы
+        (ТН ВЭД по инвойсу стартует сразу, отчёт — когда собраны все четыре документа).
+        Замена документа пересоздаёт только зависящие от него стадии; остальные задачи поставки
+        остаются прежними. Инвойс/упаковочный лист не заменяет, а добавляется к уже полученным
+        (повтор того же файла игнорируется) — тогда ставится его извлечение и заново сведение.
+        Возвращает список поставленных стадий.
+        """
+        files = self.docs.get(role, [])
+        if role in MULTI_ROLES:
+            digest = file_sha256(path)
+            if any(file_sha256(f) == digest for f in files):
+                return []
+            self.docs[role] = files + [path]
+        else:
+            self.docs[role] = [path]
+        self.touched_at = time.time()
+        stage = f"extract:{role}"
+        submitted = []
+        n = len(self.docs[role])
+        if n > 1:
+            # первый документ мог быть поставлен как extract:<роль> — его извлечение ставим заново
+            # отдельной стадией, повторного вызова API не будет: ключ кэша тот же
+            for k in range(1, n + 1):
+                if doc_stage(role, k) not in self.stage_tasks:
+                    self.submit_stage(queue, doc_stage(role, k), self.stage_payload(doc_stage(role, k)))
+                    submitted.append(doc_stage(role, k))
+        self.submit_stage(queue, stage, self.stage_payload(stage))
+        submitted.append(stage)
+        graph = self.graph()
+        for name in downstream(stage):
+            if all(dep in self.stage_tasks for dep in graph[name]):
+                self.submit_stage(queue, name, self.stage_payload(name))
+                submitted.append(name)
+        return submitted
+
+class ShipmentRegistry:
+    def __init__(self, root: Path = JOBS_ROOT, ttl_seconds: float = JOB_TTL_SECONDS):
+        self.root = root
+        self.ttl = ttl_seconds
+        self._by_chat: Dict[int, Dict[str, Shipment]] = {}
+
+    def create(self, chat_id: int) -> Shipment:
+        job_id = uuid.uuid4().hex[:12]
+        workdir = self.root / str(chat_id) / job_id
+        workdir.mkdir(parents=True, exist_ok=True)
+        job = Shipment(job_id=job_id, chat_id=chat_id, workdir=workdir)
+        self._by_chat.setdefault(chat_id, {})[job_id] = job
+        return job
+
+    def get(self, chat_id: int, job_id: Optional[str]) -> Optional[Shipment]:
+        if not job_id:
+            return None
+        return self._by_chat.get(chat_id, {}).get(job_id)
+
+    def list(self, chat_id: int) -> List[Shipment]:
+        return sorted(self._by_chat.get(chat_id, {}).values(), key=lambda j: j.created_at)
+
+    def close(self, job: Shipment) -> None:
+        self._by_chat.get(job.chat_id, {}).pop(job.job_id, None)
+        shutil.rmtree(job.workdir, ignore_errors=True)
+
+    def sweep(self) -> int:
+        """Удаляет устаревшие поставки и «осиротевшие» папки (например, после рестарта)."""
+        now = time.time()
+        removed = 0
+        for jobs in list(self._by_chat.values()):
+            for job in list(jobs.values()):
+                if now - job.touched_at > self.ttl:
+                    self.close(job)
+                    removed += 1
+        known = {j.workdir.resolve() for jobs in self._by_chat.values() for j in jobs.values()}
+        if self.root.exists():
+            for chat_dir in self.root.iterdir():
+                for job_dir in (chat_dir.iterdir() if chat_dir.is_dir() else []):
+                    if job_dir.resolve() not in known and now - job_dir.stat().st_mtime > self.ttl:
+                        shutil.rmtree(job_dir, ignore_errors=True)
+                        removed += 1
+        return removed
+
+# ——— приём файлов ———
+def safe_filename(name: str) -> str:
+    name = Path(name or "document.pdf").name
+    name = re.sub(r"[^\w.\-]+", "_", name, flags=re.UNICODE).strip("._") or "document"
+    return name if name.lower().endswith(".pdf") else name + ".pdf"
+
+def unique_path(workdir: Path, filename: str) -> Path:
+    """
+    Свободное имя в workdir (a.pdf, a_1.pdf, a_2.pdf…), занятое сразу пустым файлом: загрузки
+    с одинаковым именем идут параллельно и без резервирования писали бы в один и тот же файл.
+    """
+    base = workdir / safe_filename(filename)
+    p, n = base, 0
+    while True:
+        try:
+            os.close(os.open(p, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return p
+        except FileExistsError:
+            n += 1
+            p = base.with_name(f"{base.stem}_{n}{base.suffix}")
+
+async def stream_download(url_or_path: str, dest: Path, client: Optional[httpx.AsyncClient] = None) -> Path:
+    """
+    Скачивает файл частями прямо на диск, не держа его целиком в памяти.
+    Локальный Bot API сервер отдаёт путь к файлу — тогда просто копируем.
+    """
+    tmp = dest.with_suffix(dest.suffix + ".part")
+    try:
+        if Path(url_or_path).is_file():
+            await asyncio.to_thread(shutil.copyfile, url_or_path, tmp)
+        else:
+            own = client is None
+            client = client or httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0))
+            try:
+                async with client.stream("GET", url_or_path) as resp:
+                    resp.raise_for_status()
+                    with tmp.open("wb") as f:
+                        async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK):
+                            f.write(chunk)
+            finally:
+                if own:
+                    await client.aclose()
+        tmp.replace(dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)   # недокачанный файл не остаётся в папке поставки
+        raise
+    return dest
+
+async def accept_file(job: Shipment, path: Path, queue: WorkQueue) -> Tuple[RoleGuess, List[str]]:
+    """
+    Определяет роль только что полученного файла и сразу ставит его извлечение в очередь.
+    Возвращает (роль, поставленные стадии); повторная загрузка договора/CMR заменяет документ,
+    инвойс и упаковочный лист добавляются к поставке.
+    """
+    guess = await asyncio.to_thread(classify_document, path)
+    if guess.role not in REQUIRED_ROLES:
+        job.unassigned.append(guess)
+        return guess, []
+    job.guesses[guess.role] = guess
+    return guess, await asyncio.to_thread(job.submit_extraction, queue, guess.role, path)
@@ -0,0 +1,100 @@
+# singleflight.py
+"""
+Объединение одинаковых одновременных запросов (single-flight): пока запрос с ключом K
+выполняется, повторные вызовы с тем же K не идут в API, а ждут тот же результат
+(или то же исключение). Работает в пределах процесса; между процессами повтор
+отсекает кэш стадий (pipeline.run_stage_cached).
+
+Вызов выполняется в общем пуле, а не в потоке первого вызвавшего, поэтому любой ожидающий
+может уйти по таймауту, не мешая остальным. Если ушли все, а запрос ещё не начался, он
+отменяется; уже начатый HTTP-запрос прервать нельзя — его результат просто отбрасывается.
+
+start() запускает запрос заранее, никого не дожидаясь; с linger результат завершённого
+запроса ещё какое-то время отдаётся тем, кто придёт за ним позже (упреждающая ТН ВЭД).
+"""
+import copy
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+class _Call:
+    __slots__ = ("future", "waiters", "linger", "expires")
+
+    def __init__(self, linger: float = 0.0):
+        self.future: Optional[Future] = None
+        self.waiters = 0
+        self.linger = linger
+        self.expires: Optional[float] = None   # для завершённых с linger
+
+class SingleFlight:
+    def __init__(self, max_workers: int = 32, name: str = "flight"):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "shared": 0, "cancelled": 0}
+        self._last_purge = time.monotonic()
+
+    def _join(self, key: str, fn: Callable[[], Any], linger: float) -> _Call:
+        # вызывается под self._lock
+        now = time.monotonic()
+        if now - self._last_purge > 30:
+            self._last_purge = now
+            for k in [k for k, c in self._calls.items() if c.expires is not None and c.expires < now]:
+                del self._calls[k]
+        call = self._calls.get(key)
+        if call is not None and (call.expires is None or call.expires >= now):
+            self.stats["shared"] += 1
+            return call
+        call = _Call(linger)
+        self._calls[key] = call
+        call.future = self._pool.submit(self._run, key, call, fn)
+        self.stats["calls"] += 1
+        return call
+
+    def start(self, key: str, fn: Callable[[], Any], *, linger: float = 0.0) -> Future:
+        """Запускает запрос (или присоединяется к идущему), не дожидаясь результата."""
+        with self._lock:
+            return self._join(key, fn, linger).future
+
+    def do(self, key: str, fn: Callable[[], Any], *, timeout: Optional[float] = None,
+           linger: float = 0.0) -> Any:
+        """
+        Возвращает результат fn() (каждому ожидающему — своя копия).
+        timeout: сколько ждать этому вызывающему; по истечении — concurrent.futures.TimeoutError.
+        linger: сколько секунд после завершения отдавать готовый результат новым вызовам.
+        """
+        with self._lock:
+            call = self._join(key, fn, linger)
+            call.waiters += 1
+        try:
+            return copy.deepcopy(call.future.result(timeout))
+        finally:
+            self._leave(key, call)
+
+    def _leave(self, key: str, call: _Call) -> None:
+        with self._lock:
+            call.waiters -= 1
+            if call.waiters == 0 and call.future.cancel():
+                self.stats["cancelled"] += 1
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+    def _run(self, key: str, call: _Call, fn: Callable[[], Any]) -> Any:
+        ok = False
+        try:
+            value = fn()
+            ok = True
+            return value
+        finally:
+            # новые вызовы после завершения идут уже в новый запрос (ошибки не задерживаем)
+            with self._lock:
+                if self._calls.get(key) is call:
+                    if ok and call.linger > 0:
+                        call.expires = time.monotonic() + call.linger
+                    else:
+                        del self._calls[key]
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return sum(1 for c in self._calls.values() if not c.future.done())
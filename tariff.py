@@ -0,0 +1,323 @@
+# tariff.py
+"""
+Таможенные платежи для гр. 47 без обращения к сети: пошлина, акциз, НДС по строкам
+и таможенный сбор за декларацию.
+
+Ставки — локальные таблицы в TARIFF_DIR, по каталогу на дату вступления в силу:
+    tariff/2025-01-01/rates.csv   code,duty,vat,excise,note
+    tariff/2025-01-01/fees.csv    up_to_rub,fee_rub (шкала сбора от таможенной стоимости)
+Для расчёта на дату берётся последняя версия не позже неё. code — префикс кода ТН ВЭД
+(от 2 до 10 знаков, пустой — для всех товаров); каждое поле берётся из самой длинной
+строки-префикса, где оно заполнено, так что НДС можно задать один раз на все коды.
+
+Ставка пошлины/акциза:
+    5%                        адвалорная
+    0.5 EUR/кг                специфическая (единица — по ОКЕИ: кг, л, шт, пар …)
+    10%, не менее 0.3 EUR/кг  комбинированная — большая из двух
+    5% + 0.2 EUR/кг           сумма
+
+Проверка ставок по коду:  python tariff.py 8471300000 3004900002 [--on 2025-06-01]
+"""
+import argparse
+import csv
+import os
+import re
+from dataclasses import dataclass
+from datetime import date
+from fractions import Fraction
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import refdata
+from hashing import content_hash, file_sha256
+from rates import RATES, RateTable
+
+TARIFF_DIR = Path(os.environ.get("TARIFF_DIR", Path(__file__).resolve().parent / "tariff"))
+PAYMENT_CODES = {"fee": "1010", "duty": "2010", "vat": "5010"}   # акциз — по виду товара, без кода
+
+# ——— ставки ———
+@dataclass(frozen=True)
+class Specific:
+    amount: Fraction
+    currency: str
+    unit: str          # код ОКЕИ
+
+@dataclass(frozen=True)
+class Rate:
+    """Ставка пошлины/акциза. mode: ad | specific | max | sum."""
+    percent: Fraction = Fraction(0)
+    specific: Optional[Specific] = None
+    mode: str = "ad"
+    source: str = ""
+
+_SPECIFIC = re.compile(r"^\s*([\d.,]+)\s*([A-Za-zА-Яа-я€$₽]{1,5})\s*/\s*(.+?)\s*$")
+_PERCENT = re.compile(r"^\s*([\d.,]+)\s*%\s*$")
+
+def _number(s: str) -> Fraction:
+    return Fraction(s.replace(",", "."))
+
+def _specific(s: str) -> Specific:
+    m = _SPECIFIC.match(s)
+    if not m:
+        raise ValueError(f"не разобрать специфическую ставку: {s!r}")
+    amount, cur, unit = m.groups()
+    found_cur, found_unit = refdata.currency(cur, fuzzy=False), refdata.okei(unit, fuzzy=False)
+    if not found_cur or not found_unit:
+        raise ValueError(f"неизвестная валюта или единица в ставке: {s!r}")
+    return Specific(_number(amount), found_cur.code, found_unit.code)
+
+def parse_rate(text: str) -> Optional[Rate]:
+    """Ставка из таблицы; пустая строка — ставки нет (None)."""
+    s = (text or "").strip()
+    if not s:
+        return None
+    if _PERCENT.match(s) or re.fullmatch(r"[\d.,]+", s):
+        return Rate(_number(s.rstrip("% ")), source=s)
+    if "не менее" in s:
+        ad, spec = s.split("не менее", 1)
+        return Rate(_number(ad.strip(" ,%")), _specific(spec), "max", s)
+    if "+" in s:
+        ad, spec = s.split("+", 1)
+        return Rate(_number(ad.strip(" %")), _specific(spec), "sum", s)
+    return Rate(specific=_specific(s), mode="specific", source=s)
+
+@dataclass(frozen=True)
+class LineRates:
+    duty: Optional[Rate]
+    vat: Optional[Fraction]
+    excise: Optional[Rate]
+    matched: str            # самый длинный совпавший префикс (для справки)
+
+class TariffTable:
+    __slots__ = ("version", "rows", "fees")
+
+    def __init__(self, version: str, rows: Dict[str, Dict[str, str]], fees: List[Tuple[Optional[int], int]]):
+        self.version = version
+        self.rows = rows        # префикс → {"duty", "vat", "excise", "note"}
+        self.fees = fees        # [(до, руб — None без ограничения; сбор, руб)]
+
+    def _field(self, code: str, name: str) -> Tuple[str, str]:
+        for n in range(len(code), -1, -1):
+            row = self.rows.get(code[:n])
+            if row and row.get(name, "").strip():
+                return row[name], code[:n]
+        return "", ""
+
+    @lru_cache(maxsize=4096)
+    def find(self, code: str) -> LineRates:
+        """Ставки для кода ТН ВЭД: каждое поле — из самого длинного префикса, где оно задано."""
+        code = re.sub(r"\D", "", code or "")
+        duty, p1 = self._field(code, "duty")
+        vat, p2 = self._field(code, "vat")
+        excise, p3 = self._field(code, "excise")
+        return LineRates(parse_rate(duty), _number(vat) if vat else None, parse_rate(excise),
+                         max((p1, p2, p3), key=len))
+
+    def fee(self, customs_rub: int) -> int:
+        """Таможенный сбор (руб) по таможенной стоимости декларации (руб)."""
+        for limit, fee in self.fees:
+            if limit is None or customs_rub <= limit:
+                return fee
+        return self.fees[-1][1] if self.fees else 0
+
+# ——— версии ———
+def versions(root: Path = TARIFF_DIR) -> List[str]:
+    return sorted(p.name for p in Path(root).iterdir()
+                  if p.is_dir() and re.fullmatch(r"\d{4}-\d{2}-\d{2}", p.name)) if Path(root).is_dir() else []
+
+def version_for(on: date, root: Path = TARIFF_DIR) -> Optional[str]:
+    past = [v for v in versions(root) if v <= on.isoformat()]
+    return max(past) if past else None
+
+def fingerprint(on: date, root: Path = TARIFF_DIR) -> str:
+    """Хэш версии таблиц, действующей на дату (для ключа кэша стадии payments)."""
+    v = version_for(on, root)
+    if v is None:
+        return content_hash(None)
+    return content_hash([v, {f.name: file_sha256(f) for f in sorted((Path(root) / v).glob("*.csv"))}])
+
+@lru_cache(maxsize=8)
+def _load(path: str, fp: str) -> TariffTable:
+    # fp в ключе: изменили CSV — перечитываем
+    d = Path(path)
+    with (d / "rates.csv").open(encoding="utf-8", newline="") as f:
+        rows = {re.sub(r"\D", "", r["code"] or ""): r for r in csv.DictReader(f)}
+    fees: List[Tuple[Optional[int], int]] = []
+    if (d / "fees.csv").exists():
+        with (d / "fees.csv").open(encoding="utf-8", newline="") as f:
+            fees = [(int(r["up_to_rub"]) if r["up_to_rub"] else None, int(r["fee_rub"])) for r in csv.DictReader(f)]
+    return TariffTable(d.name, rows, fees)
+
+def table(on: Optional[date] = None, root: Path = TARIFF_DIR) -> Optional[TariffTable]:
+    on = on or date.today()
+    v = version_for(on, root)
+    return _load(str(Path(root) / v), fingerprint(on, root)) if v else None
+
+# ——— расчёт ———
+_I64_LIMIT = 2 ** 62
+
+def _percent(base, pct_e4):
+    """base (копейки, int64) × ставка в десятитысячных долях процента, округление half-up."""
+    import numpy as np
+    if len(base) and int(np.abs(base).max()) * int(pct_e4.max(initial=0)) >= _I64_LIMIT:
+        prod = base.astype(object) * pct_e4.astype(object)
+        return ((prod + 500_000) // 1_000_000).astype(np.int64)
+    return (base * pct_e4 + 500_000) // 1_000_000
+
+def _rate_arrays(rates_: Sequence[Optional[Rate]], units: Sequence[str], net_kg, qty,
+                 on: date, fx: RateTable, notes: List[str], unresolved: Optional[set] = None):
+    """
+    Массивы для векторного расчёта: (процент ×10⁴, копеек за единицу базы, база, режим).
+    В unresolved — номера строк (с 0), где специфическая часть ставки не посчитана.
+    """
+    import numpy as np
+    n = len(rates_)
+    pct = np.zeros(n, dtype=np.int64)
+    per_unit = np.zeros(n, dtype=np.float64)
+    base = np.zeros(n, dtype=np.float64)
+    mode = np.zeros(n, dtype=np.int8)            # 0 ad, 1 specific, 2 max, 3 sum
+    kop_per_unit: Dict[Specific, Optional[float]] = {}
+    for i, r in enumerate(rates_):
+        if r is None:
+            continue
+        pct[i] = int(r.percent * 10_000)
+        mode[i] = ("ad", "specific", "max", "sum").index(r.mode)
+        s = r.specific
+        if s is None:
+            continue
+        if s not in kop_per_unit:
+            rub, _ = fx.rate(s.currency, on)
+            kop_per_unit[s] = float(s.amount * rub * 100) if rub is not None else None
+            if rub is None:
+                notes.append(f"нет курса {s.currency} для специфической ставки «{r.source}»")
+        per_unit[i] = kop_per_unit[s] or 0.0
+        if kop_per_unit[s] is None and unresolved is not None:
+            unresolved.add(i)
+        if s.unit == "166":
+            base[i] = net_kg[i]
+        elif s.unit == units[i]:
+            base[i] = qty[i]
+        else:
+            notes.append(f"позиция {i + 1}: ставка «{r.source}» — нет количества в единицах ставки")
+            if unresolved is not None:
+                unresolved.add(i)
+    return pct, per_unit, base, mode
+
+def _apply(customs, arrays):
+    import numpy as np
+    pct, per_unit, base, mode = arrays
+    ad = _percent(customs, pct)
+    spec = np.rint(per_unit * base).astype(np.int64)   # копейки; float64 точен до 2⁵³ копеек
+    return np.select([mode == 0, mode == 1, mode == 2], [ad, spec, np.maximum(ad, spec)], ad + spec)
+
+def compute_payments(docs, hs_results: List[Dict[str, Any]], *, on: Optional[date] = None,
+                     fx: RateTable = RATES, root: Path = TARIFF_DIR) -> Dict[str, Any]:
+    """
+    Платежи гр. 47 по результатам classify_items_eaeu — сразу для всех строк.
+    docs — models.Documents (или роль → JSON). Суммы — в копейках (*_kop); строки без кода ТН ВЭД не считаются.
+    Если хоть одна строка без кода или ставки, totals["complete"] = False и total_kop = None.
+    """
+    import numpy as np
+    from models import Documents
+    from request_2_ppx import normalize_currency, uom_okei
+    from valuation import to_minor, valuate_invoice
+    if not isinstance(docs, Documents):
+        docs = Documents.of(docs["invoice"], docs["pl"], docs["cmr"], docs["agreement"])
+    on = on or date.today()
+    tab = table(on, root)
+    items = docs.invoice.items
+    matched = docs.matched()
+    currency = normalize_currency(docs.currency_code())
+    cur_info = refdata.currency(currency) if currency else None
+    exp = cur_info.minor_unit if cur_info and cur_info.minor_unit is not None else 2
+    val = valuate_invoice(docs, currency=currency, exp=exp, on=on, rates=fx)
+    out: Dict[str, Any] = {"tariff_version": tab.version if tab else None, "rate_date": val.rate_date,
+                           "lines": [], "totals": None, "notes": list(val.notes)}
+    if tab is None:
+        out["notes"].append(f"нет таблицы ставок на {on.isoformat()} в {root}")
+        return out
+    if val.customs is None:
+        out["notes"].append("таможенная стоимость не рассчитана — платежи не считаются")
+        return out
+
+    codes = {r["line_index"]: r["eaeu_hs_code"] for r in hs_results if r.get("eaeu_hs_code")}
+    has_code = np.array([i in codes for i in range(1, len(items) + 1)], dtype=bool)
+    found = [tab.find(codes[i]) if i in codes else None for i in range(1, len(items) + 1)]
+    net_kg = to_minor([(p.net if p else None) or 0 for p in matched], 3) / 1000
+    qty = np.array([float(it.quantity or 0) for it in items], dtype=np.float64)
+    units = [uom_okei(it.uom)[0] for it in items]
+
+    notes = out["notes"]
+    unresolved: set = set()
+    customs = np.where(has_code, val.customs, 0)
+    duty = _apply(customs, _rate_arrays([f.duty if f else None for f in found], units, net_kg, qty, on, fx,
+                                        notes, unresolved))
+    excise = _apply(customs, _rate_arrays([f.excise if f else None for f in found], units, net_kg, qty, on, fx,
+                                          notes, unresolved))
+    vat_pct = np.array([int((f.vat or 0) * 10_000) if f else 0 for f in found], dtype=np.int64)
+    vat = _percent(customs + duty + excise, vat_pct)
+
+    for i, f in enumerate(found):
+        line = {"line_index": i + 1, "eaeu_hs_code": codes.get(i + 1), "customs_value_kop": int(val.customs[i])}
+        if f is None:
+            line["error"] = "нет кода ТН ВЭД — платежи не рассчитаны"
+        else:
+            line.update(duty_kop=int(duty[i]), excise_kop=int(excise[i]), vat_kop=int(vat[i]),
+                        duty_rate=f.duty.source if f.duty else None,
+                        excise_rate=f.excise.source if f.excise else None,
+                        vat_rate=str(f.vat) if f.vat is not None else None)
+            if f.duty is None:
+                line["error"] = f"ставка пошлины для {codes[i + 1]} не найдена в таблице {tab.version}"
+            elif f.vat is None:
+                line["error"] = f"ставка НДС для {codes[i + 1]} не найдена в таблице {tab.version}"
+        out["lines"].append(line)
+
+    # итог «всего» — только когда посчитаны все строки, иначе это не сумма к уплате
+    gaps = sorted({ln["line_index"] for ln in out["lines"] if ln.get("error")} | {i + 1 for i in unresolved})
+    fee = tab.fee(int(val.customs.sum()) // 100) * 100
+    out["totals"] = {"customs_value_kop": int(val.customs.sum()), "fee_kop": fee,
+                     "duty_kop": int(duty.sum()), "excise_kop": int(excise.sum()), "vat_kop": int(vat.sum()),
+                     "total_kop": None if gaps else fee + int(duty.sum()) + int(excise.sum()) + int(vat.sum()),
+                     "complete": not gaps, "incomplete_lines": gaps}
+    return out
+
+def _rub(kop: int) -> str:
+    return f"{kop / 100:,.2f}".replace(",", " ") + " RUB"
+
+def render_payments_text(payments: Dict[str, Any]) -> str:
+    lines = []
+    for ln in payments.get("lines") or []:
+        head = f"[47] Позиция {ln['line_index']}"
+        if "duty_kop" not in ln:
+            lines.append(f"{head}: {ln.get('error')}")
+            continue
+        parts = [f"{PAYMENT_CODES['duty']} пошлина {_rub(ln['duty_kop'])} ({ln['duty_rate'] or 'ставка не найдена'})"]
+        if ln.get("excise_rate"):
+            parts.append(f"акциз {_rub(ln['excise_kop'])} ({ln['excise_rate']})")
+        parts.append(f"{PAYMENT_CODES['vat']} НДС {_rub(ln['vat_kop'])} ({ln['vat_rate'] or '—'}%)")
+        lines.append(f"{head}: " + "; ".join(parts) + (f" — {ln['error']}" if ln.get("error") else ""))
+    t = payments.get("totals")
+    if t:
+        lines.append(f"[47] Итого: {PAYMENT_CODES['fee']} сбор {_rub(t['fee_kop'])}; {PAYMENT_CODES['duty']} пошлина "
+                     f"{_rub(t['duty_kop'])}; акциз {_rub(t['excise_kop'])}; {PAYMENT_CODES['vat']} НДС {_rub(t['vat_kop'])}; "
+                     + (f"всего {_rub(t['total_kop'])}" if t.get("total_kop") is not None else
+                        "всего не определено — расчёт неполный, не посчитаны позиции "
+                        + ", ".join(map(str, t.get("incomplete_lines") or [])))
+                     + f" (ставки на {payments['tariff_version']}, курс на {payments['rate_date'] or '—'})")
+    for note in payments.get("notes") or []:
+        lines.append(f"[47] Примечание — {note}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Ставки платежей по кодам ТН ВЭД из локальной таблицы")
+    ap.add_argument("codes", nargs="+")
+    ap.add_argument("--on", type=date.fromisoformat, default=date.today(), help="дата расчёта YYYY-MM-DD")
+    args = ap.parse_args()
+    tab = table(args.on)
+    if tab is None:
+        raise SystemExit(f"нет таблицы ставок на {args.on} в {TARIFF_DIR}")
+    for code in args.codes:
+        r = tab.find(code)
+        print(f"{code}: пошлина {r.duty.source if r.duty else '—'}; НДС {r.vat if r.vat is not None else '—'}%; "
+              f"акциз {r.excise.source if r.excise else '—'}  [версия {tab.version}, префикс {r.matched or '(все)'}]")
@@ -0,0 +1,124 @@
+from datetime import date
+from fractions import Fraction
+
+import numpy as np
+import pytest
+
+from rates import RateTable
+from tariff import TariffTable, _apply, _rate_arrays, parse_rate, table
+
+RATES_CSV = """code,duty,vat,excise,note
+,,20,,
+84,5%,,,
+8471,,,,
+3004,0,10,,
+6403,"10%, не менее 2 EUR/кг",,,
+"""
+
+@pytest.fixture
+def root(tmp_path):
+    for version, vat in (("2025-01-01", "20"), ("2026-01-01", "22")):
+        d = tmp_path / version
+        d.mkdir()
+        (d / "rates.csv").write_text(RATES_CSV.replace(",,20,,", f",,{vat},,"), encoding="utf-8")
+        (d / "fees.csv").write_text("up_to_rub,fee_rub\n200000,1231\n450000,2462\n,73860\n", encoding="utf-8")
+    return tmp_path
+
+@pytest.fixture
+def fx(tmp_path):
+    t = RateTable(tmp_path / "rates.json")
+    t.update("2025-01-01", {"EUR": ["1", "100.0000"]})
+    return t
+
+# ——— таблица и версии ———
+def test_empty_prefix_gives_vat_only(root):
+    r = table(date(2025, 6, 1), root).find("9999999999")
+    assert r.duty is None and r.excise is None
+    assert r.vat == 20 and r.matched == ""
+
+def test_fields_from_longest_prefix_with_value(root):
+    r = table(date(2025, 6, 1), root).find("8471 30 000 0")
+    assert r.duty.percent == 5           # в строке 8471 пошлина пустая — берётся из 84
+    assert r.vat == 20
+    assert r.matched == "84"
+    r = table(date(2025, 6, 1), root).find("3004900002")
+    assert (r.duty.percent, r.vat, r.matched) == (0, 10, "3004")
+
+def test_dated_version(root):
+    assert table(date(2024, 12, 31), root) is None
+    assert table(date(2025, 1, 1), root).version == "2025-01-01"
+    assert table(date(2025, 12, 31), root).version == "2025-01-01"
+    assert table(date(2026, 3, 1), root).find("9999").vat == 22
+
+# ——— ставки ———
+def test_parse_rate_modes():
+    assert parse_rate("") is None
+    assert parse_rate("5%").mode == "ad" and parse_rate("7,5").percent == Fraction(15, 2)
+    spec = parse_rate("0.5 EUR/кг")
+    assert (spec.mode, spec.specific.amount, spec.specific.currency, spec.specific.unit) == \
+        ("specific", Fraction(1, 2), "EUR", "166")
+    assert parse_rate("10%, не менее 0.3 EUR/кг").mode == "max"
+    assert parse_rate("5% + 0.2 EUR/кг").mode == "sum"
+    with pytest.raises(ValueError):
+        parse_rate("0.5 EUR/попугай")
+
+@pytest.mark.parametrize("text, expected", [
+    ("5%", 50_000),                        # 5% от 10 000 RUB
+    ("0.7 EUR/кг", 70_000),                # 0.7 EUR × 100 RUB × 10 кг
+    ("10%, не менее 0.3 EUR/кг", 100_000), # адвалорная больше
+    ("10%, не менее 2 EUR/кг", 200_000),   # специфическая больше
+    ("5% + 0.2 EUR/кг", 70_000),
+])
+def test_duty_modes(fx, text, expected):
+    notes = []
+    arrays = _rate_arrays([parse_rate(text)], ["796"], np.array([10.0]), np.array([3.0]), date(2025, 1, 2), fx, notes)
+    assert _apply(np.array([1_000_000], dtype=np.int64), arrays).tolist() == [expected]
+    assert notes == []
+
+def test_specific_rate_in_other_unit_needs_quantity(fx):
+    notes = []
+    arrays = _rate_arrays([parse_rate("1 EUR/шт")], ["796"], np.array([0.0]), np.array([3.0]), date(2025, 1, 2), fx, notes)
+    assert _apply(np.array([0], dtype=np.int64), arrays).tolist() == [30_000]
+    arrays = _rate_arrays([parse_rate("1 EUR/шт")], ["166"], np.array([5.0]), np.array([5.0]), date(2025, 1, 2), fx, notes)
+    assert _apply(np.array([0], dtype=np.int64), arrays).tolist() == [0]
+    assert any("нет количества" in n for n in notes)
+
+# ——— сбор ———
+@pytest.mark.parametrize("customs_rub, fee", [
+    (0, 1231), (200_000, 1231), (200_001, 2462), (450_000, 2462), (450_001, 73860), (10 ** 9, 73860),
+])
+def test_fee_scale_boundaries(root, customs_rub, fee):
+    assert table(date(2025, 6, 1), root).fee(customs_rub) == fee
+
+def test_fee_scale_without_open_upper_row():
+    tab = TariffTable("x", {}, [(100, 5), (200, 10)])
+    assert tab.fee(200) == 10 and tab.fee(201) == 10
+    assert TariffTable("x", {}, []).fee(1) == 0
+
+# ——— платежи по документам ———
+def _docs():
+    invoice = {"invoice_number": "INV-1", "invoice_date": "2025-01-01", "incoterms": {"rule": "CIP", "place": "Moscow"},
+               "currency": {"code": "EUR"}, "total_amount": 200.0,
+               "items": [{"description": f"Item {i}", "quantity": 1, "uom": "pcs", "unit_price": 100.0,
+                          "line_total": 100.0} for i in range(2)]}
+    pl = {"items": [{"description": f"Item {i}", "quantity": 1, "net_weight_kg": 1.0, "gross_weight_kg": 1.0}
+                    for i in range(2)]}
+    return {"invoice": invoice, "pl": pl, "cmr": {}, "agreement": {}}
+
+def test_totals_incomplete_when_duty_rate_missing(root, fx):
+    from tariff import compute_payments, render_payments_text
+    hs = [{"line_index": 1, "eaeu_hs_code": "8471300000"}, {"line_index": 2, "eaeu_hs_code": "9999000000"}]
+    out = compute_payments(_docs(), hs, on=date(2025, 1, 2), fx=fx, root=root)
+    t = out["totals"]
+    assert t["complete"] is False and t["total_kop"] is None and t["incomplete_lines"] == [2]
+    text = render_payments_text(out)
+    assert "всего не определено" in text and "позиции 2" in text
+
+def test_totals_complete(root, fx):
+    from tariff import compute_payments, render_payments_text
+    hs = [{"line_index": 1, "eaeu_hs_code": "8471300000"}, {"line_index": 2, "eaeu_hs_code": "3004900002"}]
+    out = compute_payments(_docs(), hs, on=date(2025, 1, 2), fx=fx, root=root)
+    t = out["totals"]
+    assert t["complete"] is True and t["incomplete_lines"] == []
+    assert t["total_kop"] == t["fee_kop"] + t["duty_kop"] + t["excise_kop"] + t["vat_kop"]
+    assert "всего " in render_payments_text(out) and "не определено" not in render_payments_text(out)
@@ -0,0 +1,130 @@
+from datetime import date
+from fractions import Fraction
+
+import numpy as np
+import pytest
+
+from rates import RateTable
+from valuation import allocate, convert, valuate
+
+ON = date(2025, 1, 2)
+
+@pytest.fixture
+def fx(tmp_path):
+    table = RateTable(tmp_path / "rates.json")
+    # JPY у ЦБ — за 100 иен
+    table.update("2025-01-01", {"EUR": ["1", "100.0000"], "USD": ["1", "80.0000"], "JPY": ["100", "65.5000"]})
+    return table
+
+def notes_of(v, text):
+    return [n for n in v.notes if text in n]
+
+# ——— allocate ———
+def test_allocate_zero_weights_split_equally():
+    share = allocate(100, np.array([0, 0, 0]))
+    assert share.tolist() == [34, 33, 33]
+
+def test_allocate_negative_weights_count_as_zero():
+    assert allocate(100, np.array([-5, 1, 1])).tolist() == [0, 50, 50]
+
+def test_allocate_all_negative_weights_split_equally():
+    assert allocate(10, np.array([-1, -2])).tolist() == [5, 5]
+
+def test_allocate_negative_total_and_largest_remainder():
+    share = allocate(-7, np.array([1, 1]))
+    assert share.tolist() == [-4, -3]
+    assert allocate(10, np.array([1, 1, 1])).tolist() == [4, 3, 3]
+
+def test_allocate_zero_total_and_empty():
+    assert allocate(0, np.array([1, 2])).tolist() == [0, 0]
+    assert allocate(5, np.array([], dtype=np.int64)).tolist() == []
+
+def test_allocate_int64_overflow_is_exact():
+    share = allocate(2 ** 40, np.array([2 ** 30, 1, 2 ** 29]))
+    assert int(share.sum()) == 2 ** 40
+
+def test_convert_half_up():
+    assert convert(1, Fraction(1, 2), 2, 2) == 1      # 0.005 → 0.01
+    assert convert(3000, Fraction(655, 1000), 0, 2) == 196500
+
+# ——— начисления и примечания ———
+def test_fca_with_listed_freight_added_without_warning(fx):
+    v = valuate(np.array([1000, 3000]), np.array([1000, 1000]), "EUR", charges={"freight": 400},
+                terms="FCA Riga", total_amount=4400, on=ON, rates=fx)
+    assert v.freight.tolist() == [200, 200]
+    assert not notes_of(v, "FCA")
+    assert not notes_of(v, "уже включены")
+
+def test_fca_with_freight_included_in_prices_no_contradiction(fx):
+    v = valuate(np.array([1000, 3000]), np.array([1000, 1000]), "EUR", charges={"freight": 400},
+                terms="FCA Riga", total_amount=4000, on=ON, rates=fx)
+    assert v.freight.tolist() == [0, 0]
+    assert notes_of(v, "уже включены")
+    assert not notes_of(v, "FCA")
+
+def test_fca_without_freight_warns(fx):
+    v = valuate(np.array([1000]), np.array([1000]), "EUR", terms="FCA Riga", on=ON, rates=fx)
+    assert notes_of(v, "FCA: расходы на перевозку")
+
+def test_cif_without_freight_no_warning(fx):
+    v = valuate(np.array([1000]), np.array([1000]), "EUR", terms="CIF Riga", on=ON, rates=fx)
+    assert not notes_of(v, "перевозку")
+
+def test_freight_by_value_when_weight_unknown(fx):
+    v = valuate(np.array([1000, 3000]), np.array([1000, 0]), "EUR", charges={"freight": 400},
+                terms="DAP", on=ON, rates=fx)
+    assert v.freight_basis == "value"
+    assert v.freight.tolist() == [100, 300]
+    assert notes_of(v, "распределён по стоимости")
+
+def test_insurance_by_value_packing_minus_discount(fx):
+    v = valuate(np.array([1000, 3000]), np.array([1, 1]), "EUR",
+                charges={"insurance": 100, "packing": 40, "discount": 20}, terms="CIP", on=ON, rates=fx)
+    assert v.insurance.tolist() == [25, 75]
+    assert v.other.tolist() == [5, 15]
+    assert v.value.tolist() == [1030, 3090]
+
+def test_customs_and_statistical_values(fx):
+    v = valuate(np.array([1000, 3000]), np.array([1, 1]), "EUR", on=ON, rates=fx)
+    assert v.customs.tolist() == [100000, 300000]           # копейки: 10 и 30 EUR по 100
+    assert int(v.statistical.sum()) == 5000                 # 4000 RUB / 80 = 50 USD
+    assert v.rate_date == "2025-01-01"
+
+def test_missing_rate(fx):
+    v = valuate(np.array([1000]), np.array([1]), "CNY", on=ON, rates=fx)
+    assert v.customs is None and notes_of(v, "нет курса CNY")
+
+# ——— валюта без дробной части ———
+def test_jpy_exp_zero(fx):
+    v = valuate(np.array([1000, 2000]), np.array([1, 1]), "JPY", exp=0, charges={"freight": 1}, on=ON, rates=fx)
+    assert v.freight.tolist() == [1, 0]                     # одна иена неделима
+    assert int(v.customs.sum()) == convert(3001, Fraction(655, 1000), 0, 2) == 196566
+    assert v.customs.tolist() == [65533, 131033]             # фрахт в копейках — снова по весу
+
+# ——— сведённые инвойсы (multidoc) ———
+def _invoice(number, currency, freight):
+    return {"invoice_number": number, "invoice_date": "2025-01-01", "incoterms": {"rule": "CIP", "place": "Moscow"},
+            "currency": {"code": currency}, "total_amount": 110.0, "charges": {"freight": freight},
+            "items": [{"description": f"Item {number}", "quantity": 1, "uom": "pcs", "unit_price": 100.0,
+                       "line_total": 100.0}]}
+
+def test_merged_invoices_same_currency_sum_charges(fx):
+    from models import Documents
+    from multidoc import merge_documents
+    from valuation import valuate_invoice
+    merged = merge_documents("invoice", [_invoice("1", "EUR", 10), _invoice("2", "EUR", 20)], ["a.pdf", "b.pdf"])
+    assert merged["charges"] == {"freight": 30} and merged["total_amount"] == 220
+    v = valuate_invoice(Documents.of(merged), on=ON, rates=fx)
+    assert int(v.customs.sum()) == 2_300_000                # 230 EUR по 100
+
+def test_merged_invoices_in_different_currencies_not_valued(fx):
+    from models import Documents
+    from multidoc import merge_documents
+    from valuation import valuate_invoice
+    merged = merge_documents("invoice", [_invoice("1", "EUR", 10), _invoice("2", "USD", 20)], ["a.pdf", "b.pdf"])
+    assert "charges" not in merged
+    assert [(d["currency"], d["charges"]) for d in merged["documents"]] == [("EUR", {"freight": 10}), ("USD", {"freight": 20})]
+    assert [it["source"]["currency"] for it in merged["items"]] == ["EUR", "USD"]
+    v = valuate_invoice(Documents.of(merged), on=ON, rates=fx)
+    assert v.customs is None and v.statistical is None
+    assert notes_of(v, "разных валютах")
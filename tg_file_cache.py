@@ -0,0 +1,46 @@
+# tg_file_cache.py
+"""
+Кэш Telegram file_id по SHA-256 содержимого: файл, который бот уже отправлял
+(или получал от пользователя), повторно отправляется по file_id без загрузки байтов.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from hashing import file_sha256  # noqa: F401 — ключ кэша
+
+CACHE_PATH = Path(os.environ.get("TG_FILE_CACHE", "./cache/tg_file_ids.json"))
+
+class FileIdCache:
+    def __init__(self, path: Path = CACHE_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._data: Dict[str, str] = {}
+        if self.path.exists():
+            try:
+                self._data = json.loads(self.path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self._data = {}
+
+    def get(self, sha: str) -> Optional[str]:
+        return self._data.get(sha)
+
+    def put(self, sha: str, file_id: str) -> None:
+        with self._lock:
+            if self._data.get(sha) == file_id:
+                return
+            self._data[sha] = file_id
+            self._save()
+
+    def drop(self, sha: str) -> None:
+        with self._lock:
+            if self._data.pop(sha, None) is not None:
+                self._save()
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._data, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(self.path)
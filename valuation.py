@@ -0,0 +1,233 @@
+# valuation.py
+"""
+Таможенная (гр. 45) и статистическая (гр. 46) стоимость по позициям — расчёт сразу для всех
+строк на массивах NumPy.
+
+Суммы хранятся в целых минимальных единицах валюты (центы, копейки), поэтому расчёт точный:
+транспорт/страховка/упаковка/скидка из инвойса распределяются по строкам методом наибольших
+остатков (сумма долей всегда равна итогу). Итоги пересчитываются в рубли по курсу ЦБ
+(rates.RATES) дробью без потери точности и так же раскладываются по строкам уже в копейках.
+
+Правила (метод 1, ст. 39–40 ТК ЕАЭС), упрощённо:
+- расходы из charges инвойса, выставленные сверх суммы позиций, входят в таможенную стоимость
+  при любых условиях поставки: для групп C/D это часть цены, для E/F — дополнительные начисления;
+- если итог инвойса уже равен сумме позиций, charges считаются справочными (включены в цену);
+- при EXW/FCA/FAS/FOB без фрахта в инвойсе стоимость занижена — об этом пишется предупреждение;
+- транспорт раскладывается по весу брутто (если он известен для всех строк), остальное — по стоимости;
+- статистическая стоимость — таможенная, пересчитанная в доллары США.
+
+Сравнение с построчным расчётом:  python valuation.py --bench 10000
+"""
+import argparse
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from fractions import Fraction
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from models import Documents
+from rates import RATES, RateTable
+
+STAT_CURRENCY = "USD"
+FREIGHT_NOT_INCLUDED = {"EXW", "FCA", "FAS", "FOB"}   # перевозка до границы не входит в цену
+
+MAX_RATE_AGE_DAYS = 7   # курс старше — предупреждение (таблица давно не обновлялась)
+
+_I64_LIMIT = 2 ** 62
+
+# ——— точная арифметика на целых ———
+def to_minor(values: Any, exp: int = 2) -> np.ndarray:
+    """Суммы (float) → целые минимальные единицы. Входные суммы уже с точностью до exp знаков."""
+    arr = np.asarray(values, dtype=np.float64)
+    return np.rint(np.nan_to_num(arr) * 10 ** exp).astype(np.int64)
+
+def allocate(total: int, weights: np.ndarray) -> np.ndarray:
+    """
+    Делит целое total пропорционально неотрицательным weights методом наибольших остатков.
+    Сумма результата всегда равна total; при равных остатках лишняя единица достаётся строке выше.
+    Нулевые веса у всех строк — делится поровну.
+    """
+    w = np.clip(np.asarray(weights, dtype=np.int64), 0, None)
+    n = len(w)
+    if n == 0 or total == 0:
+        return np.zeros(n, dtype=np.int64)
+    wsum = int(w.sum())
+    if wsum == 0:
+        w, wsum = np.ones(n, dtype=np.int64), n
+    t = abs(int(total))
+    if t * wsum < _I64_LIMIT:
+        num = w * t
+        share, rem = np.divmod(num, wsum)
+    else:
+        # произведение не влезает в int64 — целые Python (медленнее, но точно)
+        num = w.astype(object) * t
+        share = (num // wsum).astype(np.int64)
+        rem = (num % wsum).astype(np.float64) / wsum
+    short = t - int(share.sum())
+    if short:
+        share[np.argsort(-rem, kind="stable")[:short]] += 1
+    return share if total > 0 else -share
+
+def convert(amount: int, rate: Fraction, src_exp: int, dst_exp: int = 2) -> int:
+    """Целую сумму в валюте с src_exp знаками → в валюту курса с dst_exp знаками, округление half-up."""
+    value = Fraction(amount) * rate * Fraction(10) ** (dst_exp - src_exp)
+    q, r = divmod(value.numerator, value.denominator)
+    return q + (1 if 2 * r >= value.denominator else 0)
+
+# ——— расчёт ———
+@dataclass
+class Valuation:
+    currency: str                      # валюта инвойса
+    exp: int                           # знаков после запятой в валюте инвойса
+    invoice_value: np.ndarray          # стоимость позиций, мин. единицы валюты инвойса
+    freight: np.ndarray                # доли начислений по строкам, мин. единицы валюты инвойса
+    insurance: np.ndarray
+    other: np.ndarray                  # упаковка − скидка
+    customs: Optional[np.ndarray]      # гр. 45, копейки; None — нет курса
+    statistical: Optional[np.ndarray]  # гр. 46, центы USD; None — нет курса
+    rate: Optional[Fraction] = None
+    stat_rate: Optional[Fraction] = None
+    rate_date: Optional[str] = None
+    freight_basis: str = "weight"
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def value(self) -> np.ndarray:
+        """Стоимость строки с начислениями, валюта инвойса."""
+        return self.invoice_value + self.freight + self.insurance + self.other
+
+def value_lines(values: np.ndarray, weights: np.ndarray, *, freight: int = 0, insurance: int = 0,
+                packing: int = 0, discount: int = 0):
+    """Распределяет начисления по строкам: (фрахт, страховка, упаковка−скидка, база фрахта)."""
+    basis = "weight" if len(weights) and bool(np.all(weights > 0)) else "value"
+    fr = allocate(freight, weights if basis == "weight" else values)
+    ins = allocate(insurance, values)
+    other = allocate(packing, values) - allocate(discount, values)
+    return fr, ins, other, basis
+
+def valuate(values: np.ndarray, weights: np.ndarray, currency: str, *, exp: int = 2,
+            charges: Optional[Dict[str, int]] = None, terms: Optional[str] = None,
+            total_amount: Optional[int] = None, on: Optional[date] = None,
+            rates: RateTable = RATES) -> Valuation:
+    """
+    values — стоимость строк (мин. единицы валюты инвойса), weights — вес брутто строк в граммах
+    (0 — неизвестен), charges — freight/insurance/packing/discount в мин. единицах.
+    """
+    invoice_charges = {k: int(v or 0) for k, v in (charges or {}).items()}
+    charges = invoice_charges   # что добавляется к цене; фрахт «указан в инвойсе» — по invoice_charges
+    notes: List[str] = []
+    lines_sum = int(values.sum())
+    extra = sum(charges.get(k, 0) for k in ("freight", "insurance", "packing")) - charges.get("discount", 0)
+    if extra and total_amount is not None and abs(total_amount - lines_sum) <= len(values):
+        notes.append("расходы из инвойса уже включены в цены позиций (итог = сумме позиций) — не добавлялись")
+        charges = {}
+    rule = (terms or "").split()[0].upper() if terms else ""
+    if rule in FREIGHT_NOT_INCLUDED and not invoice_charges.get("freight"):
+        notes.append(f"{rule}: расходы на перевозку до границы ЕАЭС не указаны в инвойсе — "
+                     "добавить по документам перевозчика (ст. 40 ТК ЕАЭС)")
+    fr, ins, other, basis = value_lines(values, weights, **{k: charges.get(k, 0) for k in
+                                                             ("freight", "insurance", "packing", "discount")})
+    if charges.get("freight") and basis == "value":
+        notes.append("вес брутто известен не для всех позиций — фрахт распределён по стоимости")
+    v = Valuation(currency, exp, values, fr, ins, other, None, None, freight_basis=basis, notes=notes)
+
+    on = on or date.today()
+    v.rate, v.rate_date = rates.rate(currency, on)
+    v.stat_rate, stat_date = rates.rate(STAT_CURRENCY, on)
+    v.rate_date = v.rate_date or stat_date
+    if v.rate is None:
+        notes.append(f"нет курса {currency} на {on.isoformat()} в локальной таблице — python rates.py")
+        return v
+    if v.rate_date and (on - date.fromisoformat(v.rate_date)).days > MAX_RATE_AGE_DAYS:
+        notes.append(f"курс взят на {v.rate_date} — локальная таблица устарела, обновить: python rates.py")
+    # в рубли переводятся итоги, а по строкам раскладываются уже копейки: доля фрахта,
+    # округлённая до цента валюты инвойса, дала бы ошибку до рубля на строку
+    customs_total = convert(int(v.value.sum()), v.rate, exp, 2)
+    freight_rub, insurance_rub, other_rub = (convert(int(x.sum()), v.rate, exp, 2) for x in (fr, ins, other))
+    v.customs = (allocate(customs_total - freight_rub - insurance_rub - other_rub, values)
+                 + allocate(freight_rub, weights if basis == "weight" else values)
+                 + allocate(insurance_rub, values) + allocate(other_rub, values))
+    if v.stat_rate is None:
+        notes.append(f"нет курса {STAT_CURRENCY} на {on.isoformat()} — статистическая стоимость не рассчитана")
+        return v
+    v.statistical = allocate(convert(customs_total, 1 / v.stat_rate, 2, 2), v.customs)
+    return v
+
+def valuate_invoice(docs: Documents, *, currency: Optional[str] = None, exp: int = 2,
+                    on: Optional[date] = None, rates: RateTable = RATES) -> Valuation:
+    """
+    Расчёт по извлечённым документам (models.Documents; строки PL сопоставлены один раз).
+    Сведённые инвойсы в разных валютах не пересчитываются: customs и statistical — None, причина — в notes.
+    """
+    items = docs.invoice.items
+    mixed = docs.invoice_currencies()
+    if len(mixed) > 1:
+        values = to_minor([it.line_total if it.line_total is not None else (it.quantity or 0) * (it.unit_price or 0)
+                           for it in items], exp)
+        zeros = np.zeros(len(items), dtype=np.int64)
+        return Valuation("", exp, values, zeros, zeros, zeros, None, None,
+                         notes=[f"инвойсы в разных валютах ({', '.join(mixed)}) — таможенная и статистическая "
+                                "стоимость не рассчитаны, пересчёт строк в рубли по валюте каждой строки не поддерживается"])
+    totals = [it.line_total for it in items]
+    derived = [(it.quantity or 0) * (it.unit_price or 0) for it in items]
+    values = to_minor([t if t is not None else d for t, d in zip(totals, derived)], exp)
+    weights = to_minor([(p.gross if p else None) or 0 for p in docs.matched()], 3)   # граммы
+    if not weights.any() and docs.cmr.items:
+        # в PL нет весов по строкам — берём из CMR, если строк столько же
+        cmr_gross = [it.gross_weight_kg or 0 for it in docs.cmr.items]
+        if len(cmr_gross) == len(items):
+            weights = to_minor(cmr_gross, 3)
+    charges = {k: int(to_minor(v, exp)) for k, v in (docs.invoice.charges or {}).items()
+               if isinstance(v, (int, float))}
+    total = docs.invoice.total_amount
+    return valuate(values, weights, currency or docs.currency_code() or "", exp=exp,
+                   charges=charges, terms=docs.incoterms(), total_amount=int(to_minor(total, exp)) if total is not None else None,
+                   on=on, rates=rates)
+
+# ——— бенчмарк ———
+def _per_line(values: List[int], weights: List[int], freight: int, insurance: int, rate: Fraction) -> List[int]:
+    # эталон: тот же расчёт построчно на Fraction
+    wsum, vsum = sum(weights), sum(values)
+    lines = [Fraction(v) + Fraction(freight * w, wsum) + Fraction(insurance * v, vsum) for v, w in zip(values, weights)]
+    return [int(x * rate + Fraction(1, 2)) for x in lines]
+
+def benchmark(n: int, repeat: int = 5) -> None:
+    rng = np.random.default_rng(0)
+    values = rng.integers(100, 10_000_000, n).astype(np.int64)
+    weights = rng.integers(10, 500_000, n).astype(np.int64)
+    freight, insurance = 123_456_78, 9_876_54
+    tmp = tempfile.TemporaryDirectory()
+    table = RateTable(Path(tmp.name) / "rates.json")
+    table.update("2025-01-01", {"EUR": ["1", "101.6580"], "USD": ["1", "99.2600"]})
+    on = date(2025, 1, 2)
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        v = valuate(values, weights, "EUR", charges={"freight": freight, "insurance": insurance},
+                    on=on, rates=table)
+        best = min(best, time.perf_counter() - start)
+    start = time.perf_counter()
+    ref = _per_line(values.tolist(), weights.tolist(), freight, insurance, Fraction("101.6580"))
+    loop = time.perf_counter() - start
+
+    total = int(values.sum()) + freight + insurance
+    assert int(v.value.sum()) == total
+    assert int(v.customs.sum()) == convert(total, Fraction("101.6580"), 2, 2)
+    drift = int(np.abs(v.customs - np.array(ref, dtype=np.int64)).max())
+    loop_gap = sum(ref) - int(v.customs.sum())
+    print(f"{n} строк: NumPy {best * 1000:.1f} мс, построчно (Fraction) {loop * 1000:.1f} мс "
+          f"(×{loop / best:.0f}); строки отличаются от построчного округления ≤ {drift} коп., "
+          f"итог точный (сумма построчно округлённых строк расходится с ним на {loop_gap} коп.)")
+    tmp.cleanup()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Расчёт таможенной/статистической стоимости")
+    ap.add_argument("--bench", type=int, metavar="N", help="бенчмарк на N строк")
+    args = ap.parse_args()
+    for n in ([args.bench] if args.bench else [100, 1000, 10_000]):
+        benchmark(n)
@@ -0,0 +1,173 @@
+# webhook.py
+"""
+Приём обновлений Telegram через webhook: свой небольшой HTTP-сервер на asyncio (без внешних
+зависимостей). POST на WEBHOOK_PATH проверяется по заголовку X-Telegram-Bot-Api-Secret-Token,
+обновление кладётся в очередь приложения, ответ 200 уходит сразу — обработка идёт параллельно
+(concurrent_updates приложения). GET /healthz — для балансировщика.
+
+Локальная проверка без Telegram — симуляция POST-запросов:
+    python webhook.py --url http://127.0.0.1:8443/telegram --secret <WEBHOOK_SECRET> -n 200
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import time
+from typing import Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")   # публичный адрес для setWebhook (пусто — не регистрировать)
+MAX_BODY = 1024 * 1024
+READ_TIMEOUT = 30
+
+_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large"}
+
+def _body_skipped(headers: dict) -> bool:
+    return int(headers.get("content-length") or 0) > MAX_BODY
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, dict, bytes]]:
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT)
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    path = target.split("?", 1)[0]
+    length = int(headers.get("content-length") or 0)
+    if _body_skipped(headers):
+        return method, path, headers, b""  # тело не читаем, после ответа соединение закрывается
+    body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT) if length else b""
+    return method, path, headers, body
+
+def _response(status: int, body: bytes = b"", keep_alive: bool = True) -> bytes:
+    return (f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Length: {len(body)}\r\nContent-Type: text/plain\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + body
+
+class WebhookServer:
+    def __init__(self, app: Application, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET):
+        if not secret:
+            raise RuntimeError("WEBHOOK_SECRET не задан: без него webhook принимал бы чужие запросы.")
+        self.app = app
+        self.path = path
+        self.secret = secret.encode()
+        self.stats = {"accepted": 0, "rejected": 0}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def handle(self, method: str, path: str, headers: dict, body: bytes) -> int:
+        if path == "/healthz":
+            return 200 if method == "GET" else 405
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if _body_skipped(headers):
+            return 413
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.stats["rejected"] += 1
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400
+        await self.app.update_queue.put(update)
+        self.stats["accepted"] += 1
+        return 200
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    req = await _read_request(reader)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+                    break
+                method, path, headers, body = req
+                status = await self.handle(method, path, headers, body)
+                # непрочитанное тело осталось в потоке — соединение дальше не годится, каким бы ни был ответ
+                keep = headers.get("connection", "").lower() != "close" and not _body_skipped(headers)
+                writer.write(_response(status, b"ok" if status == 200 else b"", keep))
+                await writer.drain()
+                if not keep:
+                    break
+        finally:
+            writer.close()
+
+    async def start(self, host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT) -> None:
+        self._server = await asyncio.start_server(self._client, host, port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+async def run_webhook(app: Application) -> None:
+    """Жизненный цикл приложения в режиме webhook (вместо app.run_polling)."""
+    server = WebhookServer(app)
+    async with app:
+        if app.post_init is not None:  # сам PTB вызывает его только в run_polling/run_webhook
+            await app.post_init(app)
+        await app.start()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=Update.ALL_TYPES)
+        await server.start()
+        print(f"Webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+            await app.stop()
+
+# ——— симуляция ———
+def fake_update(update_id: int, chat_id: int, text: str = "/start") -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": "Test"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"}, "from": user,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    }
+
+async def simulate(url: str, secret: str, n: int, concurrency: int, chats: int) -> None:
+    import httpx
+    sem = asyncio.Semaphore(concurrency)
+    latencies, codes = [], {}
+    async with httpx.AsyncClient(timeout=10) as client:
+        async def one(i: int):
+            async with sem:
+                start = time.monotonic()
+                r = await client.post(url, json=fake_update(i + 1, 1000 + i % chats),
+                                      headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                latencies.append(time.monotonic() - start)
+                codes[r.status_code] = codes.get(r.status_code, 0) + 1
+        start = time.monotonic()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        total = time.monotonic() - start
+        bad = await client.post(url, json=fake_update(0, 1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    latencies.sort()
+    print(f"{n} обновлений за {total:.2f} c ({n / total:.0f}/c); коды: {codes}; "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.1f} мс, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} мс; "
+          f"неверный секрет → {bad.status_code}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Симуляция POST-обновлений на локальный webhook")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    ap.add_argument("--secret", default=WEBHOOK_SECRET)
+    ap.add_argument("-n", type=int, default=100, help="сколько обновлений отправить")
+    ap.add_argument("-c", "--concurrency", type=int, default=20)
+    ap.add_argument("--chats", type=int, default=10, help="по скольким чатам распределить")
+    args = ap.parse_args()
+    asyncio.run(simulate(args.url, args.secret, args.n, args.concurrency, args.chats))
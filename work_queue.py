@@ -0,0 +1,281 @@
+# work_queue.py
+"""
+Очередь задач конвейера на SQLite: бот только ставит задачи и доставляет события,
+воркеры (worker.py, сколько угодно процессов) забирают задачи под «аренду» (lease)
+и публикуют прогресс. Внешних сервисов не нужно — файл базы общий для всех процессов.
+
+Задача может зависеть от других (стадии графа pipeline.STAGE_DEPS): такую задачу воркер
+возьмёт только когда все зависимости в статусе done; если зависимость упала —
+зависящие задачи тоже помечаются failed.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from dag import critical_path, format_critical_path
+
+QUEUE_DB = Path(os.environ.get("QUEUE_DB", "./data/queue.sqlite3"))
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id     TEXT PRIMARY KEY,
+    run_id      TEXT NOT NULL,
+    chat_id     INTEGER NOT NULL,
+    kind        TEXT NOT NULL,            -- стадия: extract:<роль>[:<n>] | hs_draft | reconcile | hs | dt | payments | report
+    payload     TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'queued',   -- queued | running | done | failed | cancelled
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    worker_id   TEXT,
+    lease_until REAL,
+    error       TEXT,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_run ON tasks(run_id);
+
+CREATE TABLE IF NOT EXISTS task_deps (
+    task_id TEXT NOT NULL,
+    dep_id  TEXT NOT NULL,
+    PRIMARY KEY (task_id, dep_id)
+);
+CREATE INDEX IF NOT EXISTS idx_task_deps_dep ON task_deps(dep_id);
+
+CREATE TABLE IF NOT EXISTS events (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id     TEXT NOT NULL,
+    chat_id    INTEGER NOT NULL,
+    kind       TEXT NOT NULL,             -- progress | done | failed
+    text       TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    delivered  INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_events_pending ON events(delivered, id);
+"""
+
+class WorkQueue:
+    def __init__(self, path: Path = QUEUE_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as c:
+            c.executescript(SCHEMA_SQL)
+            cols = {r["name"] for r in c.execute("PRAGMA table_info(tasks)")}
+            for col in ("started_at", "finished_at"):
+                if col not in cols:  # база, созданная до появления таймингов
+                    c.execute(f"ALTER TABLE tasks ADD COLUMN {col} REAL")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: транзакции открываем сами (BEGIN IMMEDIATE для захвата задач)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _tx(self, sql_fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            res = sql_fn(conn)
+            conn.execute("COMMIT")
+            return res
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # ——— постановка ———
+    def enqueue(self, run_id: str, chat_id: int, kind: str, payload: Dict[str, Any],
+                depends_on: Iterable[str] = ()) -> str:
+        task_id = uuid.uuid4().hex
+        now = time.time()
+        deps = [d for d in depends_on if d]
+
+        def _do(c):
+            c.execute(
+                "INSERT INTO tasks(task_id, run_id, chat_id, kind, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (task_id, run_id, chat_id, kind, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+            c.executemany("INSERT INTO task_deps(task_id, dep_id) VALUES (?, ?)", [(task_id, d) for d in deps])
+        self._tx(_do)
+        return task_id
+
+    # ——— воркер ———
+    def claim(self, worker_id: str, kinds: Optional[Iterable[str]] = None,
+              lease_seconds: float = LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+        """Атомарно забирает готовую к выполнению задачу (или задачу с истёкшей арендой)."""
+        now = time.time()
+        kinds = list(kinds or [])
+        kind_sql = f"AND t.kind IN ({','.join('?' * len(kinds))})" if kinds else ""
+
+        def _do(c):
+            row = c.execute(
+                f"""
+                SELECT t.task_id FROM tasks t
+                WHERE (t.status = 'queued' OR (t.status = 'running' AND t.lease_until < ?))
+                  AND t.attempts < ? {kind_sql}
+                  AND NOT EXISTS (
+                      SELECT 1 FROM task_deps d JOIN tasks p ON p.task_id = d.dep_id
+                      WHERE d.task_id = t.task_id AND p.status != 'done')
+                ORDER BY t.created_at
+                LIMIT 1
+                """,
+                (now, MAX_ATTEMPTS, *kinds),
+            ).fetchone()
+            if row is None:
+                return None
+            c.execute(
+                "UPDATE tasks SET status = 'running', worker_id = ?, lease_until = ?, "
+                "attempts = attempts + 1, updated_at = ?, started_at = ? WHERE task_id = ?",
+                (worker_id, now + lease_seconds, now, now, row["task_id"]),
+            )
+            task = dict(c.execute("SELECT * FROM tasks WHERE task_id = ?", (row["task_id"],)).fetchone())
+            task["payload"] = json.loads(task["payload"])
+            return task
+        return self._tx(_do)
+
+    def heartbeat(self, task_id: str, worker_id: str, lease_seconds: float = LEASE_SECONDS) -> None:
+        self._conn().execute(
+            "UPDATE tasks SET lease_until = ?, updated_at = ? WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+            (time.time() + lease_seconds, time.time(), task_id, worker_id),
+        )
+
+    # complete/retry/fail воркера меняют задачу, только пока она за ним: после истечения аренды
+    # её мог забрать другой воркер
+    def complete(self, task_id: str, worker_id: str) -> bool:
+        """False — аренда потеряна, задача уже не за этим воркером."""
+        cur = self._conn().execute(
+            "UPDATE tasks SET status = 'done', lease_until = NULL, updated_at = ?, finished_at = ? "
+            "WHERE task_id = ? AND status = 'running' AND worker_id = ?",
+            (time.time(), time.time(), task_id, worker_id),
+        )
+        return cur.rowcount > 0
+
+    def critical_path(self, task_id: str, finished_at: Optional[float] = None) -> Optional[str]:
+        """
+        Критический путь до задачи по фактическим таймингам её зависимостей. finished_at — время
+        окончания самой задачи, если она ещё не отмечена done.
+        """
+        conn = self._conn()
+        deps: Dict[str, List[str]] = {}
+        timings, labels = {}, {}
+        frontier = [task_id]
+        while frontier:
+            tid = frontier.pop()
+            if tid in deps:
+                continue
+            row = conn.execute("SELECT kind, started_at, finished_at FROM tasks WHERE task_id = ?", (tid,)).fetchone()
+            end = row["finished_at"] if row is not None else None
+            if end is None and tid == task_id:
+                end = finished_at
+            if end is None:
+                return None
+            labels[tid] = row["kind"]
+            timings[tid] = (row["started_at"], end)
+            deps[tid] = [r["dep_id"] for r in conn.execute("SELECT dep_id FROM task_deps WHERE task_id = ?", (tid,))]
+            frontier += deps[tid]
+        path = critical_path(deps, timings, task_id)
+        total = timings[task_id][1] - min(start for start, _ in timings.values())
+        return format_critical_path([(labels[tid], dur) for tid, dur in path], total)
+
+    def retry(self, task_id: str, worker_id: str, error: str) -> bool:
+        """Возвращает задачу воркера в очередь, если попытки не исчерпаны."""
+        cur = self._conn().execute(
+            "UPDATE tasks SET status = 'queued', error = ?, lease_until = NULL, worker_id = NULL, updated_at = ? "
+            "WHERE task_id = ? AND status = 'running' AND worker_id = ? AND attempts < ?",
+            (error, time.time(), task_id, worker_id, MAX_ATTEMPTS),
+        )
+        return cur.rowcount > 0
+
+    def reap_expired(self) -> List[Dict[str, Any]]:
+        """Задачи, чья аренда истекла после последней попытки (воркер умер), — в failed."""
+        rows = self._conn().execute(
+            "SELECT task_id FROM tasks WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            (time.time(), MAX_ATTEMPTS),
+        ).fetchall()
+        failed = []
+        for r in rows:
+            failed += self.fail(r["task_id"], "воркер не завершил задачу")
+        return failed
+
+    def fail(self, task_id: str, error: str, worker_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Помечает задачу и все зависящие от неё (транзитивно) как failed. Возвращает упавшие задачи.
+        С worker_id — только если задача выполняется этим воркером (иначе ничего не меняется).
+        """
+        def _do(c):
+            if worker_id is not None and c.execute(
+                    "SELECT 1 FROM tasks WHERE task_id = ? AND status = 'running' AND worker_id = ?",
+                    (task_id, worker_id)).fetchone() is None:
+                return []
+            failed, frontier = [], [task_id]
+            while frontier:
+                tid = frontier.pop()
+                c.execute(
+                    "UPDATE tasks SET status = 'failed', error = ?, lease_until = NULL, updated_at = ? "
+                    "WHERE task_id = ? AND status NOT IN ('failed', 'cancelled')",
+                    (error if tid == task_id else f"зависимость не выполнена: {error}", time.time(), tid),
+                )
+                row = c.execute("SELECT * FROM tasks WHERE task_id = ?", (tid,)).fetchone()
+                if row["status"] == "cancelled":
+                    continue   # заменённая цепочка — о ней не сообщаем
+                failed.append(dict(row))
+                frontier += [r["task_id"] for r in c.execute("SELECT task_id FROM task_deps WHERE dep_id = ?", (tid,))]
+            return failed
+        return self._tx(_do)
+
+    def cancel(self, task_id: str) -> int:
+        """
+        Отменяет незавершённую задачу и все зависящие от неё (транзитивно): её входы заменены.
+        Выполняющаяся задача дорабатывает, но complete() для неё уже не пройдёт. Возвращает число отменённых.
+        """
+        def _do(c):
+            cancelled, frontier = 0, [task_id]
+            while frontier:
+                tid = frontier.pop()
+                cancelled += c.execute(
+                    "UPDATE tasks SET status = 'cancelled', lease_until = NULL, updated_at = ? "
+                    "WHERE task_id = ? AND status IN ('queued', 'running')",
+                    (time.time(), tid),
+                ).rowcount
+                frontier += [r["task_id"] for r in c.execute("SELECT task_id FROM task_deps WHERE dep_id = ?", (tid,))]
+            return cancelled
+        return self._tx(_do)
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return dict(row) if row else None
+
+    def stats(self) -> Dict[str, int]:
+        rows = self._conn().execute("SELECT status, COUNT(*) AS n FROM tasks GROUP BY status").fetchall()
+        return {r["status"]: r["n"] for r in rows}
+
+    # ——— события для бота ———
+    def publish(self, run_id: str, chat_id: int, kind: str, text: str) -> None:
+        self._conn().execute(
+            "INSERT INTO events(run_id, chat_id, kind, text, created_at) VALUES (?, ?, ?, ?, ?)",
+            (run_id, chat_id, kind, text, time.time()),
+        )
+
+    def take_events(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Забирает недоставленные события; при нескольких ботах каждое достаётся одному."""
+        def _do(c):
+            rows = c.execute(
+                "SELECT * FROM events WHERE delivered = 0 ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+            if rows:
+                c.executemany("UPDATE events SET delivered = 1 WHERE id = ?", [(r["id"],) for r in rows])
+            return [dict(r) for r in rows]
+        return self._tx(_do)
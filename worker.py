@@ -0,0 +1,180 @@
+# worker.py
+"""
+Воркер конвейера: забирает задачи из очереди (work_queue), выполняет извлечение документов
+и сборку отчёта с ТН ВЭД (request_2_ppx через pipeline), пишет результаты в ResultStore
+и публикует прогресс, который доставляет бот. Процессов-воркеров может быть сколько угодно.
+
+Запуск:  python worker.py --threads 4
+"""
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict
+
+from dotenv import load_dotenv
+
+load_dotenv()  # до импорта модулей проекта: часть настроек читается при импорте
+
+import adaptive_limit
+import pdf_optimize
+import request_2_ppx
+
+from pipeline import run_stage_cached, run_title, ROLE_NAMES
+from result_store import ResultStore
+from work_queue import WorkQueue, LEASE_SECONDS
+
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "4"))
+POLL_INTERVAL = 0.5
+REAP_INTERVAL = 30
+METRICS_DIR = Path(os.environ.get("METRICS_DIR", "./data/metrics"))
+
+class Worker:
+    def __init__(self, queue: WorkQueue, store: ResultStore, threads: int = WORKER_THREADS):
+        self.queue = queue
+        self.store = store
+        request_2_ppx.HS_STORE = store   # упреждающие запросы ТН ВЭД видны воркерам в других процессах
+        self.threads = threads
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._stop = threading.Event()
+        self._wake = threading.Event()  # завершение задачи могло разблокировать зависящие
+
+    # ——— стадии ———
+    def handle_stage(self, task: Dict[str, Any]) -> Dict[str, Any]:
+        """Входы стадии — результаты задач-зависимостей (out:<task_id>), выход пишется так же."""
+        run_id, name, payload = task["run_id"], task["kind"], task["payload"]
+        inputs = {dep: self.store.get(run_id, f"out:{tid}") for dep, tid in payload["inputs"].items()}
+        value = run_stage_cached(name, inputs, payload, self.store)
+        self.store.put(run_id, f"out:{task['task_id']}", value)
+        if name.startswith("extract:"):
+            role = name.split(":")[1]
+            if "path" in payload:
+                text = f"{Path(payload['path']).name}: {ROLE_NAMES[role]} извлечён."
+            else:
+                text = f"{ROLE_NAMES[role]}: сведено документов — {len(payload['files'])} ({', '.join(payload['files'])})."
+            self.queue.publish(run_id, task["chat_id"], "progress", text)
+        elif name == "hs":
+            self.queue.publish(run_id, task["chat_id"], "progress", "Классификация ТН ВЭД завершена.")
+        elif name == "reconcile" and (value["reextracted"] or value["issues"]):
+            fixed = ", ".join(f"{ROLE_NAMES[r]} ({', '.join(f)})" for r, f in value["reextracted"].items())
+            self.queue.publish(run_id, task["chat_id"], "progress",
+                               f"Сверка документов: расхождений {len(value['issues'])}"
+                               + (f"; повторно извлечено: {fixed}" if fixed else "") + ".")
+        return inputs
+
+    def finish_report(self, task: Dict[str, Any], inputs: Dict[str, Any]) -> None:
+        """Сохраняет прогон; задача report отмечается done только после этого."""
+        run_id, chat_id = task["run_id"], task["chat_id"]
+        current = self.queue.get(task["task_id"])
+        if current is None or current["status"] != "running" or current["worker_id"] != self.worker_id:
+            return   # отчёт заменён новой цепочкой (cancel) или задача у другого воркера — не сохраняем
+        result = self.store.get(run_id, f"out:{task['task_id']}")
+        extracted = inputs["reconcile"]["docs"]
+        self.store.save_run(run_id, chat_id, extracted, result["dt_text"], result["hs_results"],
+                            result["report"], run_title(extracted))
+        path = self.queue.critical_path(task["task_id"], finished_at=time.time())
+        if path:
+            self.store.put(run_id, "critical_path", path)
+            print(f"[{run_id}] {path}")
+
+    # ——— цикл ———
+    def _heartbeat(self, task_id: str, done: threading.Event) -> None:
+        while not done.wait(LEASE_SECONDS / 3):
+            self.queue.heartbeat(task_id, self.worker_id)
+
+    def run_task(self, task: Dict[str, Any]) -> None:
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(task["task_id"], done), daemon=True).start()
+        try:
+            inputs = self.handle_stage(task)
+            if task["kind"] == "report":
+                self.finish_report(task, inputs)
+            if not self.queue.complete(task["task_id"], self.worker_id):
+                print(f"[{task['run_id']}] {task['kind']}: задача отменена или аренда истекла — результат не засчитан")
+                return
+        except Exception as e:
+            traceback.print_exc()
+            if not self.queue.retry(task["task_id"], self.worker_id, str(e)):
+                self._fail(task["task_id"], str(e))
+            return
+        finally:
+            done.set()
+        if task["kind"] == "report":
+            self.queue.publish(task["run_id"], task["chat_id"], "done", f"Отчёт по поставке {task['run_id']} готов.")
+
+    def _fail(self, task_id: str, error: str) -> None:
+        self._notify_failed(self.queue.fail(task_id, error, worker_id=self.worker_id), error)
+
+    def _notify_failed(self, tasks, error: str) -> None:
+        # одна ошибка на поставку, даже если упало несколько её задач
+        for run_id, chat_id in {(t["run_id"], t["chat_id"]) for t in tasks}:
+            run = self.store.get_run(run_id)
+            if run and run["status"] == "failed":
+                continue
+            self.store.set_status(run_id, "failed")
+            self.queue.publish(run_id, chat_id, "failed", f"Ошибка обработки: {error}")
+
+    def export_metrics(self) -> None:
+        """Лимиты параллельности к API и их история, подготовка PDF — в METRICS_DIR/<worker>.json."""
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        path = METRICS_DIR / (self.worker_id.replace(":", "_") + ".json")
+        data = {"worker_id": self.worker_id, "time": time.time(), "queue": self.queue.stats(),
+                "limiters": adaptive_limit.metrics(), "pdf": pdf_optimize.metrics()}
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)
+
+    def run_forever(self) -> None:
+        slots = threading.BoundedSemaphore(self.threads)
+        last_reap = 0.0
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="pipeline") as pool:
+            while not self._stop.is_set():
+                if time.monotonic() - last_reap > REAP_INTERVAL:
+                    last_reap = time.monotonic()
+                    self._notify_failed(self.queue.reap_expired(), "воркер не завершил задачу")
+                    self.export_metrics()
+                if not slots.acquire(timeout=POLL_INTERVAL):
+                    continue
+                self._wake.clear()
+                task = self.queue.claim(self.worker_id)
+                if task is None:
+                    slots.release()
+                    self._wake.wait(POLL_INTERVAL)
+                    continue
+                fut = pool.submit(self.run_task, task)
+                fut.add_done_callback(self._task_done(slots))
+
+    def _task_done(self, slots: threading.BoundedSemaphore):
+        def _cb(_):
+            slots.release()
+            self._wake.set()
+        return _cb
+
+    def start_in_thread(self) -> threading.Thread:
+        th = threading.Thread(target=self.run_forever, name=f"worker-{self.worker_id}", daemon=True)
+        th.start()
+        return th
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+def main():
+    ap = argparse.ArgumentParser(description="Воркер конвейера AI-таможенного брокера")
+    ap.add_argument("--threads", type=int, default=WORKER_THREADS, help="параллельных задач в процессе")
+    args = ap.parse_args()
+    worker = Worker(WorkQueue(), ResultStore(), threads=args.threads)
+    print(f"Воркер {worker.worker_id} запущен ({args.threads} потоков). Ctrl+C для остановки.")
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        worker.stop()
+
+if __name__ == "__main__":
+    main()